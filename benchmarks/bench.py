@@ -0,0 +1,380 @@
+"""Benchmarks for eventedit's parser, evaluator, inversion, hashing, diffing,
+rebasing and I/O.
+
+The import benchmark times a new interpreter importing eventedit, which
+matters for command-line tools run many times over.
+
+Run the suite, writing machine-readable results:
+
+    python benchmarks/bench.py run --sizes 1000 10000 100000 -o new.json
+
+and compare two sets of results (for instance, from two commits):
+
+    python benchmarks/bench.py compare old.json new.json --threshold 0.1
+
+which exits with status 1 if any benchmark slowed by more than the threshold.
+
+Label sets and operation sequences are synthetic but shaped like real
+annotation sessions: syllables separated by gaps, with an annotator working
+through the file, renaming and repeatedly nudging boundaries, and now and
+then merging, splitting, deleting or creating events.
+"""
+from __future__ import print_function
+
+import argparse
+import copy
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import eventedit.eventedit as eved
+
+try:
+    import tracemalloc
+except ImportError: # python 2/3 support
+    tracemalloc = None
+
+try:
+    _clock = time.perf_counter
+except AttributeError: # python 2/3 support
+    _clock = time.time
+
+SYLLABLES = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'intro', 'call']
+
+# data generation
+
+def make_labels(n, seed=0):
+    """Returns n syllable-like events, with gaps between them."""
+    rng = random.Random(seed)
+    labels = []
+    t = 0.0
+    for i in range(n):
+        t += rng.uniform(0.005, 0.2) # gap
+        duration = rng.lognormvariate(-2.5, 0.5)
+        labels.append({'start': round(t, 6),
+                       'stop': round(t + duration, 6),
+                       'name': rng.choice(SYLLABLES),
+                       'tier': 'syllable'})
+        t += duration
+    return labels
+
+def make_ops(labels, n_ops, seed=0):
+    """Returns n_ops valid operations, made by editing a copy of labels the
+       way an annotator would, and the labels they produce."""
+    rng = random.Random(seed)
+    stack = eved.EditStack(labels=copy.deepcopy(labels), ops_file='unused',
+                           load=False)
+    index = 0
+    for _ in range(n_ops):
+        events = stack.labels
+        if rng.random() < 0.3: # move on through the file
+            index += rng.randint(1, 20)
+        index %= len(events) - 1
+        event = events[index]
+        duration = event['stop'] - event['start']
+        choice = rng.random()
+        nudge = rng.uniform(-0.1, 0.1) * duration
+        if choice < 0.3:
+            stack.rename(index, rng.choice(SYLLABLES))
+        elif choice < 0.5:
+            stack.set_start(index, event['start'] + nudge)
+        elif choice < 0.7:
+            stack.set_stop(index, event['stop'] + nudge)
+        elif choice < 0.8 and len(events) > 2:
+            stack.merge_next(index)
+        elif choice < 0.9:
+            stack.split(index,
+                        event['start'] + duration * rng.uniform(0.3, 0.7))
+        elif choice < 0.95 and len(events) > 2:
+            stack.delete(index)
+        else:
+            stop = event['start'] - 0.001
+            stack.create(index, stop - 0.01, stop, rng.choice(SYLLABLES),
+                         tier='syllable')
+    return list(stack.undo_stack), stack.labels
+
+# benchmarks
+#
+# each takes (labels, ops, texts) and returns a function to be timed; any
+# setup done before returning isn't timed. If the function has a setup
+# attribute, it is called (untimed) before each run, and the function is
+# passed its result.
+
+def bench_tokenize(labels, ops, texts):
+    def run():
+        for text in texts:
+            eved.tokenize(text)
+    return run
+
+def bench_read_from_tokens(labels, ops, texts):
+    tokens = [eved.tokenize(text) for text in texts]
+    def run():
+        for token_list in tokens:
+            eved.read_from_tokens(list(token_list))
+    return run
+
+def bench_iter_parse(labels, ops, texts):
+    text = '\n'.join(texts)
+    def run():
+        for _ in eved.iter_parse(io.StringIO(text)):
+            pass
+    return run
+
+def bench_evaluate(labels, ops, texts):
+    s_exprs = [op.to_sexpr() for op in ops]
+    def run(events):
+        env = eved.make_env(labels=events)
+        for s_expr in s_exprs:
+            eved.evaluate(s_expr, env)
+    run.setup = lambda: copy.deepcopy(labels)
+    return run
+
+def bench_replay(labels, ops, texts):
+    def run(events):
+        eved.replay(events, ops)
+    run.setup = lambda: copy.deepcopy(labels)
+    return run
+
+def bench_invert(labels, ops, texts):
+    s_exprs = [op.to_sexpr() for op in ops]
+    def run():
+        for s_expr in s_exprs:
+            eved.invert(s_expr)
+    return run
+
+def bench_op_inverse(labels, ops, texts):
+    s_exprs = [op.to_sexpr() for op in ops]
+    def run(fresh_ops):
+        for op in fresh_ops:
+            op.inverse()
+    # freshly compiled ops, so this measures computing, not the cache
+    run.setup = lambda: [eved.compile_op(s_expr) for s_expr in s_exprs]
+    return run
+
+def bench_event_hash(labels, ops, texts):
+    def run():
+        eved.event_hash(labels)
+    return run
+
+def bench_event_hash_blake2b(labels, ops, texts):
+    def run():
+        eved.event_hash(labels, 'blake2b', eved.EVENT_ENCODING)
+    return run
+
+def bench_event_digest(labels, ops, texts):
+    def run():
+        eved.EventDigest(labels).hexdigest()
+    return run
+
+def bench_diff(labels, ops, texts):
+    edited = copy.deepcopy(labels)
+    eved.replay(edited, ops)
+    def run():
+        eved.diff(labels, edited)
+    return run
+
+def bench_rebase(labels, ops, texts):
+    # regenerated labels, with every boundary moved a little
+    new_labels = [dict(event, start=event['start'] + 0.001,
+                       stop=event['stop'] - 0.001) for event in labels]
+    def run():
+        eved.rebase(labels, new_labels, ops)
+    return run
+
+def bench_import(labels, ops, texts):
+    # a new interpreter each time, so this includes the interpreter's startup
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    def run():
+        subprocess.check_call([sys.executable, '-c', 'import eventedit'],
+                              cwd=root)
+    return run
+
+def _bench_write(ops_format):
+    def bench(labels, ops, texts):
+        tmpdir = tempfile.mkdtemp()
+        stack = eved.EditStack(labels=copy.deepcopy(labels),
+                               ops_file=os.path.join(tmpdir, 'ops'),
+                               load=False)
+        for op in ops:
+            stack.push(op)
+        def run():
+            stack.write_to_file(ops_format=ops_format)
+        run.cleanup = lambda: shutil.rmtree(tmpdir)
+        return run
+    return bench
+
+def _bench_read(ops_format, lazy=False):
+    def bench(labels, ops, texts):
+        tmpdir = tempfile.mkdtemp()
+        ops_file = os.path.join(tmpdir, 'ops')
+        stack = eved.EditStack(labels=copy.deepcopy(labels),
+                               ops_file=ops_file, load=False)
+        for op in ops:
+            stack.push(op)
+        stack.write_to_file(ops_format=ops_format)
+        def run(events):
+            eved.EditStack(labels=events, ops_file=ops_file, load=True,
+                           lazy=lazy)
+        run.setup = lambda: copy.deepcopy(labels)
+        run.cleanup = lambda: shutil.rmtree(tmpdir)
+        return run
+    return bench
+
+BENCHMARKS = [('import', bench_import),
+              ('tokenize', bench_tokenize),
+              ('read_from_tokens', bench_read_from_tokens),
+              ('iter_parse', bench_iter_parse),
+              ('evaluate', bench_evaluate),
+              ('replay', bench_replay),
+              ('invert', bench_invert),
+              ('op_inverse', bench_op_inverse),
+              ('event_hash', bench_event_hash),
+              ('event_hash_blake2b', bench_event_hash_blake2b),
+              ('event_digest', bench_event_digest),
+              ('diff', bench_diff),
+              ('rebase', bench_rebase),
+              ('write_to_file', _bench_write('text')),
+              ('write_to_file_binary', _bench_write('binary')),
+              ('read_from_file', _bench_read('text')),
+              ('read_from_file_binary', _bench_read('binary')),
+              ('read_from_file_lazy', _bench_read('text', lazy=True))]
+
+def measure(run, repeat):
+    """Returns the best of repeat timings of run(), and its peak memory
+       allocation in bytes (None without tracemalloc)."""
+    setup = getattr(run, 'setup', None)
+    args = lambda: (setup(),) if setup else ()
+    best = float('inf')
+    for _ in range(repeat):
+        run_args = args()
+        t0 = _clock()
+        run(*run_args)
+        best = min(best, _clock() - t0)
+    peak = None
+    if tracemalloc is not None:
+        run_args = args()
+        tracemalloc.start()
+        run(*run_args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+def run_suite(sizes, n_ops=None, repeat=3, only=None, seed=0, log=None):
+    """Runs the benchmarks at each label set size, returning a list of
+       result dicts.
+
+       n_ops -- number of operations per size; if None, a tenth of the size
+                (at least 100)
+       only -- collection of benchmark names to run, or None for all"""
+    results = []
+    for size in sizes:
+        labels = make_labels(size, seed)
+        count = n_ops if n_ops is not None else max(size // 10, 100)
+        ops, _ = make_ops(labels, count, seed)
+        texts = [eved.deparse(op) for op in ops]
+        for name, bench in BENCHMARKS:
+            if only and name not in only:
+                continue
+            run = bench(labels, ops, texts)
+            try:
+                seconds, peak = measure(run, repeat)
+            finally:
+                getattr(run, 'cleanup', lambda: None)()
+            result = {'name': name, 'size': size, 'n_ops': len(ops),
+                      'seconds': seconds, 'peak_bytes': peak}
+            results.append(result)
+            if log:
+                log(result)
+    return results
+
+def metadata():
+    """Returns a description of the environment the suite ran in."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'eventedit_version': eved.__version__,
+            'commit': commit,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def compare(old, new, threshold=0.1):
+    """Compares two sets of results, returning (rows, regressions).
+
+       Each row is (name, size, old seconds, new seconds, ratio); a
+       regression is a row whose ratio exceeds 1 + threshold."""
+    old_times = {(r['name'], r['size']): r['seconds'] for r in old['results']}
+    rows = []
+    for r in new['results']:
+        key = (r['name'], r['size'])
+        if key in old_times:
+            rows.append(key + (old_times[key], r['seconds'],
+                               r['seconds'] / old_times[key]))
+    regressions = [row for row in rows if row[-1] > 1 + threshold]
+    return rows, regressions
+
+def _format_result(result):
+    peak = result['peak_bytes']
+    return '%-22s %9d events %7d ops %10.4fs %s' % (
+        result['name'], result['size'], result['n_ops'], result['seconds'],
+        '' if peak is None else '%8.1f MiB peak' % (peak / 2.0 ** 20))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                     help='label set sizes (default: 1000 10000)')
+    run.add_argument('--ops', type=int, default=None,
+                     help='operations per size (default: size / 10)')
+    run.add_argument('--repeat', type=int, default=3,
+                     help='timings per benchmark; the best is kept')
+    run.add_argument('--only', nargs='+', default=None,
+                     choices=[name for name, _ in BENCHMARKS],
+                     help='benchmarks to run (default: all)')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('-o', '--output', help='JSON file to write results to')
+    cmp_ = commands.add_parser('compare', help='compare two results files')
+    cmp_.add_argument('old')
+    cmp_.add_argument('new')
+    cmp_.add_argument('--threshold', type=float, default=0.1,
+                      help='slowdown ratio counted as a regression '
+                           '(default: 0.1)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run_suite(args.sizes, args.ops, args.repeat, args.only,
+                            args.seed, log=lambda r: print(_format_result(r)))
+        if args.output:
+            with open(args.output, 'w') as fp:
+                json.dump({'meta': metadata(), 'results': results}, fp,
+                          indent=2, sort_keys=True)
+        return 0
+    elif args.command == 'compare':
+        with open(args.old) as fp:
+            old = json.load(fp)
+        with open(args.new) as fp:
+            new = json.load(fp)
+        rows, regressions = compare(old, new, args.threshold)
+        for name, size, old_s, new_s, ratio in rows:
+            flag = '  REGRESSION' if ratio > 1 + args.threshold else ''
+            print('%-22s %9d %10.4fs %10.4fs %6.2fx%s' % (name, size, old_s,
+                                                        new_s, ratio, flag))
+        return 1 if regressions else 0
+    parser.print_help()
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,3 @@
 from __future__ import absolute_import
 from eventedit.eventedit import *
+from eventedit.labeltable import LabelTable
@@ -0,0 +1,187 @@
+"""Applies operations files to many Bark label files at once.
+
+Each label file (CSV, with at least start, stop and name columns) is paired
+with the operations file beside it (the label filename plus '.corr', and its
+'.corr.yaml' metadata). The operations are replayed onto the labels after
+checking hash_pre, and the corrected labels are written beside the original.
+
+Usage from the shell:
+
+    eventedit-batch DIRECTORY [--workers N] [--ops-suffix .corr]
+                              [--output-suffix .corrected]
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import collections
+import csv
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+from eventedit.eventedit import EditStack
+
+BOUNDARY_COLUMNS = ('start', 'stop')
+
+class BatchResult(collections.namedtuple('BatchResult',
+                                         ['labels_file', 'ops_file',
+                                          'output_file', 'n_ops', 'seconds',
+                                          'error'])):
+    """Outcome of applying one operations file.
+
+       error is None on success, or a string describing the failure, in
+       which case output_file is None."""
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def find_pairs(root, ops_suffix='.corr'):
+    """Returns (labels file, ops file) pairs for every ops file under root
+       which has a label file beside it, in sorted order."""
+    pairs = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(ops_suffix):
+                ops_file = os.path.join(dirpath, filename)
+                labels_file = ops_file[:-len(ops_suffix)]
+                if os.path.isfile(labels_file):
+                    pairs.append((labels_file, ops_file))
+    return sorted(pairs)
+
+def output_path(labels_file, output_suffix='.corrected'):
+    """Returns the filename for the corrected version of a label file, with
+       output_suffix inserted before the extension."""
+    base, ext = os.path.splitext(labels_file)
+    return base + output_suffix + ext
+
+def _open_csv(path, mode):
+    if sys.version_info[0] < 3: # python 2/3 support
+        return open(path, mode + 'b')
+    return io.open(path, mode, newline='', encoding='utf-8')
+
+def read_labels(path):
+    """Reads a CSV label file.
+
+       Returns a list of dicts, with start and stop converted to floats and
+       all other values left as strings, and the list of column names."""
+    with _open_csv(path, 'r') as fp:
+        reader = csv.DictReader(fp)
+        labels = []
+        for row in reader:
+            for column in BOUNDARY_COLUMNS:
+                row[column] = float(row[column])
+            labels.append(row)
+        return labels, list(reader.fieldnames)
+
+def write_labels(path, labels, columns=()):
+    """Writes labels to a CSV file.
+
+       columns -- column names to write first; any other columns follow in
+                  the order they are first found"""
+    columns = list(columns)
+    seen = set(columns)
+    for event in labels:
+        for column in event:
+            if column not in seen:
+                seen.add(column)
+                columns.append(column)
+    with _open_csv(path, 'w') as fp:
+        writer = csv.DictWriter(fp, columns)
+        writer.writeheader()
+        writer.writerows(labels)
+
+def apply_ops_file(labels_file, ops_file, output_file):
+    """Applies an operations file to a label file, writing the corrected
+       labels to output_file, and the label file's Bark metadata (if any)
+       beside it.
+
+       Returns the number of operations applied. Raises ValueError if the
+       label file doesn't match the operations file's hash_pre."""
+    labels, columns = read_labels(labels_file)
+    stack = EditStack(labels, ops_file, load=True)
+    write_labels(output_file, stack.labels, columns)
+    if os.path.exists(labels_file + '.meta.yaml'):
+        shutil.copyfile(labels_file + '.meta.yaml', output_file + '.meta.yaml')
+    return len(stack.undo_stack)
+
+def _apply_job(job):
+    """Runs apply_ops_file on a (labels file, ops file, output file) job,
+       returning a BatchResult instead of raising."""
+    labels_file, ops_file, output_file = job
+    t0 = time.time()
+    try:
+        n_ops = apply_ops_file(labels_file, ops_file, output_file)
+    except Exception as e:
+        return BatchResult(labels_file, ops_file, None, 0, time.time() - t0,
+                           '%s: %s' % (type(e).__name__, e))
+    return BatchResult(labels_file, ops_file, output_file, n_ops,
+                       time.time() - t0, None)
+
+def iter_apply_batch(pairs, workers=None, output_suffix='.corrected'):
+    """Applies each operations file to its label file, yielding a
+       BatchResult for each pair, in order, as it completes.
+
+       pairs -- iterable of (labels file, ops file) pairs, as from find_pairs
+       workers -- int; number of worker processes, or None for one per CPU;
+                  with 1, files are processed in this process
+       output_suffix -- string; inserted before the extension of each label
+                        filename to name its corrected version
+
+       A failure in one pair is reported in its result, and does not stop
+       the batch."""
+    jobs = [(labels_file, ops_file, output_path(labels_file, output_suffix))
+            for labels_file, ops_file in pairs]
+    if workers == 1:
+        for job in jobs:
+            yield _apply_job(job)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(_apply_job, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def apply_batch(pairs, workers=None, output_suffix='.corrected'):
+    """Returns a list of the BatchResults of iter_apply_batch."""
+    return list(iter_apply_batch(pairs, workers, output_suffix))
+
+def main(argv=None):
+    """Command-line entry point; returns the exit status."""
+    parser = argparse.ArgumentParser(
+        description='Apply operations files to the label files beside them.')
+    parser.add_argument('root', help='directory to search for label files')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes '
+                             '(default: one per CPU)')
+    parser.add_argument('--ops-suffix', default='.corr',
+                        help='suffix of operations files (default: .corr)')
+    parser.add_argument('--output-suffix', default='.corrected',
+                        help='inserted before the extension of corrected '
+                             'label files (default: .corrected)')
+    args = parser.parse_args(argv)
+    pairs = find_pairs(args.root, args.ops_suffix)
+    failures = 0
+    t0 = time.time()
+    for result in iter_apply_batch(pairs, args.workers, args.output_suffix):
+        if result.ok:
+            print('ok      %8.3fs  %6d ops  %s' % (result.seconds,
+                                                   result.n_ops,
+                                                   result.labels_file))
+        else:
+            failures += 1
+            print('FAILED  %8.3fs  %s: %s' % (result.seconds,
+                                              result.labels_file,
+                                              result.error))
+    print('%d files, %d failed, %.3fs' % (len(pairs), failures,
+                                          time.time() - t0))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
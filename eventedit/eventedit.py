@@ -1,138 +1,917 @@
-import copy
+import os
+import re
+import struct
 import itertools
 import numbers
-import tempfile
+import io
 import codecs
-import yaml
-import uuid
 import hashlib
 import collections
+import contextlib
+import threading
+import time
 import functools as ft
 
+# copy, json, logging and yaml are imported where they are needed, as
+# importing them is slow next to the rest of the module
+
 __version__ = "0.4.2"
 
-class EditStack:
-    def __init__(self, labels, ops_file, load):
+def _timed(name):
+    """Decorates an EditStack method, to be timed as name when the stack is
+       instrumented."""
+    def decorate(method):
+        @ft.wraps(method)
+        def timed(self, *args, **kwargs):
+            with self._timer(name):
+                return method(self, *args, **kwargs)
+        return timed
+    return decorate
+
+def _locked(mode, load=True):
+    """Decorates an EditStack method, to hold the stack's lock for mode
+       ('read' or 'write') while it runs, if the stack is thread-safe.
+       
+       load -- bool; if False, the method doesn't need the labels, so a
+               pending lazy load is left pending"""
+    def decorate(method):
+        @ft.wraps(method)
+        def locked(self, *args, **kwargs):
+            if self._lock is None:
+                return method(self, *args, **kwargs)
+            if load: # a lazy load writes, so can't be done while reading
+                self._load()
+            with getattr(self._lock, mode)():
+                return method(self, *args, **kwargs)
+        return locked
+    return decorate
+
+class EditStack(object):
+    def __init__(self, labels, ops_file, load, journal=False, fsync_every=1,
+                 ops_format='text', instrument=False, stats_hook=None,
+                 lazy=False, checkpoint_interval=None, thread_safe=False,
+                 autosave=None, autosave_every=None, hash_algorithm=None,
+                 metadata_format='yaml'):
         """Creates an EditStack.
         
            labels -- a list of dicts denoted event data
            ops_file -- filename string to save operations
-           load -- bool; if True, load from ops_file and apply to labels"""
-        self.labels = labels
+           load -- bool; if True, load from ops_file and apply to labels
+           journal -- bool; if True, append each operation to a journal
+                      (ops_file + '.journal') as it is executed, and if load
+                      is True and a journal exists, recover from it instead
+                      of ops_file
+           fsync_every -- int; number of journal records between syncs to
+                          disk, or 0 to leave syncing to the OS
+           ops_format -- 'text' or 'binary'; format in which to write ops_file
+                         (a loaded file keeps its own format)
+           instrument -- bool; if True, count and time operations, hashing
+                         and file access, as reported by stats()
+           stats_hook -- callable; if present, instrument, and call
+                         stats_hook(name, seconds) after each timed event
+           lazy -- bool; if True, and load is True, defer checking and
+                   replaying the loaded operations until labels are needed
+                   (see read_from_file)
+           checkpoint_interval -- int; if present, keep a snapshot of the
+                                  labels every checkpoint_interval
+                                  revisions, so goto() can jump to any
+                                  revision cheaply
+           thread_safe -- bool; if True, guard the labels and stacks with a
+                          readers-writer lock, so they may be read from
+                          several threads while another edits (see
+                          reading() and snapshot())
+           autosave -- number of seconds; if present, save to ops_file on a
+                       background thread once edits pause for this long
+           autosave_every -- int; if present, also autosave once this many
+                             edits have been made since the last save
+           hash_algorithm -- name of the hash algorithm for hash_pre, if load
+                             is False (see event_hash); if not present,
+                             DEFAULT_HASH_ALGORITHM. A loaded stack keeps
+                             the algorithm recorded in its metadata.
+           metadata_format -- 'yaml' or 'json'; format in which to write the
+                              metadata file (ops_file + '.yaml' or
+                              ops_file + '.json'); a loaded file keeps its
+                              own format
+           
+           Autosaving makes the stack thread-safe. Call flush() to save any
+           edits not yet autosaved, and close() to stop autosaving."""
+        if autosave is not None or autosave_every:
+            thread_safe = True
+        self._autosaver = None
+        self._stats = None
+        self._pending = None
+        self._lock = RWLock() if thread_safe else None
+        self._saving = threading.Lock() if thread_safe else _NO_LOCK
+        if instrument or stats_hook is not None:
+            self._stats = Stats(stats_hook)
+        self._labels = labels
         self.file = ops_file
+        self.ops_format = ops_format
+        self.metadata_format = metadata_format
+        self.journal = None
+        self.hash_post = None
+        self._digest = None
+        self._time_index = None
+        self.checkpoint_interval = checkpoint_interval
+        self._checkpoints = {}
+        self._frozen = None
+        self._transaction = None
         if load:
-            self.read_from_file()
+            if journal and os.path.exists(self.file + '.journal'):
+                self.read_from_journal()
+            else:
+                self.read_from_file(lazy=lazy)
         else:
             self.undo_stack = collections.deque()
             self.redo_stack = collections.deque()
-            self.hash_pre = event_hash(self.labels)
+            self.hash_algorithm = hash_algorithm or DEFAULT_HASH_ALGORITHM
+            self.event_encoding = EVENT_ENCODING
+            with self._timer('hash'):
+                self._digest = EventDigest(self.labels, self.hash_algorithm,
+                                       self.event_encoding)
+            self.hash_pre = self._digest.flat_hash
+            self._start_checkpoints()
+        if journal:
+            self.start_journal(fsync_every)
+        if autosave is not None or autosave_every:
+            self._autosaver = Autosaver(self.write_to_file, autosave,
+                                        autosave_every)
     
     def __enter__(self):
         return self
     
     def __exit__(self, exc_type, exc_value, exc_trace):
+        if self._autosaver is not None:
+            self._autosaver.close(flush=False) # the stack is saved below
+            self._autosaver = None
         if exc_type is None:
             self.write_to_file()
+            if self.journal is not None:
+                self.close_journal()
             return True
         else:
+            if self.journal is not None:
+                self.journal.close() # keep journal for recovery
+                self.journal = None
             self.write_to_file(self.file + '.bak')
             return False
     
-    def read_from_file(self, file=None):
+    @_locked('write', load=False)
+    @_timed('read_from_file')
+    def read_from_file(self, file=None, lazy=False):
         """Read a stack of corrections plus metadata from file.
            
            file -- if not present, use self.file
+           lazy -- bool; if True, only find where each operation lies in
+                   file; the hash check and replay happen the first time
+                   labels is accessed or the stack is changed or saved, and
+                   each operation is parsed the first time it is read from
+                   undo_stack (a read-only sequence until then). Binary
+                   files are read in full, but their replay is deferred.
            
-           Raises ValueError if pre-operation hashes don't match."""
+           Raises ValueError if pre-operation hashes don't match, or if the
+           labels after the replay don't match the hash_post the file
+           records (if lazy, when the replay happens)."""
         if file:
             self.file = file
-        with codecs.open((self.file + '.yaml'), 'r', encoding='utf-8') as mdfp:
-            file_data = yaml.safe_load(mdfp)
-            self.hash_pre = file_data['hash_pre']
-        if self.hash_pre != event_hash(self.labels):
+        file_data, self.metadata_format = read_metadata(self.file)
+        self.hash_pre = file_data['hash_pre']
+        self.hash_post = file_data.get('hash_post') # not in older files
+        # files without these predate them, and use the legacy hash
+        self.hash_algorithm = file_data.get('hash_algorithm',
+                                            LEGACY_HASH_ALGORITHM)
+        self.event_encoding = file_data.get('event_encoding')
+        self._pending = None
+        self.redo_stack = collections.deque()
+        if lazy:
+            self._digest = None
+            with self._timer('parse'):
+                self.undo_stack, self.ops_format = _read_ops_lazily(self.file)
+            self._pending = self.undo_stack
+            return
+        with self._timer('hash'):
+            self._digest = EventDigest(self.labels, self.hash_algorithm,
+                                       self.event_encoding)
+        if self.hash_pre != self._digest.flat_hash:
+            self._digest = None
             raise ValueError('label file hash does not match op file hash_pre')
-        with codecs.open(self.file, 'r', encoding='utf-8') as fp:
-            self.undo_stack = collections.deque()
-            self.redo_stack = collections.deque()
-            for op in fp:
-                if op != '\n':
-                    self.push(parse(op.strip()))
+        with self._timer('parse'):
+            s_exprs, self.ops_format = read_ops_file(self.file)
+            ops = [compile_op(s_expr) for s_expr in s_exprs]
+        self.undo_stack = collections.deque()
+        try:
+            with self._timer('replay'):
+                self._replay(ops)
+            self._check_hash_post()
+        except Exception:
+            self._digest = None
+            raise
+        self.undo_stack.extend(ops)
     
-    def write_to_file(self, file=None):
-        """Write stack of corrections plus metadata to file.
+    @_locked('write', load=False)
+    @_timed('read_from_journal')
+    def read_from_journal(self, file=None):
+        """Recover a stack of corrections from the journal of file.
+           
+           file -- if not present, use self.file; the journal read is
+                   file + '.journal'
+           
+           Restores both the undo and redo stacks, and applies the undo
+           stack to labels. A truncated final record, as left by a process
+           killed while writing it, is ignored.
            
-           file -- if not present, use self.file"""
+           Raises ValueError if pre-operation hashes don't match."""
         if file:
             self.file = file
-        with codecs.open(self.file, 'w', encoding='utf-8') as fp:
-            for op in self.undo_stack:
-                fp.write(deparse(op) + '\n')
-        with codecs.open((self.file + '.yaml'), 'w', encoding='utf-8') as mdfp:
-            self.hash_post = event_hash(self.labels)
-            file_data = {'hash_pre': self.hash_pre}
-            mdfp.write("""# corrections metadata, YAML syntax\n---\n""")
-            mdfp.write(yaml.safe_dump(file_data, default_flow_style=False))
+        self._pending = None
+        with self._timer('parse'):
+            with codecs.open((self.file + '.journal'), 'r',
+                             encoding='utf-8') as fp:
+                header, undo_ops, redo_ops = _read_journal(fp)
+        self.hash_pre = header['hash_pre']
+        self.hash_post = None # a journal is never the saved state
+        self.hash_algorithm = header.get('hash_algorithm',
+                                         LEGACY_HASH_ALGORITHM)
+        self.event_encoding = header.get('event_encoding')
+        with self._timer('hash'):
+            self._digest = EventDigest(self.labels, self.hash_algorithm,
+                                       self.event_encoding)
+        if self.hash_pre != self._digest.flat_hash:
+            self._digest = None
+            raise ValueError('label file hash does not match journal hash_pre')
+        self.undo_stack = collections.deque()
+        self.redo_stack = collections.deque(redo_ops)
+        try:
+            with self._timer('replay'):
+                self._replay(undo_ops)
+        except Exception:
+            self._digest = None
+            raise
+        self.undo_stack.extend(undo_ops)
+    
+    @_locked('write', load=False)
+    @_timed('rebase_from_file')
+    def rebase_from_file(self, old_labels, file=None):
+        """Read a stack of corrections made against other labels, such as an
+           earlier version of these, and move it onto labels.
+           
+           old_labels -- list of event dicts the corrections were made
+                         against; not modified
+           file -- if not present, use self.file
+           
+           The operations are moved by rebase(), and those which still
+           apply are applied to labels and become the undo stack; hash_pre
+           becomes the hash of labels, so writing the file afterwards saves
+           the corrections against labels. Returns the Conflicts for the
+           operations left out.
+           
+           Raises ValueError if old_labels don't match the file's
+           pre-operation hash."""
+        if file:
+            self.file = file
+        self._pending = None # labels are the new labels, whatever was loaded
+        file_data, self.metadata_format = read_metadata(self.file)
+        self.hash_algorithm = file_data.get('hash_algorithm',
+                                            LEGACY_HASH_ALGORITHM)
+        self.event_encoding = file_data.get('event_encoding')
+        with self._timer('hash'):
+            old_hash = event_hash(old_labels, self.hash_algorithm,
+                                  self.event_encoding)
+        if file_data['hash_pre'] != old_hash:
+            raise ValueError('old label file hash does not match op file '
+                             'hash_pre')
+        with self._timer('parse'):
+            s_exprs, self.ops_format = read_ops_file(self.file)
+        rebased = rebase(old_labels, self._labels, s_exprs)
+        with self._timer('hash'):
+            self._digest = EventDigest(self._labels, self.hash_algorithm,
+                                       self.event_encoding)
+        self.hash_pre = self._digest.flat_hash
+        self.hash_post = None
+        self.undo_stack = collections.deque()
+        self.redo_stack = collections.deque()
+        try:
+            with self._timer('replay'):
+                self._replay(rebased.ops)
+        except Exception:
+            self._digest = None
+            raise
+        self.undo_stack.extend(rebased.ops)
+        return rebased.conflicts
+    
+    @_timed('write_to_file')
+    def write_to_file(self, file=None, ops_format=None, squash=False,
+                      metadata_format=None):
+        """Write stack of corrections plus metadata to file, replacing each
+           file atomically.
+           
+           file -- if not present, use self.file
+           ops_format -- 'text' or 'binary'; if not present, use
+                         self.ops_format
+           metadata_format -- 'yaml' or 'json'; if not present, use
+                              self.metadata_format
+           squash -- bool; if True, write the undo stack as compacted by
+                     squash_ops, leaving the stack itself unchanged
+           
+           hash_post, the EventDigest hash of the labels (as from
+           current_hash()), is recorded in the metadata and set on the stack.
+           The stack is read through snapshot(), so on a thread-safe stack
+           other threads may go on editing while the files are written."""
+        with self.reading():
+            state = self.snapshot(labels=False)
+        ops = squash_ops(state.undo_ops) if squash else state.undo_ops
+        with self._saving:
+            if file:
+                self.file = file
+            ops_format = ops_format or self.ops_format
+            metadata_format = metadata_format or self.metadata_format
+            write_ops_file(self.file, ops, ops_format)
+            self.ops_format = ops_format
+            file_data = {'hash_pre': state.hash_pre,
+                         'hash_post': state.current_hash}
+            if self.event_encoding is not None:
+                file_data['hash_algorithm'] = self.hash_algorithm
+                file_data['event_encoding'] = self.event_encoding
+            write_metadata(self.file, file_data, metadata_format)
+            self.metadata_format = metadata_format
+            self.hash_post = state.current_hash
     
+    @_locked('write')
     def undo(self):
         """Undoes last executed command, if any.
            Raises an IndexError if the undo_stack is empty."""
-        inv = invert(self.undo_stack.pop())
-        self.redo_stack.append(inv)
-        self._apply(inv)
+        self._load()
+        self._check_no_transaction()
+        op = self.undo_stack[-1]
+        with self._timer('undo.' + op.kind):
+            inv = invert(op)
+            self._apply(inv)
+            self.undo_stack.pop()
+            self.redo_stack.append(inv)
+            if self.journal is not None:
+                self.journal.undo()
+        self._note_revision()
     
+    @_locked('write')
     def redo(self):
         """Redoes last undone command, if any.
            Raises an IndexError if the redo_stack is empty."""
-        inv = invert(self.redo_stack.pop())
-        self.undo_stack.append(inv)
-        self._apply(inv)
+        self._load()
+        self._check_no_transaction()
+        op = self.redo_stack[-1]
+        with self._timer('redo.' + op.kind):
+            inv = invert(op)
+            self._apply(inv)
+            self.redo_stack.pop()
+            self.undo_stack.append(inv)
+            if self.journal is not None:
+                self.journal.redo()
+        self._note_revision()
     
+    @_locked('write')
     def push(self, cmd):
-        """Executes command, discarding redo stack."""
-        self.redo_stack.clear()
-        self.undo_stack.append(cmd)
-        self._apply(cmd)
+        """Executes command, discarding redo stack.
+           
+           cmd -- an Op, or an operation s-expression
+           
+           The stacks are only changed once the command has been applied."""
+        cmd = compile_op(cmd)
+        self._load()
+        with self._timer('push.' + cmd.kind):
+            self._apply(cmd)
+            if self.redo_stack:
+                self.redo_stack.clear()
+                self._drop_checkpoints(len(self.undo_stack))
+            self.undo_stack.append(cmd)
+            if self.journal is not None:
+                self.journal.push(cmd)
+        self._note_revision()
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """Returns a context manager grouping the operations pushed in its
+           block into one, undone and redone as a unit.
+           
+           Operations are applied as they are pushed, so each sees the
+           labels as left by the last. On leaving the block, they are
+           replaced on the undo stack by a Group (the journal only records
+           the Group); if the block raises an exception, they are undone,
+           the redo stack is restored, and the exception propagates. A
+           transaction within a transaction joins it. Undo, redo, goto and
+           squash are not allowed within a transaction.
+           
+           On a thread-safe stack, the lock is held for writing throughout
+           the block, so other threads never see part of a transaction."""
+        self._load()
+        with self._locking('write'):
+            if self._transaction is not None:
+                yield
+            else:
+                with self._grouping():
+                    yield
+    
+    @contextlib.contextmanager
+    def _grouping(self):
+        """Context manager doing the work of an outermost transaction()."""
+        start = len(self.undo_stack)
+        redo_stack = collections.deque(self.redo_stack)
+        journal, self.journal = self.journal, None
+        self._transaction = start
+        try:
+            yield
+        except BaseException:
+            while len(self.undo_stack) > start:
+                self._apply(invert(self.undo_stack.pop()))
+            self.redo_stack = redo_stack
+            raise
+        else:
+            ops = [self.undo_stack.pop()
+                   for _ in range(len(self.undo_stack) - start)]
+            if ops:
+                ops.reverse()
+                op = ops[0] if len(ops) == 1 else Group(ops)
+                self.undo_stack.append(op)
+                if journal is not None:
+                    journal.push(op)
+        finally:
+            self._transaction = None
+            self.journal = journal
+            self._drop_checkpoints(start)
+            self._note_revision()
     
+    def _check_no_transaction(self):
+        if self._transaction is not None:
+            raise RuntimeError('not allowed within a transaction')
+    
+    @_locked('read', load=False)
     def peek(self, index=-1):
         """Returns command string at top of undo stack, or index."""
         return self.undo_stack[index]
     
+    @_locked('write')
+    def squash(self):
+        """Compacts the undo stack with squash_ops.
+           
+           The labels are unchanged, but undo steps through the compacted
+           operations."""
+        self._load()
+        self._check_no_transaction()
+        self.undo_stack = collections.deque(squash_ops(self.undo_stack))
+        self._drop_checkpoints(0) # later revisions are renumbered
+        if self.journal is not None: # journal must reproduce the new stack
+            self.start_journal(self.journal.fsync_every)
+        self._note_revision()
+    
+    @_locked('write', load=False)
+    def start_journal(self, fsync_every=1):
+        """Starts journaling operations to self.file + '.journal'.
+           
+           The journal is begun with records reproducing the current undo
+           and redo stacks, replacing any existing journal."""
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = Journal(self.file + '.journal', self.hash_pre,
+                               self.undo_stack, self.redo_stack, fsync_every,
+                               self.hash_algorithm, self.event_encoding)
+    
+    @_locked('write', load=False)
+    def close_journal(self):
+        """Stops journaling and deletes the journal.
+           
+           Call only once the operations have been saved by write_to_file."""
+        self.journal.close()
+        os.remove(self.journal.file)
+        self.journal = None
+    
+    @_locked('read')
+    def current_hash(self):
+        """Returns the EventDigest hash of the labels in their current state.
+           
+           The digest is kept up to date by each operation, so this costs
+           O(log n) per event changed since the last call. Labels modified
+           other than through the stack's operations are not reflected until
+           rehash() is called."""
+        self._load()
+        if self._digest is None:
+            with self._timer('hash'):
+                self._digest = EventDigest(self._labels)
+        return self._digest.hexdigest()
+    
+    @_locked('write')
+    @_timed('hash')
+    def rehash(self):
+        """Rebuilds the label digest from scratch, and discards the time
+           index and checkpoints, after labels are changed other than by the
+           stack's operations."""
+        self._digest = EventDigest(self.labels)
+        self._time_index = None
+        self._start_checkpoints()
+    
+    def _trackers(self):
+        """Returns the structures kept in sync with labels by _apply."""
+        return [t for t in (self._digest, self._time_index, self._frozen)
+                if t is not None]
+    
+    # lazy loading
+    
+    @property
+    def labels(self):
+        """The list of event dicts, with the undo stack applied."""
+        if self._pending is not None:
+            self._load()
+        return self._labels
+    
+    @labels.setter
+    def labels(self, labels):
+        """Replaces the labels, discarding the digest, time index and
+           checkpoints of the old ones; they are rebuilt as needed."""
+        self._labels = labels
+        self._digest = None
+        self._time_index = None
+        self._start_checkpoints()
+    
+    @property
+    def loaded(self):
+        """False while a lazy load's replay is still pending."""
+        return self._pending is None
+    
+    def _load(self):
+        """Completes a lazy load, if one is pending: checks the labels'
+           hash, and replays the loaded operations onto them."""
+        if self._pending is None:
+            return
+        with self._locking('write'):
+            if self._pending is not None: # unless another thread loaded it
+                self._replay_pending()
+    
+    def _replay_pending(self):
+        with self._timer('hash'):
+            self._digest = EventDigest(self._labels, self.hash_algorithm,
+                                       self.event_encoding)
+        if self.hash_pre != self._digest.flat_hash:
+            self._digest = None
+            raise ValueError('label file hash does not match op file hash_pre')
+        ops = list(self._pending)
+        try:
+            with self._timer('replay'):
+                self._replay(ops)
+            self._check_hash_post()
+        except Exception:
+            self._digest = None
+            raise
+        self._pending = None
+        self.undo_stack = collections.deque(ops)
+    
+    def _check_hash_post(self):
+        """Raises ValueError if the labels, after replaying a file, don't
+           match the hash_post it records."""
+        if (self.hash_post is not None and
+                self.hash_post != self._digest.hexdigest()):
+            raise ValueError('replayed labels do not match op file hash_post')
+    
+    # checkpoints
+    
+    @property
+    def revision(self):
+        """The number of operations applied: the length of the undo stack."""
+        return len(self.undo_stack)
+    
+    @_locked('write')
+    def goto(self, revision):
+        """Undoes or redoes operations until revision operations are applied.
+           
+           With checkpoints, this costs at most one restore of the labels and
+           the replay of fewer than checkpoint_interval operations; nearby
+           revisions are reached by undo and redo. Either way, the undo and
+           redo stacks end up as undo and redo would leave them.
+           
+           Raises an IndexError if revision is outside the stacks."""
+        self._load()
+        self._check_no_transaction()
+        current = len(self.undo_stack)
+        if not 0 <= revision <= current + len(self.redo_stack):
+            raise IndexError('revision out of range')
+        base = max([r for r in self._checkpoints if r <= revision] or [None])
+        if (base is None or
+                abs(revision - current) <= max(revision - base,
+                                               self.checkpoint_interval)):
+            while len(self.undo_stack) > revision:
+                self.undo()
+            while len(self.undo_stack) < revision:
+                self.redo()
+            return
+        with self._timer('goto'):
+            history = list(self.undo_stack)
+            history.extend(op.inverse() for op in reversed(self.redo_stack))
+            self._restore_checkpoint(base)
+            replay(self._labels, history[base:revision], self._trackers())
+            self.undo_stack = collections.deque(history[:revision])
+            self.redo_stack = collections.deque(
+                op.inverse() for op in reversed(history[revision:]))
+        self._note_revision()
+        if self.journal is not None: # journal must reproduce the new stacks
+            self.start_journal(self.journal.fsync_every)
+    
+    def _note_revision(self):
+        """Takes a checkpoint if the current revision is due one, and tells
+           the autosaver of the edit."""
+        if self._autosaver is not None:
+            self._autosaver.changed()
+        interval = self.checkpoint_interval
+        if interval and self._frozen is not None:
+            revision = len(self.undo_stack)
+            if revision % interval == 0 and revision not in self._checkpoints:
+                self._checkpoints[revision] = self._frozen.snapshot()
+    
+    def _start_checkpoints(self, revision=None):
+        """Discards any checkpoints, and checkpoints the labels as they are
+           at revision (by default, the current revision)."""
+        if self.checkpoint_interval:
+            if revision is None:
+                revision = len(self.undo_stack)
+            self._frozen = _FrozenEvents(self._labels)
+            self._checkpoints = {revision: self._frozen.snapshot()}
+    
+    def _restore_checkpoint(self, revision):
+        """Returns the labels to their state in a checkpoint.
+           
+           Only the events differing from the checkpoint's are replaced,
+           found by comparing blocks of the mirrored events, and the trackers
+           are updated as for operations replacing them."""
+        # in descending order, so each hunk's indices are unaffected by the
+        # others
+        hunks = self._frozen.restore(self._checkpoints[revision])
+        _replace_events(self._labels, hunks)
+        replacements = [(start, stop - start, events)
+                        for start, stop, events in hunks]
+        for tracker in (self._digest, self._time_index):
+            if tracker is not None:
+                tracker.replace_many(replacements)
+    
+    def _drop_checkpoints(self, after):
+        """Forgets the checkpoints of revisions after after."""
+        for revision in list(self._checkpoints):
+            if revision > after:
+                del self._checkpoints[revision]
+    
+    def _replay(self, ops):
+        """Replays ops onto labels at revision 0, checkpointing on the way."""
+        interval = self.checkpoint_interval
+        if not interval:
+            replay(self._labels, ops, self._trackers())
+            return
+        self._start_checkpoints(0)
+        for start in range(0, len(ops), interval):
+            chunk = ops[start:(start + interval)]
+            replay(self._labels, chunk, self._trackers())
+            if len(chunk) == interval:
+                self._checkpoints[start + interval] = self._frozen.snapshot()
+    
+    # time lookup
+    
+    def _times(self):
+        """Returns the TimeIndex of labels, building it if necessary."""
+        if self._time_index is None:
+            self._time_index = TimeIndex(self.labels)
+        return self._time_index
+    
+    @_locked('read')
+    def event_at(self, t):
+        """Returns the index of the first event with start <= t < stop, or
+           None if there is no such event."""
+        found = self._times().at(t)
+        return found[0] if found else None
+    
+    @_locked('read')
+    def events_in(self, t0, t1):
+        """Returns the indices of the events overlapping [t0, t1)."""
+        return self._times().overlapping(t0, t1)
+    
+    def _index_at(self, t):
+        """Returns event_at(t), raising ValueError if there is no event."""
+        index = self.event_at(t)
+        if index is None:
+            raise ValueError('no event at time ' + str(t))
+        return index
+    
     def _apply(self, s_expr):
         """Executes s-expression, applied to labels."""
-        evaluate(s_expr, make_env(labels=self.labels))
+        code = compile_op(s_expr)
+        with self._timer('apply.' + code.kind):
+            _apply_code(code, self.labels, self._trackers())
+    
+    # instrumentation
+    
+    def stats(self, reset=False):
+        """Returns a snapshot of the stack's instrumentation, or an empty dict
+           if it isn't instrumented.
+           
+           reset -- bool; if True, start counting again afterwards
+           
+           The snapshot maps each event name to a dict of its 'count' and
+           total 'seconds'. Events are push.KIND, undo.KIND and redo.KIND for
+           each kind of operation pushed, undone or redone; apply.KIND for
+           applying an operation to the labels; hash for building the label
+           digest; parse and replay for the parts of loading; goto for
+           restoring a checkpoint; and
+           read_from_file, read_from_journal and write_to_file."""
+        if self._stats is None:
+            return {}
+        snapshot = self._stats.snapshot()
+        if reset:
+            self._stats.reset()
+        return snapshot
+    
+    def _timer(self, name):
+        """Returns a context manager timing its block as name, if the stack
+           is instrumented."""
+        if self._stats is None:
+            return _NO_TIMER
+        return self._stats.timer(name)
+    
+    # thread safety
+    
+    def reading(self):
+        """Returns a context manager holding the stack's lock for reading,
+           so labels and the stacks can be used in its block without another
+           thread changing them. Editing in the block raises RuntimeError.
+           
+           Without thread_safe, the context manager does nothing."""
+        self._load()
+        return self._locking('read')
+    
+    def flush(self):
+        """Saves any edits not yet autosaved, waiting for a save already
+           under way to finish. Does nothing without autosave."""
+        self._check_no_transaction() # the save would wait on the lock
+        if self._autosaver is not None:
+            self._autosaver.flush()
+    
+    def close(self):
+        """Stops autosaving, after saving any edits not yet saved.
+           
+           Leaving the context manager does this before writing the
+           operations file."""
+        self._check_no_transaction()
+        if self._autosaver is not None:
+            self._autosaver.close()
+            self._autosaver = None
+    
+    def _locking(self, mode):
+        """Returns a context manager holding the lock for mode, if any."""
+        if self._lock is None:
+            return _NO_LOCK
+        return getattr(self._lock, mode)()
+    
+    @_locked('read')
+    def snapshot(self, labels=True):
+        """Returns a Snapshot of the stack, consistent as of one moment.
+           
+           labels -- bool; if False, leave out the copy of the labels
+           
+           The snapshot holds the revision, hash_pre, the EventDigest hash
+           (as from current_hash()), the undo and redo stacks (as tuples,
+           bottom first) and a copy of the labels as a list of dicts.
+           Operations are immutable, so copying the stacks costs a reference
+           per operation; once it is taken, the snapshot can be serialized
+           without holding the lock."""
+        events = None
+        if labels:
+            events = [_copy_event(e) for e in _event_list(self._labels)]
+        return Snapshot(len(self.undo_stack), self.hash_pre,
+                        self.current_hash(), tuple(self.undo_stack),
+                        tuple(self.redo_stack), events)
     
     # operations
     
+    @_locked('write')
     def rename(self, index, new_name):
         """Renames an event."""
         self.push(self.codegen_rename(index, new_name))
     
+    @_locked('write')
     def set_start(self, index, new_start):
         """Changes the start time of an event."""
         self.push(self.codegen_set_start(index, new_start))
     
+    @_locked('write')
     def set_stop(self, index, new_stop):
         """Changes the stop time of an event."""
         self.push(self.codegen_set_stop(index, new_stop))
     
+    @_locked('write')
     def merge_next(self, index):
         """Merges an event with its successor."""
         self.push(self.codegen_merge_next(index))
     
+    @_locked('write')
     def split(self, index, new_sep):
         """Splits an event in two."""
         self.push(self.codegen_split(index, new_sep))
     
+    @_locked('write')
     def delete(self, index):
         """Deletes an event."""
         self.push(self.codegen_delete(index))
     
+    @_locked('write')
     def create(self, index, start, stop, name, **kwargs):
         """Creates a new event."""
         self.push(self.codegen_create(index, start, stop, name, **kwargs))
     
+    # time-addressed operations
+    
+    @_locked('write')
+    def rename_at(self, t, new_name):
+        """Renames the event at time t."""
+        self.rename(self._index_at(t), new_name)
+    
+    @_locked('write')
+    def set_start_at(self, t, new_start):
+        """Changes the start time of the event at time t."""
+        self.set_start(self._index_at(t), new_start)
+    
+    @_locked('write')
+    def set_stop_at(self, t, new_stop):
+        """Changes the stop time of the event at time t."""
+        self.set_stop(self._index_at(t), new_stop)
+    
+    @_locked('write')
+    def split_at(self, t):
+        """Splits the event at time t in two, at t."""
+        self.split(self._index_at(t), t)
+    
+    @_locked('write')
+    def delete_at(self, t):
+        """Deletes the event at time t."""
+        self.delete(self._index_at(t))
+    
+    # bulk operations
+    
+    @_locked('read')
+    def select(self, predicate=None, name=None, min_duration=None,
+               max_duration=None, t0=None, t1=None, **columns):
+        """Returns the indices of the events meeting every given criterion.
+           
+           predicate -- callable; called with each event, true to select it
+           name -- the name of the events to select
+           min_duration, max_duration -- selects events with
+                                         min_duration <= stop - start and
+                                         stop - start < max_duration
+           t0, t1 -- selects events overlapping [t0, t1); either may be
+                     omitted
+           columns -- values of other columns of the events to select"""
+        labels = self.labels
+        if name is not None:
+            columns['name'] = name
+        tests = [_column_test(k, v) for k, v in columns.items()]
+        if min_duration is not None:
+            tests.append(lambda e: e['stop'] - e['start'] >= min_duration)
+        if max_duration is not None:
+            tests.append(lambda e: e['stop'] - e['start'] < max_duration)
+        if predicate is not None:
+            tests.append(predicate)
+        if len(tests) == 1:
+            test = tests[0]
+        else:
+            test = lambda e: all(t(e) for t in tests)
+        if t0 is not None or t1 is not None:
+            candidates = self.events_in(float('-inf') if t0 is None else t0,
+                                        float('inf') if t1 is None else t1)
+            return [i for i in candidates if test(labels[i])]
+        return [i for i, event in enumerate(labels) if test(event)]
+    
+    @_locked('write')
+    def rename_many(self, indices, new_name):
+        """Renames events, as one operation."""
+        self.push(self.codegen_rename_many(indices, new_name))
+    
+    @_locked('write')
+    def delete_many(self, indices):
+        """Deletes events, as one operation."""
+        self.push(self.codegen_delete_many(indices))
+    
+    @_locked('write')
+    def rename_where(self, new_name, **criteria):
+        """Renames the events selected by criteria (as for select), as one
+           operation, and returns the number renamed."""
+        indices = self.select(**criteria)
+        if indices:
+            self.rename_many(indices, new_name)
+        return len(indices)
+    
+    @_locked('write')
+    def delete_where(self, **criteria):
+        """Deletes the events selected by criteria (as for select), as one
+           operation, and returns the number deleted."""
+        indices = self.select(**criteria)
+        if indices:
+            self.delete_many(indices)
+        return len(indices)
+    
     # code generators
     
+    @_locked('read')
     def codegen_rename(self, index, new_name):
         """Generates s-expression to rename an event."""
         if '"' in new_name:
@@ -141,18 +920,21 @@ class EditStack:
         old_vals = set()
         return gen_code(self.labels, 'set_name', index, new_vals, old_vals)
     
+    @_locked('read')
     def codegen_set_start(self, index, new_start):
         """Generates s-expression to move an event's start."""
         new_vals = {'start': new_start}
         old_vals = set()
         return gen_code(self.labels, 'set_start', index, new_vals, old_vals)
     
+    @_locked('read')
     def codegen_set_stop(self, index, new_stop):
         """Generates s-expression to move an event's stop."""
         new_vals = {'stop': new_stop}
         old_vals = set()
         return gen_code(self.labels, 'set_stop', index, new_vals, old_vals)
     
+    @_locked('read')
     def codegen_merge_next(self, index):
         """Generates an s-expression to merge an event with its successor.
            The new event inherits all non-boundary column values from the
@@ -161,6 +943,7 @@ class EditStack:
         old_vals = set(self.labels[index].keys())
         return gen_code(self.labels, 'merge_next', index, new_vals, old_vals)
     
+    @_locked('read')
     def codegen_split(self, index, split_pt):
         """Generates an s-expression to split an event in two at a point.
            The child events inherit all non-boundary column values from the
@@ -169,23 +952,48 @@ class EditStack:
         old_vals = set(self.labels[index].keys())
         return gen_code(self.labels, 'split', index, new_vals, old_vals)
     
+    @_locked('read')
     def codegen_delete(self, index):
         """Generates an s-expression to delete an event."""
         new_vals = {}
         old_vals = set(self.labels[index].keys())
         return gen_code(self.labels, 'delete', index, new_vals, old_vals)
     
+    @_locked('read')
     def codegen_create(self, index, start, stop, name, **kwargs):
         """Generates an s-expression to create a new event with given values."""
         new_vals = {'start': start, 'stop': stop, 'name': name}
         new_vals.update(kwargs)
         old_vals = set(new_vals.keys())
-        # trick: make 'create' s-expr with new_vals, invert to 'delete' s-expr
-        # to inject them into #:target, remove the garbage new_values, then
-        # invert again to generate the proper 'create' s-expr
-        bad_create = gen_code(self.labels, 'create', index, new_vals, old_vals)
-        good_create = invert(invert(bad_create)[:3])
-        return good_create
+        return gen_code(self.labels, 'create', index, new_vals, old_vals)
+    
+    @_locked('read')
+    def codegen_rename_many(self, indices, new_name):
+        """Generates an operation renaming many events."""
+        if '"' in new_name:
+            raise ValueError('" character disallowed in event names')
+        indices = self._bulk_indices(indices)
+        labels = self.labels
+        return SetNameMany(indices, [labels[i]['name'] for i in indices],
+                           [new_name] * len(indices))
+    
+    @_locked('read')
+    def codegen_delete_many(self, indices):
+        """Generates an operation deleting many events."""
+        indices = self._bulk_indices(indices)
+        labels = self.labels
+        return DeleteMany(indices, [labels[i] for i in indices])
+    
+    def _bulk_indices(self, indices):
+        """Returns indices normalized, deduplicated and sorted, raising
+           IndexError if any is out of range."""
+        length = len(self.labels)
+        normalized = set()
+        for index in indices:
+            if not -length <= index < length:
+                raise IndexError('event index out of range')
+            normalized.add(index % length)
+        return sorted(normalized)
 
 # raw operations
 
@@ -204,7 +1012,7 @@ def _split(labels, target, **kwargs):
             kwargs['new_next_start'] < labels[target['index']]['stop']):
         raise ValueError('split point must be within interval')
     index = target['index']
-    labels.insert(index + 1, copy.deepcopy(labels[index]))
+    labels.insert(index + 1, _copy_event(labels[index]))
     labels[index]['stop'] = kwargs['new_stop']
     for k in target:
         if k[:5] == 'next_':
@@ -219,34 +1027,76 @@ def _create(labels, target):
     new_point = {'start': target['start'],
                  'stop': target['stop'],
                  'name': target['name']}
-    del target['index']
-    new_point.update(target)
+    new_point.update((k, v) for k, v in target.items() if k != 'index')
     labels.insert(idx, new_point)
 
+def _set_values(labels, target, column):
+    for item in target:
+        _set_value(labels, item, column,
+                   **{'new_' + column: item['new_' + column]})
+
+def _delete_many(labels, target):
+    for item in reversed(target): # indices are before any deletion
+        _delete(labels, item)
+
+def _create_many(labels, target):
+    for item in target: # indices are after every creation
+        _create(labels, item)
+
+def _column_test(column, value):
+    """Returns a function testing whether an event has a column value."""
+    missing = object()
+    return lambda event: event.get(column, missing) == value
+
+def _intervals(items):
+    """Returns the values of (position, value) items, ordered by position."""
+    return [v for _, v in sorted(items, key=lambda item: int(item[0]))]
+
+try:
+    _text_types = (str, unicode)
+except NameError: # python 2/3 support
+    _text_types = (str,)
+
+_IMMUTABLE_TYPES = frozenset((type(None), bool, int, float) + _text_types)
+
+def _copy_value(value):
+    """Returns a copy of a column value; immutable values aren't copied."""
+    if type(value) in _IMMUTABLE_TYPES:
+        return value
+    if value is None or isinstance(value, (numbers.Number,) + _text_types):
+        return value
+    import copy
+    return copy.deepcopy(value)
+
+def _copy_event(event):
+    """Returns a copy of an event as a dict."""
+    return {k: _copy_value(v) for k, v in event.items()}
+
 # code generation
 
 def gen_code(labels, op, idx, new_vals, old_vals):
-    """Generates an s-expression for the given op.
+    """Generates the Op for the given operation.
        
        labels -- list of dicts representing events
        op -- string
        idx -- integer
        new_vals -- dict; keys must be valid column names
        old_vals -- list of strings; must be valid column names"""
-    sxpr = [Symbol(op), KeyArg('target'), [Symbol('interval')]]
-    sxpr[-1].extend([KeyArg('index'), idx])
+    cls = OP_CLASSES[op]
+    if op == 'create':
+        return cls(idx, dict(new_vals))
     query_keys = (old_vals | set(new_vals.keys())) - set(['next_start'])
-    for c in query_keys:
-        sxpr[-1].extend([KeyArg(c), labels[idx][c]])
-    if op == 'merge_next': # include second event's data to allow inversion
-        for c in query_keys:
-            sxpr[-1].extend([KeyArg('next_' + c), labels[idx + 1][c]])
+    event = {c: labels[idx][c] for c in query_keys}
+    if issubclass(cls, SetValue):
+        return cls(idx, event[cls.column], new_vals[cls.column])
+    elif op == 'merge_next': # include second event's data to allow inversion
+        next_event = {c: labels[idx + 1][c] for c in query_keys}
+        return cls(idx, event, next_event, new_vals['stop'],
+                   new_vals['next_start'])
     elif op == 'split': # second child event's data is copied from first
-        for c in query_keys:
-            sxpr[-1].extend([KeyArg('next_' + c), labels[idx][c]])
-    for c in new_vals:
-        sxpr.extend([KeyArg('new_' + c), new_vals[c]])
-    return sxpr
+        return cls(idx, event, dict(event), new_vals['stop'],
+                   new_vals['next_start'])
+    return cls(idx, event)
 
 
 # invert operations
@@ -257,22 +1107,31 @@ INVERSE_TABLE = {'set_name': 'set_name',
                  'merge_next': 'split',
                  'split': 'merge_next',
                  'delete': 'create',
-                 'create': 'delete'}
+                 'create': 'delete',
+                 'set_name_many': 'set_name_many',
+                 'delete_many': 'create_many',
+                 'create_many': 'delete_many'}
 
 def invert(s_expr):
-    """Generates an s-expression for the inverse of s_expr."""
-    op = s_expr[0]
-    inverse = INVERSE_TABLE[op]
-    target = s_expr[s_expr.index('target') + 1]
-    for i in range(len(s_expr)):
-        curr = s_expr[i]
-        if isinstance(curr, KeyArg) and len(curr) >= 4 and curr[:4] == 'new_':
-            oldname = curr[4:]
-            oldval = copy.deepcopy(target[target.index(oldname) + 1])
-            target[target.index(oldname) + 1] = copy.deepcopy(s_expr[i + 1])
-            s_expr[i + 1] = oldval
-    inverse_s_expr = [Symbol(inverse)]
+    """Generates an s-expression for the inverse of s_expr, leaving s_expr
+       unchanged.
+       
+       If s_expr is an Op, returns the inverse Op, which is computed once and
+       cached."""
+    if isinstance(s_expr, Op):
+        return s_expr.inverse()
+    if s_expr[0] in BULK_OPS or s_expr[0] == Group.kind:
+        return compile_op(s_expr).inverse().to_sexpr()
+    inverse_s_expr = SExpr([Symbol(INVERSE_TABLE[s_expr[0]])])
     inverse_s_expr.extend(s_expr[1:])
+    pos = inverse_s_expr.index('target') + 1
+    target = inverse_s_expr[pos] = list(inverse_s_expr[pos])
+    for i in range(1, len(inverse_s_expr)):
+        curr = inverse_s_expr[i]
+        if isinstance(curr, KeyArg) and curr[:4] == 'new_':
+            j = target.index(curr[4:]) + 1
+            target[j], inverse_s_expr[i + 1] = (
+                _copy_value(inverse_s_expr[i + 1]), _copy_value(target[j]))
     return inverse_s_expr
 
 # reverse parsing
@@ -288,9 +1147,11 @@ def detokenize(token_list):
 
 def write_to_tokens(ntl):
     """Turns an s-expression into a flat token list."""
+    if isinstance(ntl, Op):
+        ntl = ntl.to_sexpr()
     token_list = ['(']
     for t in ntl:
-        if isinstance(t, list):
+        if isinstance(t, (list, Op)):
             token_list.extend(write_to_tokens(t))
         else:
             token_list.append(deatomize(t))
@@ -323,42 +1184,30 @@ class Symbol(str): pass
 
 class KeyArg(Symbol): pass
 
+class SExpr(list):
+    """A top-level s-expression, which caches its compiled form in code."""
+    __slots__ = ('code',)
+
+_TOKEN = re.compile(r'''\s*(?:([()])|               # parenthesis
+                            ("[^"]*")(?![^\s)])|    # string
+                            ([^\s()"]+)(?![^\s()])| # other atom
+                            (\S))                   # misplaced "
+                      ''', re.VERBOSE)
+
+def _bad_token(text):
+    """Raises the error for a misplaced " character in text."""
+    if text.count('"') % 2:
+        raise SyntaxError('unterminated string in command: ' + text)
+    raise ValueError('unexpected " character in command: ' + text)
+
 def tokenize(cmd):
     """Turns a command string into a flat token list."""
-    second_pass = []
-    in_string = False
-    for token in cmd.split(' '):
-        if len(token) > 0 and token[0] == '"' and not in_string: # open quote
-            second_pass.append(token)
-            if token.count('"') != 2:
-                in_string = True
-        elif '"' in token and in_string: # close quote
-            if all(c == ')' for c in token[(token.index('"') + 1):]):
-                second_pass[-1] += ' ' + token
-                in_string = False
-            else:
-                raise ValueError('unexpected " character in command: ' + cmd)
-        elif '"' not in token and in_string: # middle words in quote
-            second_pass[-1] += ' ' + token
-        elif '"' in token:
-            raise ValueError('unexpected " character in command: ' + cmd)
-        else:
-            second_pass.append(token)
-    third_pass = []
-    for token in second_pass:
-        if token[0] == '(':
-            third_pass.append('(')
-            if len(token) > 1:
-                third_pass.append(token[1:])
-        elif token[-1] == ')':
-            pps = []
-            while token[-1] == ')':
-                pps.append(')')
-                token = token[:-1]
-            third_pass.extend([token] + pps)
-        else:
-            third_pass.append(token)
-    return third_pass
+    tokens = []
+    for paren, string, atom, bad in _TOKEN.findall(cmd):
+        if bad:
+            _bad_token(cmd)
+        tokens.append(paren or string or atom)
+    return tokens
 
 
 def atomize(token):
@@ -382,26 +1231,130 @@ def atomize(token):
             return Symbol(token)
 
 
+_ATOM_CACHE = {}
+
+_INT_TOKEN = re.compile(r'-?[0-9]+\Z')
+
+def _atomize_cached(token):
+    """Turns a non-string token into an atom, caching symbols."""
+    try:
+        return _ATOM_CACHE[token]
+    except KeyError:
+        pass
+    if _INT_TOKEN.match(token):
+        return int(token)
+    if '.' in token or 'e' in token or 'E' in token: # never an int
+        try:
+            return float(token)
+        except ValueError:
+            pass
+    atom = atomize(token)
+    if not isinstance(atom, numbers.Number):
+        _ATOM_CACHE[token] = atom
+    return atom
+
+if hasattr(str, 'decode'): # python 2/3 support
+    def _unquote(token):
+        return token[1:-1].decode('string_escape')
+else:
+    def _unquote(token):
+        return token[1:-1]
+
+
 def read_from_tokens(token_list):
-    """Turns a flat token list into an s-expression."""
-    if len(token_list) == 0:
-        raise SyntaxError('unexpected EOF')
-    token = token_list.pop(0)
-    if token == '(':
-        nested_list = []
-        while token_list[0] != ')':
-            nested_list.append(read_from_tokens(token_list))
-        token_list.pop(0)
-        return nested_list
-    elif token == ')':
-        raise SyntaxError('unexpected )')
-    else:
-        return atomize(token)
+    """Turns a flat token list into an s-expression.
+    
+       Consumes the tokens making up the s-expression from token_list."""
+    stack = []
+    for pos, token in enumerate(token_list):
+        if token == '(':
+            stack.append([])
+            continue
+        elif token == ')':
+            if not stack:
+                raise SyntaxError('unexpected )')
+            expr = stack.pop()
+        else:
+            expr = atomize(token)
+        if stack:
+            stack[-1].append(expr)
+        else:
+            del token_list[:pos + 1]
+            return expr
+    raise SyntaxError('unexpected EOF')
+
+
+def _read_forms(text, stack, out, limit=None):
+    """Reads complete top-level s-expressions from text into out.
+    
+       text -- string to read from; must not end inside a token
+       stack -- list of partially-read lists, carried between calls
+       out -- list to which complete s-expressions are appended
+       limit -- int; if present, stop after this many s-expressions"""
+    for paren, string, atom, bad in _TOKEN.findall(text):
+        if paren == '(':
+            stack.append([])
+            continue
+        elif paren:
+            if not stack:
+                raise SyntaxError('unexpected )')
+            expr = stack.pop()
+        elif string:
+            expr = _unquote(string)
+        elif atom:
+            expr = _atomize_cached(atom)
+        else:
+            _bad_token(text)
+        if stack:
+            stack[-1].append(expr)
+        else:
+            out.append(SExpr(expr) if isinstance(expr, list) else expr)
+            if limit is not None and len(out) >= limit:
+                return
+
+
+def _token_boundary(text):
+    """Returns the last position in text which cannot be inside a token."""
+    pos = len(text)
+    while pos > 0:
+        pos = max(text.rfind(c, 0, pos) for c in ' \t\r\n')
+        if pos <= 0 or text.count('"', 0, pos) % 2 == 0:
+            break
+        pos = text.rfind('"', 0, pos) # back up past an unterminated string
+    return max(pos, 0)
 
 
 def parse(cmd):
     """Turns a command string into an s-expression."""
-    return read_from_tokens(tokenize(cmd))
+    out = []
+    _read_forms(cmd, [], out, limit=1)
+    if not out:
+        raise SyntaxError('unexpected EOF')
+    return out[0]
+
+
+def iter_parse(fp, chunk_size=65536):
+    """Yields the s-expressions in an open file or buffer, one at a time.
+    
+       fp -- file-like object with a read() method returning strings
+       chunk_size -- number of characters to read at a time
+       
+       Raises SyntaxError if the input ends inside an s-expression."""
+    stack = []
+    buf = ''
+    eof = False
+    while not eof:
+        chunk = fp.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+        cut = len(buf) if eof else _token_boundary(buf)
+        out = []
+        _read_forms(buf[:cut], stack, out)
+        buf = buf[cut:]
+        for s_expr in out:
+            yield s_expr
+    if stack:
+        raise SyntaxError('unexpected EOF')
 
 
 def make_env(labels=None, **kwargs):
@@ -413,8 +1366,14 @@ def make_env(labels=None, **kwargs):
            'split': ft.partial(_split, labels=labels),
            'delete': ft.partial(_delete, labels=labels),
            'create': ft.partial(_create, labels=labels),
+           'set_name_many': ft.partial(_set_values, labels=labels,
+                                       column='name'),
+           'delete_many': ft.partial(_delete_many, labels=labels),
+           'create_many': ft.partial(_create_many, labels=labels),
            'interval': dict,
-           'interval_pair': dict}
+           'interval_pair': dict,
+           'intervals': lambda **items: _intervals(items.items()),
+           'begin': lambda **_: None} # operations are applied as arguments
     env['labels'] = labels
     env.update(kwargs)
     return env
@@ -432,19 +1391,2792 @@ def evaluate(expr, env=make_env()):
         return proc(**kwargs)
 
 
-def _grouper(iterable, n):
-    """Returns nonoverlapping windows of input of length n.
+# operation objects
+
+class Op(object):
+    """An operation, held in a fixed field layout rather than as a list.
     
-       Copied from itertools recipe suggestions."""
-    args = [iter(iterable)] * n
-    try:
-        return itertools.izip_longest(*args)
-    except AttributeError: # python 2/3 support
-        return itertools.zip_longest(*args)
+       Subclasses define the fields of each kind of operation. Ops convert to
+       list s-expressions with to_sexpr(), and from them with compile_op(),
+       and compare equal to the s-expressions they convert to.
+       
+       Ops are not modified once made, so an Op and its inverse may share
+       field values, and the inverse is cached."""
+    __slots__ = ('_inverse',)
+    kind = None
+    fields = ()
+    removed = inserted = 1 # events replaced by the operation
+    
+    def apply(self, labels):
+        """Applies the operation to labels."""
+        raise NotImplementedError
+    
+    def inverse(self):
+        """Returns the operation undoing this one.
+           
+           The inverse is computed once, and its own inverse is this Op."""
+        if self._inverse is None:
+            self._inverse = self._invert()
+            self._inverse._inverse = self
+        return self._inverse
+    
+    def _invert(self):
+        raise NotImplementedError
+    
+    def to_sexpr(self):
+        """Returns the operation as a list s-expression."""
+        raise NotImplementedError
+    
+    def footprint(self, length):
+        """Returns (index, removed, inserted) for the events this operation
+           replaces, when applied to labels of the given length."""
+        index = self.index
+        if index < 0:
+            index += length
+        if not self.removed: # insertion clamps its index, like list.insert
+            index = min(max(index, 0), length)
+        return index, self.removed, self.inserted
+    
+    def footprints(self, length):
+        """Returns a list of footprints, as from footprint(), in an order in
+           which the replacements can be made one after another."""
+        return [self.footprint(length)]
+    
+    def _values(self):
+        return tuple(getattr(self, f) for f in self.fields)
+    
+    def __eq__(self, other):
+        if isinstance(other, list):
+            try:
+                other = compile_op(other)
+            except ValueError:
+                return False
+        if not isinstance(other, Op):
+            return NotImplemented
+        return type(self) is type(other) and self._values() == other._values()
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return deparse(self)
 
-def event_hash(events):
-    """Returns SHA-1 hash of given event list (assumed to be list of dicts)."""
-    eh = hashlib.sha1()
-    for e in events:
-        eh.update(repr(sorted(e.items())).encode())
-    return eh.hexdigest()
+
+def _target(index, columns):
+    """Returns an interval s-expression for an index and column values."""
+    target = [Symbol('interval'), KeyArg('index'), index]
+    for k, v in columns:
+        target.extend([KeyArg(k), v])
+    return target
+
+def _targets(targets):
+    """Returns an intervals s-expression listing interval s-expressions."""
+    expr = [Symbol('intervals')]
+    for position, target in enumerate(targets):
+        expr.extend([KeyArg(str(position)), target])
+    return expr
+
+
+class SetValue(Op):
+    """Sets one column of an event."""
+    __slots__ = ('index', 'old', 'new')
+    fields = __slots__
+    column = None
+    
+    def __init__(self, index, old, new):
+        self.index = index
+        self.old = old
+        self.new = new
+        self._inverse = None
+    
+    def apply(self, labels):
+        event = labels[self.index]
+        event[self.column] # raise KeyError if column not present
+        event[self.column] = self.new
+    
+    def _invert(self):
+        return type(self)(self.index, self.new, self.old)
+    
+    def to_sexpr(self):
+        return SExpr([Symbol(self.kind), KeyArg('target'),
+                      _target(self.index, [(self.column, self.old)]),
+                      KeyArg('new_' + self.column), self.new])
+    
+    @classmethod
+    def from_args(cls, target, kwargs):
+        op = cls(target.pop('index'), target.pop(cls.column),
+                 kwargs.pop('new_' + cls.column))
+        if target or kwargs:
+            raise KeyError(next(iter(target or kwargs)))
+        return op
+
+class SetName(SetValue):
+    __slots__ = ()
+    kind = 'set_name'
+    column = 'name'
+
+class SetStart(SetValue):
+    __slots__ = ()
+    kind = 'set_start'
+    column = 'start'
+
+class SetStop(SetValue):
+    __slots__ = ()
+    kind = 'set_stop'
+    column = 'stop'
+
+
+_COLUMNS = {}
+
+def _columns(event):
+    """Returns the sorted column names of an event, and their values.
+       
+       The tuple of names is shared by every operation with the same
+       columns."""
+    columns = tuple(sorted(event))
+    columns = _COLUMNS.setdefault(columns, columns)
+    return columns, tuple(event[c] for c in columns)
+
+def _replaced(values, i, value):
+    """Returns a tuple of values with the value at i replaced."""
+    return values[:i] + (value,) + values[(i + 1):]
+
+
+class PairOp(Op):
+    """Merges an event with its successor, or splits an event in two.
+       
+       event and next_event hold the column values of the two events before
+       a merge; a split copies them into the two children. new_stop and
+       new_next_start are the boundary between the two events after the
+       operation."""
+    __slots__ = ('index', 'columns', 'values', 'next_columns', 'next_values',
+                 'new_stop', 'new_next_start')
+    fields = __slots__
+    
+    def __init__(self, index, event, next_event, new_stop, new_next_start):
+        columns, values = _columns(event)
+        next_columns, next_values = _columns(next_event)
+        self._set(index, columns, values, next_columns, next_values,
+                  new_stop, new_next_start)
+    
+    def _set(self, index, columns, values, next_columns, next_values,
+             new_stop, new_next_start):
+        self.index = index
+        self.columns = columns
+        self.values = values
+        self.next_columns = next_columns
+        self.next_values = next_values
+        self.new_stop = new_stop
+        self.new_next_start = new_next_start
+        self._inverse = None
+    
+    @property
+    def event(self):
+        return dict(zip(self.columns, self.values))
+    
+    @property
+    def next_event(self):
+        return dict(zip(self.next_columns, self.next_values))
+    
+    def _invert(self):
+        # swap the boundary values in the targets with the new values
+        stop = self.columns.index('stop')
+        start = self.next_columns.index('start')
+        inverse = object.__new__(OP_CLASSES[INVERSE_TABLE[self.kind]])
+        inverse._set(self.index,
+                     self.columns,
+                     _replaced(self.values, stop, self.new_stop),
+                     self.next_columns,
+                     _replaced(self.next_values, start, self.new_next_start),
+                     self.values[stop],
+                     self.next_values[start])
+        return inverse
+    
+    def to_sexpr(self):
+        target = _target(self.index, zip(self.columns, self.values))
+        for k, v in zip(self.next_columns, self.next_values):
+            target.extend([KeyArg('next_' + k), v])
+        return SExpr([Symbol(self.kind), KeyArg('target'), target,
+                      KeyArg('new_stop'), self.new_stop,
+                      KeyArg('new_next_start'), self.new_next_start])
+    
+    @classmethod
+    def from_args(cls, target, kwargs):
+        index = target.pop('index')
+        event = {}
+        next_event = {}
+        for k, v in target.items():
+            if k[:5] == 'next_':
+                next_event[k[5:]] = v
+            else:
+                event[k] = v
+        op = cls(index, event, next_event, kwargs.pop('new_stop'),
+                 kwargs.pop('new_next_start'))
+        if kwargs:
+            raise KeyError(next(iter(kwargs)))
+        return op
+
+class MergeNext(PairOp):
+    __slots__ = ()
+    kind = 'merge_next'
+    removed = 2
+    
+    def apply(self, labels):
+        index = self.index
+        labels[index]['stop'] = labels[index + 1]['stop']
+        labels.pop(index + 1)
+
+class Split(PairOp):
+    __slots__ = ()
+    kind = 'split'
+    inserted = 2
+    
+    def apply(self, labels):
+        index = self.index
+        event = labels[index]
+        if not (self.new_stop > event['start'] and
+                self.new_next_start < event['stop']):
+            raise ValueError('split point must be within interval')
+        labels.insert(index + 1, _copy_event(event))
+        labels[index]['stop'] = self.new_stop
+        next_event = labels[index + 1]
+        for k, v in zip(self.next_columns, self.next_values):
+            next_event[k] = _copy_value(v)
+        next_event['start'] = self.new_next_start
+
+
+class EventOp(Op):
+    """Deletes or creates an event, whose column values are held in event."""
+    __slots__ = ('index', 'columns', 'values')
+    fields = __slots__
+    
+    def __init__(self, index, event):
+        self.index = index
+        self.columns, self.values = _columns(event)
+        self._inverse = None
+    
+    @property
+    def event(self):
+        return dict(zip(self.columns, self.values))
+    
+    def _invert(self):
+        inverse = object.__new__(OP_CLASSES[INVERSE_TABLE[self.kind]])
+        inverse.index = self.index
+        inverse.columns = self.columns
+        inverse.values = self.values
+        inverse._inverse = None
+        return inverse
+    
+    def to_sexpr(self):
+        return SExpr([Symbol(self.kind), KeyArg('target'),
+                      _target(self.index, zip(self.columns, self.values))])
+    
+    @classmethod
+    def from_args(cls, target, kwargs):
+        if kwargs:
+            raise KeyError(next(iter(kwargs)))
+        return cls(target.pop('index'), target)
+
+class Delete(EventOp):
+    __slots__ = ()
+    kind = 'delete'
+    inserted = 0
+    
+    def apply(self, labels):
+        labels.pop(self.index)
+
+class Create(EventOp):
+    __slots__ = ()
+    kind = 'create'
+    removed = 0
+    
+    def apply(self, labels):
+        labels.insert(self.index, _new_event(self.event))
+
+def _new_event(event):
+    """Returns a copy of an event to be created, with its boundaries and
+       name first."""
+    new_point = {'start': event['start'],
+                 'stop': event['stop'],
+                 'name': event['name']}
+    new_point.update(_copy_event(event))
+    return new_point
+
+
+class SetValues(Op):
+    """Sets one column of many events, as one operation."""
+    __slots__ = ('indices', 'old', 'new')
+    fields = __slots__
+    column = None
+    
+    def __init__(self, indices, old, new):
+        self.indices = tuple(indices)
+        self.old = tuple(old)
+        self.new = tuple(new)
+        self._inverse = None
+    
+    def apply(self, labels):
+        column = self.column
+        events = [labels[index] for index in self.indices]
+        for event in events:
+            event[column] # raise KeyError if column not present
+        for event, new in zip(events, self.new):
+            event[column] = new
+    
+    def footprints(self, length):
+        return [(index, 1, 1) for index in self.indices]
+    
+    def _invert(self):
+        return type(self)(self.indices, self.new, self.old)
+    
+    def to_sexpr(self):
+        column = self.column
+        return SExpr([Symbol(self.kind), KeyArg('target'), _targets(
+            _target(index, [(column, old), ('new_' + column, new)])
+            for index, old, new in zip(self.indices, self.old, self.new))])
+    
+    @classmethod
+    def from_args(cls, target, kwargs):
+        if not isinstance(target, list):
+            raise TypeError('bulk operation target must be intervals')
+        if kwargs:
+            raise KeyError(next(iter(kwargs)))
+        indices, old, new = [], [], []
+        for item in target:
+            indices.append(item.pop('index'))
+            old.append(item.pop(cls.column))
+            new.append(item.pop('new_' + cls.column))
+            if item:
+                raise KeyError(next(iter(item)))
+        return cls(indices, old, new)
+
+class SetNameMany(SetValues):
+    __slots__ = ()
+    kind = 'set_name_many'
+    column = 'name'
+
+
+class EventsOp(Op):
+    """Deletes or creates many events, as one operation.
+       
+       indices are in ascending order: for a deletion, the positions of the
+       events before any is deleted, and for a creation, their positions
+       once all are created."""
+    __slots__ = ('indices', 'columns', 'values')
+    fields = __slots__
+    
+    def __init__(self, indices, events):
+        self.indices = tuple(indices)
+        if any(a >= b for a, b in zip(self.indices, self.indices[1:])):
+            raise ValueError('bulk operation indices must be ascending')
+        pairs = [_columns(event) for event in events]
+        self.columns = tuple(columns for columns, _ in pairs)
+        self.values = tuple(values for _, values in pairs)
+        self._inverse = None
+    
+    @property
+    def events(self):
+        return [dict(zip(c, v)) for c, v in zip(self.columns, self.values)]
+    
+    def _invert(self):
+        inverse = object.__new__(OP_CLASSES[INVERSE_TABLE[self.kind]])
+        inverse.indices = self.indices
+        inverse.columns = self.columns
+        inverse.values = self.values
+        inverse._inverse = None
+        return inverse
+    
+    def to_sexpr(self):
+        return SExpr([Symbol(self.kind), KeyArg('target'), _targets(
+            _target(index, zip(columns, values))
+            for index, columns, values in zip(self.indices, self.columns,
+                                              self.values))])
+    
+    @classmethod
+    def from_args(cls, target, kwargs):
+        if not isinstance(target, list):
+            raise TypeError('bulk operation target must be intervals')
+        if kwargs:
+            raise KeyError(next(iter(kwargs)))
+        return cls([item.pop('index') for item in target], target)
+
+class DeleteMany(EventsOp):
+    __slots__ = ()
+    kind = 'delete_many'
+    
+    def apply(self, labels):
+        indices = self.indices
+        if indices and not 0 <= indices[0] <= indices[-1] < len(labels):
+            raise IndexError('delete index out of range')
+        if not isinstance(labels, list):
+            for index in reversed(indices):
+                labels.pop(index)
+            return
+        kept = []
+        prev = 0
+        for index in indices:
+            kept.extend(labels[prev:index])
+            prev = index + 1
+        kept.extend(labels[prev:])
+        labels[:] = kept
+    
+    def footprints(self, length):
+        return [(index, 1, 0) for index in reversed(self.indices)]
+
+class CreateMany(EventsOp):
+    __slots__ = ()
+    kind = 'create_many'
+    
+    def apply(self, labels):
+        indices = self.indices
+        if indices and not (0 <= indices[0] and
+                            indices[-1] < len(labels) + len(indices)):
+            raise IndexError('create index out of range')
+        events = [_new_event(event) for event in self.events]
+        if not isinstance(labels, list):
+            for index, event in zip(indices, events):
+                labels.insert(index, event)
+            return
+        merged = []
+        prev = 0
+        for created, (index, event) in enumerate(zip(indices, events)):
+            merged.extend(labels[prev:(index - created)])
+            prev = index - created
+            merged.append(event)
+        merged.extend(labels[prev:])
+        labels[:] = merged
+    
+    def footprints(self, length):
+        return [(index, 0, 1) for index in self.indices]
+
+
+class Group(Op):
+    """A sequence of operations, applied, undone and redone as one.
+       
+       If one of the operations fails, those already applied are undone
+       before the exception propagates."""
+    __slots__ = ('ops',)
+    fields = __slots__
+    kind = 'begin'
+    
+    def __init__(self, ops):
+        self.ops = tuple(compile_op(op) for op in ops)
+        self._inverse = None
+    
+    def apply(self, labels, trackers=()):
+        done = []
+        try:
+            for op in self.ops:
+                _apply_code(op, labels, trackers)
+                done.append(op)
+        except Exception:
+            for op in reversed(done):
+                _apply_code(op.inverse(), labels, trackers)
+            raise
+    
+    def _invert(self):
+        return Group([op.inverse() for op in reversed(self.ops)])
+    
+    def to_sexpr(self):
+        s_expr = SExpr([Symbol(self.kind)])
+        for position, op in enumerate(self.ops):
+            s_expr.extend([KeyArg(str(position)), op.to_sexpr()])
+        return s_expr
+    
+    @classmethod
+    def from_sexpr(cls, s_expr):
+        return cls(_intervals(_grouper(s_expr[1:], 2)))
+
+
+OP_CLASSES = {cls.kind: cls for cls in (SetName, SetStart, SetStop, MergeNext,
+                                        Split, Delete, Create, SetNameMany,
+                                        DeleteMany, CreateMany, Group)}
+
+BULK_OPS = frozenset(['set_name_many', 'delete_many', 'create_many'])
+
+ARG_TABLE = {'interval': dict,
+             'interval_pair': dict,
+             'intervals': _intervals}
+
+def _apply_code(code, labels, trackers=()):
+    """Applies an Op to labels, and replays the change on trackers.
+    
+       trackers -- objects with a replace(index, removed, events) method,
+                   and optionally a replace_many(replacements) method taking
+                   a list of such arguments, used for bulk operations, and a
+                   prepare(index, removed) method, called with each
+                   footprint before the events are changed"""
+    if not trackers:
+        return code.apply(labels)
+    if isinstance(code, Group): # trackers follow each operation in turn
+        return code.apply(labels, trackers)
+    footprints = code.footprints(len(labels))
+    for tracker in trackers:
+        prepare = getattr(tracker, 'prepare', None)
+        if prepare is not None:
+            for index, removed, _ in footprints:
+                prepare(index, removed)
+    result = code.apply(labels)
+    replacements = [(index, removed,
+                     [labels[i] for i in range(index, index + inserted)])
+                    for index, removed, inserted in footprints]
+    for tracker in trackers:
+        if len(replacements) > 1 and hasattr(tracker, 'replace_many'):
+            tracker.replace_many(replacements)
+        else:
+            for replacement in replacements:
+                tracker.replace(*replacement)
+    return result
+
+def compile_op(s_expr):
+    """Converts an operation s-expression into an Op.
+    
+       Applying the Op is equivalent to evaluate(s_expr,
+       make_env(labels=labels)). The result is cached on s_expr if it is an
+       SExpr; an Op is returned unchanged.
+       
+       Raises ValueError if s_expr is not an operation in the layout
+       generated by gen_code."""
+    if isinstance(s_expr, Op):
+        return s_expr
+    code = getattr(s_expr, 'code', None)
+    if code is None:
+        try:
+            cls = OP_CLASSES[s_expr[0]]
+            if cls is Group:
+                return Group.from_sexpr(s_expr)
+            kwargs = {key: _compile_arg(val)
+                      for key, val in _grouper(s_expr[1:], 2)}
+            target = kwargs.pop('target')
+            if isinstance(target, list):
+                target = [dict(item) for item in target]
+            else:
+                target = dict(target)
+            code = cls.from_args(target, kwargs)
+        except (KeyError, TypeError):
+            raise ValueError('unsupported operation: ' + str(s_expr))
+        if isinstance(s_expr, SExpr):
+            s_expr.code = code
+    return code
+
+def _compile_arg(expr):
+    """Resolves an operation argument to its value."""
+    if isinstance(expr, list):
+        return ARG_TABLE[expr[0]]((k, _compile_arg(v))
+                                  for k, v in _grouper(expr[1:], 2))
+    elif isinstance(expr, Symbol):
+        raise ValueError('cannot compile free symbol: ' + expr)
+    return expr
+
+
+def _grouper(iterable, n):
+    """Returns nonoverlapping windows of input of length n.
+    
+       Copied from itertools recipe suggestions."""
+    args = [iter(iterable)] * n
+    try:
+        return itertools.izip_longest(*args)
+    except AttributeError: # python 2/3 support
+        return itertools.zip_longest(*args)
+
+# batch replay
+
+STRUCTURAL_OPS = frozenset(['merge_next', 'split', 'delete', 'create',
+                            'delete_many', 'create_many', 'begin'])
+
+def replay(labels, ops, trackers=()):
+    """Applies a sequence of operations to labels.
+    
+       labels -- list of dicts denoting event data; modified in place
+       ops -- iterable of operation s-expressions
+       trackers -- objects kept in sync with labels, as in _apply_code
+       
+       Equivalent to evaluating each operation in turn, but the list is only
+       rebuilt once: while replaying, labels are held in blocks, so each index
+       shift from a structural operation costs O(log n) instead of O(n). If an
+       operation raises an exception, labels are left as they were after the
+       previous operation."""
+    codes = [compile_op(op) for op in ops]
+    if not any(code.kind in STRUCTURAL_OPS for code in codes):
+        for code in codes:
+            _apply_code(code, labels, trackers)
+        return
+    seq = _BlockList(_event_list(labels))
+    try:
+        for code in codes:
+            _apply_code(code, seq, trackers)
+    finally:
+        labels[:] = seq
+
+
+def _event_list(labels):
+    """Returns labels as a list of event dicts, for tables with to_dicts()."""
+    to_dicts = getattr(labels, 'to_dicts', None)
+    return labels if to_dicts is None else to_dicts()
+
+
+class _BlockList(object):
+    """List-like sequence stored as a list of blocks.
+    
+       Supports the list methods used by the raw operations. A segment tree
+       of block lengths locates positions, so indexing, insertion and removal
+       cost O(log n + block_size)."""
+    
+    block_size = 512
+    
+    def __init__(self, items=()):
+        items = list(items)
+        size = self.block_size
+        self._blocks = [items[i:(i + size)]
+                        for i in range(0, len(items), size)] or [[]]
+        self._len = len(items)
+        self._build()
+    
+    def _build(self):
+        """Rebuilds the segment tree after blocks are added or removed."""
+        n_blocks = len(self._blocks)
+        width = 1
+        while width < n_blocks:
+            width *= 2
+        tree = [0] * (2 * width)
+        tree[width:(width + n_blocks)] = [len(b) for b in self._blocks]
+        for node in range(width - 1, 0, -1):
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+        self._width = width
+        self._tree = tree
+    
+    def _resize(self, block, delta):
+        """Records a change in length of a block."""
+        tree = self._tree
+        node = block + self._width
+        while node:
+            tree[node] += delta
+            node //= 2
+    
+    def _writable(self, block):
+        """Called before the contents of a block change in place."""
+        pass
+    
+    def _touched(self, block):
+        """Called after the contents of a block change in place."""
+        pass
+    
+    def _locate(self, index):
+        """Returns (block, offset) of a valid, non-negative index."""
+        tree = self._tree
+        node = 1
+        while node < self._width:
+            node *= 2
+            if index >= tree[node]:
+                index -= tree[node]
+                node += 1
+        return node - self._width, index
+    
+    def _check(self, index):
+        """Normalizes an index, raising IndexError if it is out of range."""
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('list index out of range')
+        return index
+    
+    def __len__(self):
+        return self._len
+    
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+    
+    def __getitem__(self, index):
+        block, offset = self._locate(self._check(index))
+        return self._blocks[block][offset]
+    
+    def __setitem__(self, index, item):
+        block, offset = self._locate(self._check(index))
+        self._writable(block)
+        self._blocks[block][offset] = item
+        self._touched(block)
+    
+    def insert(self, index, item):
+        if index < 0:
+            index = max(index + self._len, 0)
+        if index >= self._len:
+            block = len(self._blocks) - 1
+            offset = len(self._blocks[block])
+        else:
+            block, offset = self._locate(index)
+        self._writable(block)
+        self._blocks[block].insert(offset, item)
+        self._len += 1
+        if len(self._blocks[block]) > 2 * self.block_size:
+            full = self._blocks[block]
+            self._blocks[block:(block + 1)] = [full[:self.block_size],
+                                               full[self.block_size:]]
+            self._build()
+        else:
+            self._resize(block, 1)
+            self._touched(block)
+    
+    def pop(self, index=-1):
+        block, offset = self._locate(self._check(index))
+        self._writable(block)
+        item = self._blocks[block].pop(offset)
+        self._len -= 1
+        if not self._blocks[block] and len(self._blocks) > 1:
+            del self._blocks[block]
+            self._build()
+        else:
+            self._resize(block, -1)
+            self._touched(block)
+        return item
+    
+    def index(self, item, start=0, stop=None):
+        """Returns the first position of item from start, a non-negative
+           index, up to stop; raises ValueError if there is none."""
+        stop = self._len if stop is None else min(stop, self._len)
+        if start < stop:
+            block, offset = self._locate(start)
+            position = start - offset
+            while position < stop:
+                items = self._blocks[block]
+                try:
+                    return position + items.index(item, offset,
+                                                  stop - position)
+                except ValueError:
+                    position += len(items)
+                    block += 1
+                    offset = 0
+        raise ValueError('item not in list')
+
+
+class _SummaryList(_BlockList):
+    """_BlockList with a segment tree of per-block summaries.
+    
+       Subclasses define fold(block), which summarizes a block, and
+       combine(left, right), which summarizes two adjacent ranges from their
+       summaries; empty is the summary of an empty range.
+       
+       Between defer() and refresh(), changed blocks are only noted, and
+       are summarized once by refresh()."""
+    
+    empty = None
+    _dirty = None # set of changed blocks, while deferred
+    
+    def defer(self):
+        """Defers updating summaries until refresh()."""
+        self._dirty = set()
+    
+    def refresh(self):
+        """Updates the summaries of the blocks changed since defer()."""
+        dirty, self._dirty = self._dirty, None
+        summaries = self._summaries
+        width = self._width
+        for block in dirty:
+            summaries[width + block] = self.fold(self._blocks[block])
+        nodes = set((width + block) // 2 for block in dirty)
+        while nodes:
+            for node in sorted(nodes, reverse=True):
+                summaries[node] = self.combine(summaries[2 * node],
+                                               summaries[2 * node + 1])
+            nodes = set(node // 2 for node in nodes if node > 1)
+    
+    def _build(self):
+        if self._dirty is not None:
+            self._dirty.clear() # every block is summarized below
+        _BlockList._build(self)
+        summaries = [self.empty] * (2 * self._width)
+        for block, items in enumerate(self._blocks):
+            summaries[self._width + block] = self.fold(items)
+        for node in range(self._width - 1, 0, -1):
+            summaries[node] = self.combine(summaries[2 * node],
+                                           summaries[2 * node + 1])
+        self._summaries = summaries
+    
+    def _touched(self, block):
+        if self._dirty is not None:
+            self._dirty.add(block)
+            return
+        summaries = self._summaries
+        node = block + self._width
+        summaries[node] = self.fold(self._blocks[block])
+        node //= 2
+        while node:
+            summaries[node] = self.combine(summaries[2 * node],
+                                           summaries[2 * node + 1])
+            node //= 2
+
+
+# hashing
+
+HASH_ALGORITHMS = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256}
+if hasattr(hashlib, 'blake2b'): # python 2/3 support
+    HASH_ALGORITHMS['blake2b'] = hashlib.blake2b
+DEFAULT_HASH_ALGORITHM = ('blake2b' if 'blake2b' in HASH_ALGORITHMS
+                          else 'sha256')
+LEGACY_HASH_ALGORITHM = 'sha1'
+
+def register_hash_algorithm(name, constructor):
+    """Makes a hash algorithm available by name, for hashing labels.
+       
+       constructor -- callable taking no arguments, returning an object with
+                      the update() and hexdigest() methods of hashlib's"""
+    HASH_ALGORITHMS[name] = constructor
+
+def _hash_constructor(name):
+    """Returns the constructor of a registered or hashlib hash algorithm.
+       
+       Raises ValueError if there is no such algorithm."""
+    if name in HASH_ALGORITHMS:
+        return HASH_ALGORITHMS[name]
+    try:
+        hashlib.new(name)
+    except (ValueError, TypeError):
+        raise ValueError('unknown hash algorithm: ' + str(name))
+    return lambda: hashlib.new(name)
+
+def _event_repr(event):
+    """Returns the legacy serialization of an event used for hashing.
+       
+       It depends on the repr of the Python version in use."""
+    return repr(sorted(event.items())).encode()
+
+# the canonical event encoding, version 1: the number of columns, the
+# length-prefixed UTF-8 name of each column (start, stop and name first,
+# then the rest in sorted order), then the value of each column in the same
+# order, as a tag byte and its data: b'f' and a little-endian double; b'i'
+# and a length-prefixed decimal integer; b'T' or b'F' for booleans; b'n'
+# for None; b's' and length-prefixed UTF-8 text; b'y' and length-prefixed
+# bytes; or b'r' and the length-prefixed UTF-8 repr of any other value
+
+EVENT_ENCODING = 1
+
+_LEADING_COLUMNS = ('start', 'stop', 'name')
+_pack_length = struct.Struct('<I').pack
+_pack_float = struct.Struct('<cd').pack
+
+def _encode_float(value):
+    return _pack_float(b'f', value)
+
+def _encode_int(value):
+    data = str(int(value)).encode()
+    return b'i' + _pack_length(len(data)) + data
+
+def _encode_bool(value):
+    return b'T' if value else b'F'
+
+def _encode_none(value):
+    return b'n'
+
+def _encode_text(value):
+    data = value.encode('utf-8')
+    return b's' + _pack_length(len(data)) + data
+
+def _encode_str_bytes(value): # python 2/3 support: str is bytes in python 2
+    return b's' + _pack_length(len(value)) + value
+
+def _encode_bytes(value):
+    return b'y' + _pack_length(len(value)) + value
+
+def _encode_repr(value):
+    data = repr(value).encode('utf-8')
+    return b'r' + _pack_length(len(data)) + data
+
+def _value_encoder(cls):
+    """Returns the function encoding values of a type."""
+    if issubclass(cls, bool):
+        return _encode_bool
+    elif issubclass(cls, numbers.Integral):
+        return _encode_int
+    elif issubclass(cls, numbers.Real):
+        return lambda value: _encode_float(float(value))
+    elif issubclass(cls, bytes):
+        return _encode_str_bytes if bytes is str else _encode_bytes
+    elif issubclass(cls, _text_types):
+        return _encode_text
+    elif cls is type(None):
+        return _encode_none
+    return _encode_repr
+
+# type -> encoding function, for each type seen so far
+_VALUE_ENCODERS = {cls: _value_encoder(cls)
+                   for cls in (float, int, bool, type(None)) + _text_types}
+_LAYOUTS = {} # tuple of columns, in dict order -> (encoding order, header)
+
+def _layout(columns):
+    """Returns the columns in encoding order, and the encoded header."""
+    layout = _LAYOUTS.get(columns)
+    if layout is None:
+        order = [c for c in _LEADING_COLUMNS if c in columns]
+        order.extend(sorted(c for c in columns if c not in _LEADING_COLUMNS))
+        header = [_pack_length(len(order))]
+        header.extend(_encode_text(c)[1:] for c in order)
+        layout = _LAYOUTS[columns] = (tuple(order), b''.join(header))
+    return layout
+
+def encode_event(event, _encoders=_VALUE_ENCODERS):
+    """Returns the canonical encoding of an event, as bytes.
+       
+       The encoding (version EVENT_ENCODING) doesn't depend on the order of
+       the event's columns, or on the Python version."""
+    order, header = _layout(tuple(event))
+    parts = [header]
+    try:
+        for c in order:
+            value = event[c]
+            parts.append(_encoders[type(value)](value))
+    except KeyError: # a type not seen before
+        for value in event.values():
+            if type(value) not in _encoders:
+                _encoders[type(value)] = _value_encoder(type(value))
+        return encode_event(event)
+    return b''.join(parts)
+
+_EVENT_ENCODERS = {None: _event_repr, 1: encode_event}
+
+def _event_encoder(event_encoding):
+    try:
+        return _EVENT_ENCODERS[event_encoding]
+    except KeyError:
+        raise ValueError('unknown event encoding: ' + str(event_encoding))
+
+def event_hash(events, hash_algorithm=LEGACY_HASH_ALGORITHM,
+               event_encoding=None):
+    """Returns the hash of given event list (assumed to be list of dicts).
+       
+       hash_algorithm -- name of a hash algorithm, as registered by
+                         register_hash_algorithm or known to hashlib
+       event_encoding -- version of the canonical event encoding, or None
+                         for the legacy encoding
+       
+       By default, this is the legacy SHA-1 hash of each event's repr."""
+    eh = _hash_constructor(hash_algorithm)()
+    encode = _event_encoder(event_encoding)
+    for e in _event_list(events):
+        eh.update(encode(e))
+    return eh.hexdigest()
+
+
+DIGEST_MODULUS = 2**127 - 1
+DIGEST_BASE = int(hashlib.sha1(b'eventedit').hexdigest(), 16) % DIGEST_MODULUS
+
+def _leaf_digest(data):
+    """Returns the digest of one serialized event, as an integer."""
+    return int(hashlib.sha1(data).hexdigest(), 16) % DIGEST_MODULUS
+
+def _combine_digests(left, right):
+    """Combines (hash, base**length) pairs of two adjacent event ranges."""
+    return ((left[0] * right[1] + right[0]) % DIGEST_MODULUS,
+            (left[1] * right[1]) % DIGEST_MODULUS)
+
+def _fold_digests(leaves):
+    """Returns the (hash, base**length) pair of a range of leaf digests."""
+    h = 0
+    for leaf in leaves:
+        h = (h * DIGEST_BASE + leaf) % DIGEST_MODULUS
+    return h, pow(DIGEST_BASE, len(leaves), DIGEST_MODULUS)
+
+
+class EventDigest(object):
+    """Hash of an event list which can be updated as events change.
+    
+       Each event is hashed on its own, and the event hashes are combined as
+       a polynomial hash modulo 2**127 - 1. The combination is associative, so
+       partial hashes of blocks of events are kept in a segment tree, and
+       replacing an event costs O(log n) rather than rehashing the list.
+       
+       The result does not depend on the history of edits, only on the
+       events, but it is not the same as event_hash. Events are hashed in
+       the canonical encoding."""
+    
+    def __init__(self, events=(), hash_algorithm=None,
+                 event_encoding=EVENT_ENCODING):
+        """Creates an EventDigest.
+           
+           events -- list of dicts denoting event data
+           hash_algorithm, event_encoding -- if hash_algorithm is present,
+               also compute event_hash(events, hash_algorithm,
+               event_encoding) in the same pass, and store it in flat_hash"""
+        eh = None
+        if hash_algorithm is not None:
+            eh = _hash_constructor(hash_algorithm)()
+            encode = _event_encoder(event_encoding)
+        leaves = []
+        for e in _event_list(events):
+            data = encode_event(e)
+            if eh is not None:
+                eh.update(data if encode is encode_event else encode(e))
+            leaves.append(_leaf_digest(data))
+        self.flat_hash = eh.hexdigest() if eh is not None else None
+        self._leaves = _DigestList(leaves)
+    
+    def __len__(self):
+        return len(self._leaves)
+    
+    def replace(self, index, removed, events):
+        """Replaces removed events starting at index with new events."""
+        leaves = [_leaf_digest(encode_event(e)) for e in events]
+        for i in range(min(removed, len(leaves))):
+            self._leaves[index + i] = leaves[i]
+        for _ in range(removed - len(leaves)):
+            self._leaves.pop(index + len(leaves))
+        for i in range(removed, len(leaves)):
+            self._leaves.insert(index + i, leaves[i])
+    
+    def replace_many(self, replacements):
+        """Makes a sequence of (index, removed, events) replacements, as by
+           replace(), combining block digests once at the end."""
+        self._leaves.defer()
+        for index, removed, events in replacements:
+            self.replace(index, removed, events)
+        self._leaves.refresh()
+    
+    def hexdigest(self):
+        """Returns the hash of the events, as a string of hex digits."""
+        h = self._leaves.digest()[0]
+        return hashlib.sha1(('%d:%x' % (len(self), h)).encode()).hexdigest()
+
+
+class _DigestList(_SummaryList):
+    """_BlockList of leaf digests, with a segment tree of block digests."""
+    
+    block_size = 64
+    empty = (0, 1)
+    fold = staticmethod(_fold_digests)
+    combine = staticmethod(_combine_digests)
+    
+    def digest(self):
+        """Returns the (hash, base**length) pair of the whole list."""
+        return self._summaries[1]
+
+
+# time index
+
+def _fold_bounds(bounds):
+    """Returns (earliest start, latest stop) of a range of (start, stop)."""
+    lo, hi = float('inf'), float('-inf')
+    for start, stop in bounds:
+        if start < lo:
+            lo = start
+        if stop > hi:
+            hi = stop
+    return lo, hi
+
+def _combine_bounds(left, right):
+    """Combines the (earliest start, latest stop) of two ranges."""
+    return min(left[0], right[0]), max(left[1], right[1])
+
+def _bounds(event):
+    """Returns (start, stop) of an event as floats; None becomes NaN."""
+    start, stop = event['start'], event['stop']
+    return (float('nan') if start is None else float(start),
+            float('nan') if stop is None else float(stop))
+
+
+class TimeIndex(object):
+    """Index of event boundaries supporting lookup by time.
+    
+       Event (start, stop) pairs are kept in blocks, with the earliest start
+       and latest stop of each block in a segment tree. Queries skip every
+       block which cannot contain a match, so for time-ordered events they
+       cost O(log n) plus the number of matches. Events need not be sorted
+       or non-overlapping."""
+    
+    def __init__(self, events=()):
+        """Creates a TimeIndex.
+           
+           events -- list of dicts denoting event data"""
+        self._bounds = _TimeList([_bounds(e) for e in _event_list(events)])
+    
+    def __len__(self):
+        return len(self._bounds)
+    
+    def replace(self, index, removed, events):
+        """Replaces removed events starting at index with new events."""
+        bounds = [_bounds(e) for e in events]
+        for i in range(min(removed, len(bounds))):
+            self._bounds[index + i] = bounds[i]
+        for _ in range(removed - len(bounds)):
+            self._bounds.pop(index + len(bounds))
+        for i in range(removed, len(bounds)):
+            self._bounds.insert(index + i, bounds[i])
+    
+    def replace_many(self, replacements):
+        """Makes a sequence of (index, removed, events) replacements, as by
+           replace(), combining block bounds once at the end."""
+        self._bounds.defer()
+        for index, removed, events in replacements:
+            self.replace(index, removed, events)
+        self._bounds.refresh()
+    
+    def at(self, t):
+        """Returns the indices of the events with start <= t < stop."""
+        return self._bounds.search(lambda lo, hi: lo <= t < hi)
+    
+    def overlapping(self, t0, t1):
+        """Returns the indices of the events overlapping [t0, t1)."""
+        return self._bounds.search(lambda lo, hi: lo < t1 and hi > t0)
+
+
+class _TimeList(_SummaryList):
+    """_BlockList of (start, stop), with a segment tree of block bounds."""
+    
+    block_size = 64
+    empty = (float('inf'), float('-inf'))
+    fold = staticmethod(_fold_bounds)
+    combine = staticmethod(_combine_bounds)
+    
+    def search(self, hit):
+        """Returns, in order, the indices of items for which hit(start, stop).
+           
+           hit -- function which is True for (start, stop) of any matching
+                  item, and for the (earliest start, latest stop) of any
+                  range containing one"""
+        tree = self._tree
+        summaries = self._summaries
+        found = []
+        pending = [(1, 0)]
+        while pending:
+            node, offset = pending.pop()
+            if not hit(*summaries[node]):
+                continue
+            if node >= self._width:
+                for i, bounds in enumerate(self._blocks[node - self._width]):
+                    if hit(*bounds):
+                        found.append(offset + i)
+            else:
+                pending.append((2 * node + 1, offset + tree[2 * node]))
+                pending.append((2 * node, offset))
+        return found
+
+
+# journal
+
+class Journal(object):
+    """Append-only record of the operations executed on an EditStack.
+       
+       Each push, undo or redo appends one record, which is flushed as it is
+       written, so a killed process loses at most the record being written.
+       Records are synced to disk every fsync_every records."""
+    version = 2
+    
+    def __init__(self, file, hash_pre, undo_stack=(), redo_stack=(),
+                 fsync_every=1, hash_algorithm=LEGACY_HASH_ALGORITHM,
+                 event_encoding=None):
+        """Creates a journal, replacing any existing file.
+           
+           file -- filename string of the journal
+           hash_pre -- hash of the labels before any operation
+           undo_stack, redo_stack -- stacks the journal starts from
+           fsync_every -- int; records between syncs, or 0 to never sync
+           hash_algorithm, event_encoding -- how hash_pre was computed, as
+                                             for event_hash"""
+        self.file = file
+        self.fsync_every = fsync_every
+        self._unsynced = 0
+        header = [Symbol('journal'), KeyArg('version'), self.version,
+                  KeyArg('hash_pre'), hash_pre]
+        if event_encoding is not None:
+            header.extend([KeyArg('hash_algorithm'), hash_algorithm,
+                           KeyArg('event_encoding'), event_encoding])
+        redo_stack = list(redo_stack)
+        tmp_file = file + '.tmp'
+        with codecs.open(tmp_file, 'w', encoding='utf-8') as fp:
+            fp.write(deparse(header) + '\n')
+            for op in undo_stack:
+                fp.write(_journal_record('push', op))
+            # each undo moves the inverse of the last push onto the redo stack
+            for op in reversed(redo_stack):
+                fp.write(_journal_record('push', invert(op)))
+            for _ in redo_stack:
+                fp.write(_journal_record('undo'))
+            fp.flush()
+            os.fsync(fp.fileno())
+        _replace_file(tmp_file, file)
+        self._fp = codecs.open(file, 'a', encoding='utf-8')
+    
+    def push(self, op):
+        self._write(_journal_record('push', op))
+    
+    def undo(self):
+        self._write(_journal_record('undo'))
+    
+    def redo(self):
+        self._write(_journal_record('redo'))
+    
+    def _write(self, record):
+        self._fp.write(record)
+        self._fp.flush()
+        self._unsynced += 1
+        if self.fsync_every and self._unsynced >= self.fsync_every:
+            self.sync()
+    
+    def sync(self):
+        """Syncs all records written so far to disk."""
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._unsynced = 0
+    
+    def close(self):
+        if not self._fp.closed:
+            self.sync()
+            self._fp.close()
+
+
+def _journal_record(kind, op=None):
+    """Returns the journal line for a push, undo or redo."""
+    record = [Symbol(kind)]
+    if op is not None:
+        record.append(op)
+    return deparse(record) + '\n'
+
+try:
+    _replace_file = os.replace
+except AttributeError: # python 2/3 support
+    _replace_file = os.rename
+
+def read_journal(fp):
+    """Reads a journal from an open file.
+       
+       Returns the journal's hash_pre, and lists of the undo and redo stacks
+       left by its records. A truncated final record is ignored.
+       
+       Raises ValueError if fp does not hold a readable journal."""
+    header, undo_ops, redo_ops = _read_journal(fp)
+    return header['hash_pre'], undo_ops, redo_ops
+
+def _read_journal(fp):
+    """Reads a journal as read_journal does, but returns a dict of all the
+       fields of its header in place of hash_pre."""
+    records = []
+    try:
+        _read_forms(fp.read(), [], records)
+    except (SyntaxError, ValueError):
+        pass # records read before the truncation are kept
+    if not records or records[0][0] != 'journal':
+        raise ValueError('not an operations journal')
+    header = dict(_grouper(records[0][1:], 2))
+    if header['version'] > Journal.version:
+        raise ValueError('unsupported journal version')
+    undo_ops = []
+    redo_ops = []
+    for record in records[1:]:
+        if record[0] == 'push':
+            del redo_ops[:]
+            undo_ops.append(compile_op(record[1]))
+        elif record[0] == 'undo':
+            redo_ops.append(invert(undo_ops.pop()))
+        elif record[0] == 'redo':
+            undo_ops.append(invert(redo_ops.pop()))
+        else:
+            raise ValueError('unknown journal record: ' + str(record[0]))
+    return header, undo_ops, redo_ops
+
+
+# binary format
+
+BINARY_MAGIC = b'\x93EVOPS'
+BINARY_VERSION = 1
+
+# value tags
+_NULL, _LIST, _INT, _FLOAT, _STRING, _SYMBOL, _KEYARG, _REF = range(8)
+
+def _write_varint(out, n):
+    """Appends non-negative integer n to bytearray out, 7 bits per byte."""
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _read_varint(data, pos):
+    """Returns the integer at pos in bytearray data, and the position after.
+       
+       Raises IndexError if data ends inside the integer."""
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+class _BinaryEncoder(object):
+    """Encodes s-expressions, interning symbols and keywords.
+       
+       The first use of a symbol writes its name; later uses refer to it by
+       its position in the order of first use."""
+    def __init__(self):
+        self._ids = {}
+    
+    def encode(self, expr, out):
+        """Appends the encoding of expr to bytearray out."""
+        if expr is None:
+            out.append(_NULL)
+        elif isinstance(expr, Op):
+            self.encode(expr.to_sexpr(), out)
+        elif isinstance(expr, list):
+            out.append(_LIST)
+            _write_varint(out, len(expr))
+            for item in expr:
+                self.encode(item, out)
+        elif isinstance(expr, Symbol):
+            key = (isinstance(expr, KeyArg), expr)
+            if key in self._ids:
+                out.append(_REF)
+                _write_varint(out, self._ids[key])
+            else:
+                self._ids[key] = len(self._ids)
+                out.append(_KEYARG if key[0] else _SYMBOL)
+                self._encode_text(expr, out)
+        elif isinstance(expr, _text_types):
+            out.append(_STRING)
+            self._encode_text(expr, out)
+        elif isinstance(expr, numbers.Integral):
+            out.append(_INT)
+            _write_varint(out, 2 * expr if expr >= 0 else -2 * expr - 1)
+        elif isinstance(expr, numbers.Real):
+            out.append(_FLOAT)
+            out.extend(struct.pack('<d', expr))
+        else:
+            raise ValueError('unknown atomic type: ' + str(expr))
+    
+    def _encode_text(self, text, out):
+        data = text.encode('utf-8')
+        _write_varint(out, len(data))
+        out.extend(data)
+
+
+class _BinaryDecoder(object):
+    """Decodes s-expressions written by a _BinaryEncoder."""
+    def __init__(self):
+        self._atoms = []
+    
+    def decode(self, data, pos):
+        """Returns the expression at pos in bytearray data, and the position
+           after it."""
+        tag = data[pos]
+        pos += 1
+        if tag == _LIST:
+            count, pos = _read_varint(data, pos)
+            expr = []
+            for _ in range(count):
+                item, pos = self.decode(data, pos)
+                expr.append(item)
+            return expr, pos
+        elif tag == _REF:
+            i, pos = _read_varint(data, pos)
+            return self._atoms[i], pos
+        elif tag == _INT:
+            n, pos = _read_varint(data, pos)
+            return (-(n + 1) >> 1 if n & 1 else n >> 1), pos
+        elif tag == _FLOAT:
+            return struct.unpack_from('<d', data, pos)[0], pos + 8
+        elif tag in (_STRING, _SYMBOL, _KEYARG):
+            size, pos = _read_varint(data, pos)
+            text = data[pos:(pos + size)].decode('utf-8')
+            pos += size
+            if tag == _STRING:
+                return text, pos
+            atom = Symbol(text) if tag == _SYMBOL else KeyArg(text)
+            self._atoms.append(atom)
+            return atom, pos
+        elif tag == _NULL:
+            return None, pos
+        raise ValueError('unknown tag in binary operations: ' + str(tag))
+
+
+def write_binary(ops, fp):
+    """Writes s-expressions to an open binary file.
+       
+       The file begins with BINARY_MAGIC and the format version, followed by
+       one length-prefixed record per s-expression."""
+    fp.write(BINARY_MAGIC + bytes(bytearray([BINARY_VERSION])))
+    encoder = _BinaryEncoder()
+    for op in ops:
+        payload = bytearray()
+        encoder.encode(op, payload)
+        record = bytearray()
+        _write_varint(record, len(payload))
+        fp.write(bytes(record + payload))
+
+def iter_read_binary(fp, chunk_size=65536):
+    """Yields the s-expressions in an open binary file, one at a time.
+       
+       fp -- file-like object with a read() method returning bytes
+       chunk_size -- number of bytes to read at a time
+       
+       Raises ValueError if fp is not in a supported binary format, and
+       SyntaxError if the input ends inside a record."""
+    header = bytearray(fp.read(len(BINARY_MAGIC) + 1))
+    if bytes(header[:-1]) != BINARY_MAGIC:
+        raise ValueError('not a binary operations file')
+    if header[-1] > BINARY_VERSION:
+        raise ValueError('unsupported binary operations version')
+    decoder = _BinaryDecoder()
+    buf = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        try:
+            size, start = _read_varint(buf, pos)
+            if start + size > len(buf):
+                raise IndexError
+        except IndexError: # record incomplete; read more
+            if eof:
+                if pos < len(buf):
+                    raise SyntaxError('unexpected EOF')
+                return
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            del buf[:pos]
+            buf.extend(chunk)
+            pos = 0
+            continue
+        expr, pos = decoder.decode(buf, start)
+        if pos != start + size:
+            raise ValueError('malformed record in binary operations')
+        yield SExpr(expr) if isinstance(expr, list) else expr
+
+
+def read_ops_file(file):
+    """Returns the s-expressions in an operations file, and its format,
+       which is detected from the file's contents."""
+    with open(file, 'rb') as fp:
+        binary = fp.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+    if binary:
+        with open(file, 'rb') as fp:
+            return list(iter_read_binary(fp)), 'binary'
+    with codecs.open(file, 'r', encoding='utf-8') as fp:
+        return list(iter_parse(fp)), 'text'
+
+def write_ops_file(file, ops, ops_format='text'):
+    """Writes s-expressions to an operations file in ops_format.
+       
+       The file is replaced atomically, as by _replacing."""
+    if ops_format == 'text':
+        with _replacing(file) as fp:
+            for op in ops:
+                fp.write(deparse(op) + '\n')
+    elif ops_format == 'binary':
+        with _replacing(file, binary=True) as fp:
+            write_binary(ops, fp)
+    else:
+        raise ValueError('unknown operations format: ' + str(ops_format))
+
+@contextlib.contextmanager
+def _replacing(file, binary=False):
+    """Context manager yielding a file to write in place of file.
+       
+       The block writes to a temporary file beside file, which is synced and
+       renamed over file if the block succeeds, so file is never left partly
+       written, even by a killed process."""
+    tmp_file = file + '.tmp'
+    if binary:
+        fp = open(tmp_file, 'wb')
+    else:
+        fp = codecs.open(tmp_file, 'w', encoding='utf-8')
+    try:
+        with fp:
+            yield fp
+            fp.flush()
+            os.fsync(fp.fileno())
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    _replace_file(tmp_file, file)
+
+def read_metadata(file):
+    """Reads the metadata of an operations file: file + '.json' if it
+       exists, and otherwise file + '.yaml'.
+       
+       Returns the metadata as a dict, and its format."""
+    if os.path.exists(file + '.json'):
+        import json
+        with codecs.open(file + '.json', 'r', encoding='utf-8') as fp:
+            return json.load(fp), 'json'
+    with codecs.open(file + '.yaml', 'r', encoding='utf-8') as fp:
+        import yaml
+        return yaml.safe_load(fp), 'yaml'
+
+def write_metadata(file, data, metadata_format='yaml'):
+    """Writes the metadata of an operations file, as file + '.yaml' or
+       file + '.json', replacing it atomically; any metadata file of the
+       other format is removed, so it can't be read in its place.
+       
+       data -- dict of metadata, of values YAML and JSON can both hold
+       metadata_format -- 'yaml' or 'json'; JSON avoids importing PyYAML"""
+    if metadata_format == 'json':
+        import json
+        with _replacing(file + '.json') as fp:
+            fp.write(json.dumps(data, indent=2, sort_keys=True) + '\n')
+    elif metadata_format == 'yaml':
+        import yaml
+        with _replacing(file + '.yaml') as fp:
+            fp.write("""# corrections metadata, YAML syntax\n---\n""")
+            fp.write(yaml.safe_dump(data, default_flow_style=False))
+    else:
+        raise ValueError('unknown metadata format: ' + str(metadata_format))
+    for other in METADATA_FORMATS:
+        if other != metadata_format and os.path.exists(file + '.' + other):
+            os.remove(file + '.' + other)
+
+METADATA_FORMATS = ('yaml', 'json')
+
+def convert_ops_file(src, dst, ops_format):
+    """Converts an operations file (of either format) to ops_format.
+       
+       The metadata file is unaffected, and applies equally to dst."""
+    ops, _ = read_ops_file(src)
+    write_ops_file(dst, ops, ops_format)
+
+
+# lazy loading
+
+_FORM_DELIMITERS = re.compile(br'"[^"]*"|[()]')
+
+def _form_spans(data):
+    """Returns the (start, stop) offsets of each top-level s-expression in
+       data, a string of UTF-8 bytes, without parsing them.
+       
+       Raises SyntaxError if parentheses are unbalanced."""
+    spans = []
+    depth = 0
+    start = 0
+    for match in _FORM_DELIMITERS.finditer(data):
+        delimiter = match.group()
+        if delimiter == b'(':
+            if not depth:
+                start = match.start()
+            depth += 1
+        elif delimiter == b')':
+            depth -= 1
+            if not depth:
+                spans.append((start, match.end()))
+            elif depth < 0:
+                raise SyntaxError('unexpected )')
+    if depth:
+        raise SyntaxError('unexpected EOF')
+    return spans
+
+class _LazyOps(object):
+    """Read-only sequence of the operations in a text operations file,
+       each parsed and compiled the first time it is accessed."""
+    __slots__ = ('_data', '_spans', '_ops')
+    
+    def __init__(self, data):
+        self._data = data
+        self._spans = _form_spans(data)
+        self._ops = [None] * len(self._spans)
+    
+    def __len__(self):
+        return len(self._ops)
+    
+    def __getitem__(self, index):
+        op = self._ops[index]
+        if op is None:
+            if index < 0:
+                index += len(self._ops)
+            start, stop = self._spans[index]
+            op = compile_op(parse(self._data[start:stop].decode('utf-8')))
+            self._ops[index] = op
+        return op
+    
+    def __iter__(self):
+        for i in range(len(self._ops)):
+            yield self[i]
+
+def _read_ops_lazily(file):
+    """Returns the operations in an operations file as a sequence, and the
+       file's format. Text files are parsed lazily, by _LazyOps; binary
+       files, whose records can't be decoded out of order, are read in
+       full."""
+    with open(file, 'rb') as fp:
+        data = fp.read()
+    if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return [compile_op(s_expr)
+                for s_expr in iter_read_binary(io.BytesIO(data))], 'binary'
+    return _LazyOps(data), 'text'
+
+
+# checkpoints
+
+def _freeze_event(event):
+    """Returns an event as a frozen event, a 1-tuple of a copy of its dict.
+       
+       Operations replace values rather than changing them in place, so a
+       shallow copy keeps the event's values."""
+    return (dict(event),)
+
+def _thaw_event(frozen):
+    """Returns a new event dict from a frozen event."""
+    return _copy_event(frozen[0])
+
+def _freeze_block(items):
+    """Freezes, in place, the events in a block of a _FrozenEvents."""
+    items[:] = [item if isinstance(item, tuple) else _freeze_event(item)
+                for item in items]
+
+class _FrozenEvents(_BlockList):
+    """The events in labels, kept in sync with them in the same way as an
+       EventDigest, in blocks which snapshots share copy-on-write.
+       
+       Each item is either the event dict in labels at the same position,
+       or a frozen event with its values. The rows of a table are views of
+       a position rather than events, so they are frozen as soon as they
+       are mirrored. A snapshot is a tuple of the
+       blocks, so it costs one reference per block. Before a block shared
+       with a snapshot changes, its events are frozen in place, which the
+       snapshots see too, and the block is copied; so only frozen events are
+       ever held by snapshots alone, and events unchanged between snapshots
+       are shared by them."""
+    
+    block_size = 32
+    
+    def __init__(self, labels=()):
+        if not isinstance(labels, list): # to_dicts() makes the copies
+            labels = [(event,) for event in _event_list(labels)]
+        _BlockList.__init__(self, labels)
+        self._owned = set() # ids of the blocks copied since the snapshot
+    
+    def _writable(self, block):
+        items = self._blocks[block]
+        if id(items) not in self._owned:
+            _freeze_block(items)
+            items = self._blocks[block] = list(items)
+            self._owned.add(id(items))
+    
+    def prepare(self, index, removed):
+        """Copies the blocks of the events about to be changed, if they are
+           shared, before the event dicts change in place."""
+        stop = min(index + removed, self._len)
+        while index < stop:
+            block, offset = self._locate(index)
+            self._writable(block)
+            index += len(self._blocks[block]) - offset
+    
+    def replace(self, index, removed, events):
+        """Replaces removed events starting at index with events."""
+        events = [e if type(e) is dict else _freeze_event(e) for e in events]
+        common = min(removed, len(events))
+        for i in range(common):
+            self[index + i] = events[i]
+        for _ in range(removed - common):
+            self.pop(index + common)
+        for i in range(common, len(events)):
+            self.insert(index + i, events[i])
+    
+    def snapshot(self):
+        self._owned = set()
+        return tuple(self._blocks)
+    
+    def restore(self, snapshot):
+        """Returns to a snapshot, comparing its blocks with the current ones,
+           and then the items of the blocks which differ.
+           
+           Returns a list of (start, stop, events) in descending order, such
+           that replacing each labels[start:stop] with events, new dicts,
+           returns labels to the snapshot's events."""
+        blocks = self._blocks
+        starts = [0]
+        for items in blocks:
+            starts.append(starts[-1] + len(items))
+        spans = _changed_spans(blocks, snapshot)
+        for start, stop, _, _ in spans: # so the snapshot holds frozen events
+            for items in blocks[start:stop]:
+                _freeze_block(items)
+        hunks = []
+        for start, stop, new_start, new_stop in reversed(spans):
+            old = [item for items in blocks[start:stop] for item in items]
+            new = [item for items in snapshot[new_start:new_stop]
+                   for item in items]
+            for i, j, new_i, new_j in reversed(_changed_spans(old, new)):
+                events = [_thaw_event(item) for item in new[new_i:new_j]]
+                hunks.append((starts[start] + i, starts[start] + j, events))
+        self._blocks = list(snapshot)
+        self._len = sum(len(items) for items in snapshot)
+        self._owned = set()
+        self._build()
+        return hunks
+
+def _changed_spans(old, new):
+    """Returns a list of (start, stop, new_start, new_stop), in order, such
+       that replacing each old[start:stop] with new[new_start:new_stop]
+       turns old into new, where old and new are sequences compared by
+       identity, such as of the blocks of two snapshots or their items.
+       
+       A greedy alignment, which is exact for items shared between
+       snapshots, though not always minimal."""
+    i = 0
+    n = min(len(old), len(new))
+    while i < n and old[i] is new[i]:
+        i += 1
+    end = 0
+    while end < n - i and old[-1 - end] is new[-1 - end]:
+        end += 1
+    old_stop, new_stop = len(old) - end, len(new) - end
+    old_index = {id(old[k]): k for k in range(i, old_stop)}
+    new_index = {id(new[k]): k for k in range(i, new_stop)}
+    spans = []
+    j = i
+    while i < old_stop and j < new_stop:
+        if old[i] is new[j]:
+            i += 1
+            j += 1
+            continue
+        # find the nearest item shared by the rest of both sequences
+        for d in itertools.count():
+            if i + d >= old_stop and j + d >= new_stop:
+                resync = old_stop, new_stop
+                break
+            if i + d < old_stop:
+                k = new_index.get(id(old[i + d]), -1)
+                if k >= j and new[k] is old[i + d]:
+                    resync = i + d, k
+                    break
+            if j + d < new_stop:
+                k = old_index.get(id(new[j + d]), -1)
+                if k >= i and old[k] is new[j + d]:
+                    resync = k, j + d
+                    break
+        spans.append((i, resync[0], j, resync[1]))
+        i, j = resync
+    if i < old_stop or j < new_stop:
+        spans.append((i, old_stop, j, new_stop))
+    return spans
+
+def _replace_events(labels, hunks):
+    """Replaces labels[start:stop] with events, for each (start, stop,
+       events) in hunks, in descending order, in a list or a table; the list
+       is rebuilt once."""
+    events = _event_list(labels)
+    pieces = []
+    end = len(events)
+    for start, stop, new_events in hunks:
+        pieces.append(events[stop:end])
+        pieces.append(new_events)
+        end = start
+    pieces.append(events[:end])
+    labels[:] = list(itertools.chain.from_iterable(reversed(pieces)))
+
+# history compaction
+
+def squash_ops(ops):
+    """Returns a compacted list of operations with the same effect as ops.
+       
+       ops -- iterable of Ops or operation s-expressions
+       
+       Value changes to the same column of the same event are folded into
+       one, as long as no structural operation comes between them; an
+       operation immediately followed by its inverse is dropped along with
+       it; and value changes which leave the value unchanged are dropped.
+       Applied to the labels ops were generated against, the result gives
+       the same labels as ops, and can be undone to the same starting
+       labels."""
+    out = [] # dropped operations are replaced by None
+    live = [] # positions of operations in out, some perhaps since dropped
+    pending = {} # (kind, index) -> position of unfolded value change
+    for op in ops:
+        op = compile_op(op)
+        if isinstance(op, SetValue):
+            key = (op.kind, op.index)
+            if key in pending:
+                pos = pending[key]
+                op = type(op)(op.index, out[pos].old, op.new)
+                out[pos] = op
+            else:
+                pos = len(out)
+                out.append(op)
+                live.append(pos)
+                pending[key] = pos
+            if op.old == op.new:
+                out[pos] = None
+                del pending[key]
+        else:
+            pending.clear()
+            while live and out[live[-1]] is None:
+                live.pop()
+            if live and out[live[-1]] == op.inverse():
+                out[live.pop()] = None
+            else:
+                live.append(len(out))
+                out.append(op)
+    return [op for op in out if op is not None]
+
+
+# diffing
+
+def diff(labels_before, labels_after):
+    """Returns a list of operations turning labels_before into labels_after.
+       
+       labels_before, labels_after -- lists of event dicts, or tables with
+                                      to_dicts(), ordered by start time
+       
+       Neither argument is modified. Events shared at the start and end of
+       both lists are skipped; the rest are aligned by sweeping through both
+       in time order, so the cost grows with the length of the lists plus
+       the number of differences. An event which overlaps one event on the
+       other side becomes value changes (set_name, set_start, set_stop) if
+       its other columns match, or else a delete and a create; one which
+       overlaps two neighbours on the other side becomes a merge_next or a
+       split; and one which overlaps nothing is deleted or created. The
+       result is short, though not always minimal, and replaying it onto
+       labels_before always gives labels equal to labels_after."""
+    old = _event_list(labels_before)
+    new = _event_list(labels_after)
+    i = 0
+    n = min(len(old), len(new))
+    while i < n and old[i] == new[i]:
+        i += 1
+    end = 0
+    while end < n - i and old[-1 - end] == new[-1 - end]:
+        end += 1
+    old_stop, new_stop = len(old) - end, len(new) - end
+    ops = []
+    index = j = i # index is the position of cur in the labels being edited
+    ahead = [] # split-off events, which come before old[i], the nearest last
+    cur = None # the current old event, as edited so far
+    while True:
+        if cur is None:
+            if ahead:
+                cur = ahead.pop()
+            elif i < old_stop:
+                cur = old[i]
+                i += 1
+            else:
+                break
+        if j == new_stop:
+            ops.append(Delete(index, cur))
+            cur = None
+            continue
+        event = new[j]
+        if cur == event:
+            index += 1
+            j += 1
+            cur = None
+        elif cur['stop'] <= event['start']:
+            ops.append(Delete(index, cur))
+            cur = None
+        elif event['stop'] <= cur['start']:
+            ops.append(Create(index, event))
+            index += 1
+            j += 1
+        else:
+            nxt = ahead[-1] if ahead else old[i] if i < old_stop else None
+            new_next = new[j + 1] if j + 1 < new_stop else None
+            if (nxt is not None and nxt['start'] < event['stop'] and
+                    (new_next is None or new_next['start'] >= nxt['stop'])):
+                # the next old event is covered by this new event alone
+                ops.append(MergeNext(index, cur, nxt, None, None))
+                cur = dict(cur, stop=nxt['stop'])
+                if ahead:
+                    ahead.pop()
+                else:
+                    i += 1
+                continue
+            if (new_next is not None and new_next['start'] < cur['stop'] and
+                    (nxt is None or nxt['start'] >= new_next['stop'])):
+                # the next new event is covered by this old event alone
+                child = dict(cur)
+                child.update(new_next)
+                child['stop'] = cur['stop']
+                ops.append(Split(index, cur, child, event['stop'],
+                                 new_next['start']))
+                ahead.append(child)
+                cur = dict(cur, stop=event['stop'])
+            ops.extend(_retarget(index, cur, event))
+            index += 1
+            j += 1
+            cur = None
+    while j < new_stop:
+        ops.append(Create(index, new[j]))
+        index += 1
+        j += 1
+    return ops
+
+def _retarget(index, event, target):
+    """Returns the operations turning event, at index, into target."""
+    if (len(event) != len(target) or
+            any(k not in _BOUNDARY_NAME and (k not in target or
+                                             target[k] != v)
+                for k, v in event.items())):
+        return [Delete(index, event), Create(index, target)]
+    return [cls(index, event[cls.column], target[cls.column])
+            for cls in (SetName, SetStart, SetStop)
+            if event[cls.column] != target[cls.column]]
+
+_BOUNDARY_NAME = frozenset(('start', 'stop', 'name'))
+
+
+# merging
+
+Merge = collections.namedtuple('Merge', ['ops', 'conflicts', 'labels'])
+
+class Conflict(collections.namedtuple('Conflict', ['start', 'stop', 'ops',
+                                                   'other_ops'])):
+    """Edits made by two histories to the same events.
+       
+       start, stop -- the range of the original events concerned
+       ops -- the first history's operations on them, which were kept
+       other_ops -- the second history's operations on them, which were
+                    left out
+       
+       Operations are listed in the order of their history, with groups
+       and bulk operations whole."""
+    __slots__ = ()
+
+_SINGLE_OPS = {'set_name_many': SetName,
+               'delete_many': Delete,
+               'create_many': Create}
+
+def _single_ops(ops):
+    """Yields the operations in ops, with groups and bulk operations broken
+       into operations on one event each."""
+    for op in ops:
+        op = compile_op(op)
+        if isinstance(op, Group):
+            for child in _single_ops(op.ops):
+                yield child
+        elif isinstance(op, SetValues):
+            cls = _SINGLE_OPS[op.kind]
+            for index, old, new in zip(op.indices, op.old, op.new):
+                yield cls(index, old, new)
+        elif isinstance(op, EventsOp):
+            cls = _SINGLE_OPS[op.kind]
+            items = list(zip(op.indices, op.events))
+            if op.kind == 'delete_many': # indices are before any deletion
+                items.reverse()
+            for index, event in items:
+                yield cls(index, event)
+        else:
+            yield op
+
+def _reindexed(op, index):
+    """Returns a copy of a single-event operation with a different index."""
+    if op.index == index:
+        return op
+    copied = object.__new__(type(op))
+    for field in op.fields:
+        setattr(copied, field, getattr(op, field))
+    copied.index = index
+    copied._inverse = None
+    return copied
+
+class _Tracer(object):
+    """Follows the events of labels through a history of single-event
+       operations, as tags: original events are tagged with their index, and
+       new events with numbers from new_tags.
+       
+       origin maps each new event's tag to the original event it was split
+       from, or which came before it when it was created (0 for none). The
+       tags are held in a _BlockList, so each step costs O(log n)."""
+    def __init__(self, length, new_tags):
+        self.tags = _BlockList(range(length))
+        self.length = length
+        self.new_tags = new_tags
+        self.origin = {}
+    
+    def step(self, op):
+        """Follows op; returns op with its index made non-negative, the tags
+           of the events it replaces and the tags of those it leaves there."""
+        tags = self.tags
+        index, removed, inserted = op.footprint(len(tags))
+        op = _reindexed(op, index)
+        replaced = _slice(tags, index, index + removed)
+        kept = replaced[:inserted]
+        if removed:
+            parent = self.base(replaced[0])
+        else:
+            parent = self.base(tags[index - 1]) if index else 0
+        for _ in range(inserted - len(kept)):
+            tag = next(self.new_tags)
+            self.origin[tag] = parent
+            kept.append(tag)
+        _splice(tags, index, replaced, kept)
+        return op, replaced, kept
+    
+    def alias(self, index, kept, others):
+        """Retags the events kept at index by a step with others, the tags
+           another tracer gave the same events."""
+        for position, (tag, other) in enumerate(zip(kept, others)):
+            if tag != other:
+                self.tags[index + position] = other
+                self.origin[other] = self.origin[tag]
+    
+    def base(self, tag):
+        """Returns the original event a tag is, or comes from."""
+        return tag if tag < self.length else self.origin[tag]
+    
+    def bases(self, replaced, kept):
+        """Returns the original events concerned by a step."""
+        return set(self.base(tag) for tag in replaced or kept)
+
+def _slice(seq, start, stop):
+    """Returns seq[start:stop] of a _BlockList, for a non-negative start."""
+    return [seq[i] for i in range(start, min(stop, len(seq)))]
+
+def _splice(seq, index, old, new):
+    """Replaces the items old at index in a _BlockList with new, where the
+       shorter of old and new begins the longer, as for the tags of a
+       _Tracer step."""
+    common = min(len(old), len(new))
+    for _ in range(common, len(old)):
+        seq.pop(index + common)
+    for position in range(common, len(new)):
+        seq.insert(index + position, new[position])
+
+_DELETED = 'deleted'
+
+_Trace = collections.namedtuple('_Trace', ['units', 'changes', 'restructured',
+                                           'concerns', 'tags', 'removed',
+                                           'steps', 'matched'])
+
+def _step_key(op, replaced, tags):
+    """Returns a key identifying a merge, split or creation followed by a
+       _Tracer with the given tags, by the events it replaces (for a
+       creation, the event before it) and the values it gives them."""
+    if isinstance(op, Create):
+        replaced = [tags[op.index - 1]] if op.index else []
+    return type(op), tuple(replaced), repr(op._values()[1:])
+
+def _trace(ops, length, new_tags, same=None):
+    """Follows a history of compiled operations through labels of the given
+       length.
+       
+       same -- dict of the merges, splits and creations of another history,
+               as the steps of its _Trace; if present, each one this history
+               also makes is matched, and the events it leaves take the
+               other history's tags. Matches are removed from same.
+       
+       Returns a _Trace of: for each operation, a list of the single-event
+       operations it breaks into; for each event changed, _DELETED if it was
+       deleted, or else a dict of the columns whose value was set and their
+       last values; for each event merged or split, a list of the keys of
+       the steps doing so (None if same is absent); the positions in ops of
+       the operations concerning each original event; the tags of the events
+       at the end; the set of tags of the events removed; a dict of the keys
+       of the merges, splits and creations left unmatched to a deque of the
+       tags of the events each left; and for the position in units of each
+       step matched, the tags it took."""
+    tracer = _Tracer(length, new_tags)
+    units = []
+    changed = {}
+    restructured = collections.defaultdict(list)
+    concerns = collections.defaultdict(list)
+    removed = set()
+    steps = {}
+    matched = {}
+    for position, unit in enumerate(ops):
+        unit_steps = []
+        for op in _single_ops([unit]):
+            op, replaced, kept = tracer.step(op)
+            unit_steps.append(op)
+            removed.update(replaced[op.inserted:])
+            if isinstance(op, (PairOp, Create)):
+                key = None
+                if same is not None:
+                    key = _step_key(op, replaced, tracer.tags)
+                if same and same.get(key): # made by both histories
+                    others = same[key].popleft()
+                    tracer.alias(op.index, kept, others)
+                    kept = others
+                    matched[(position, len(unit_steps) - 1)] = others
+                else:
+                    steps.setdefault(key, collections.deque()).append(kept)
+                    for tag in replaced:
+                        restructured[tag].append(key)
+            for tag in replaced:
+                if isinstance(op, SetValue):
+                    values = changed.setdefault(tag, {})
+                    if isinstance(values, dict):
+                        values[op.column] = op.new
+                elif isinstance(op, Delete):
+                    changed[tag] = _DELETED
+            for tag in tracer.bases(replaced, kept):
+                if concerns[tag][-1:] != [position]:
+                    concerns[tag].append(position)
+        units.append(unit_steps)
+    return _Trace(units, changed, restructured, concerns, tracer.tags,
+                  removed, steps, matched)
+
+def _settled(changes, restructured, unmatched):
+    """Returns the changes of a _Trace, with None for each event merged or
+       split (but not deleted) by a step whose key is still in unmatched."""
+    changes = dict(changes)
+    for tag, keys in restructured.items():
+        if (changes.get(tag) is not _DELETED and
+                any(unmatched.get(key) for key in keys)):
+            changes[tag] = None
+    return changes
+
+def _find(seq, item, guess):
+    """Returns the position of item in seq, searching outward from guess."""
+    width = 16
+    while True:
+        lo = max(guess - width, 0)
+        try:
+            return seq.index(item, lo, guess + width)
+        except ValueError:
+            if lo == 0 and guess + width >= len(seq):
+                raise
+        width *= 4
+
+def _transform_action(op, replaced, our_changes, their_changes, gone,
+                      strict):
+    """Returns 'apply' if an operation of the second history applies after
+       the first, 'skip' if the first has already made the same edit, or
+       'clash' if the two conflict."""
+    action = 'apply'
+    for tag in replaced:
+        ours = our_changes.get(tag)
+        theirs = their_changes.get(tag)
+        if ours == _DELETED == theirs:
+            action = 'skip'
+        elif tag in gone:
+            # unless both merged it away identically, after the same edit
+            if not (isinstance(op, SetValue) and isinstance(ours, dict) and
+                    isinstance(theirs, dict) and op.column in ours and
+                    ours[op.column] == theirs[op.column]):
+                return 'clash'
+            action = 'skip'
+        elif tag not in our_changes:
+            continue
+        elif not isinstance(op, SetValue):
+            if strict:
+                return 'clash'
+        elif not isinstance(ours, dict):
+            return 'clash'
+        elif not isinstance(theirs, dict):
+            if strict:
+                return 'clash'
+            # the event is merged, split or deleted later, so the value this
+            # operation sets is the one to compare
+            if op.column in ours:
+                if ours[op.column] != op.new:
+                    return 'clash'
+                action = 'skip'
+        elif op.column in ours:
+            if ours[op.column] != theirs[op.column]:
+                return 'clash'
+            action = 'skip'
+    return action
+
+def _retargeted(op, index, labels):
+    """Returns a single-event operation moved to index, with the values of
+       its target taken from labels, to which it is about to be applied."""
+    if isinstance(op, SetValue):
+        return type(op)(index, labels[index][op.column], op.new)
+    if isinstance(op, Create):
+        return _reindexed(op, index)
+    event = labels[index]
+    if isinstance(op, Delete):
+        return Delete(index, event)
+    if isinstance(op, MergeNext):
+        return MergeNext(index, event, labels[index + 1], op.new_stop,
+                         op.new_next_start)
+    # a split's second child takes the values the operation gave it where
+    # they differ from the event split, and the rest from the event
+    parent = op.event
+    next_event = dict(event)
+    next_event.update((k, v) for k, v in zip(op.next_columns, op.next_values)
+                      if k not in parent or parent[k] != v)
+    return Split(index, event, next_event, op.new_stop, op.new_next_start)
+
+def _transform(ops, length, merged, result, copied, our_changes, gone,
+               new_tags, strict=True, ours=None):
+    """Moves a history of operations made against labels of the given length
+       onto the result of another history, as followed by _trace.
+       
+       merged -- _BlockList of the tags of the events in result; updated
+       result -- _BlockList of events; updated
+       copied -- set of the ids of events in result which are copies, as
+                 for _apply_copying; updated
+       our_changes, gone -- the other history's changes to the original
+                            events, as from _trace, and the tags it removed
+       new_tags -- iterator of numbers for tags, after those in merged
+       strict -- bool; if True, a structural operation conflicts with
+                 value changes the other history made to its events
+       ours -- the _Trace of the other history, if present; a merge, split
+               or creation it also made is kept once, and our_changes are
+               taken from it
+       
+       Each operation, including a group or bulk operation, is applied or
+       left out whole. Returns the history, compiled; the operations to
+       apply to result, a group for each operation of more than one event;
+       and (start, stop, position) for each operation left out, where start
+       and stop are the range of the original events it concerns."""
+    ops = [compile_op(op) for op in ops]
+    first_theirs = next(new_tags) # later tags are this history's
+    same = None
+    if ours is not None:
+        same = {key: collections.deque(kept)
+                for key, kept in ours.steps.items()}
+    trace = _trace(ops, length, itertools.count(first_theirs), same)
+    their_changes = _settled(trace.changes, trace.restructured, trace.steps)
+    if ours is not None:
+        our_changes = _settled(ours.changes, ours.restructured, same)
+    tracer = _Tracer(length, itertools.count(first_theirs))
+    drift = 0 # how far the last event found had moved
+    out = []
+    clashes = []
+    for position, unit in enumerate(trace.units):
+        saved_drift = drift
+        done = [] # (op applied, index, tags replaced, tags kept)
+        bases = set()
+        created = []
+        clash = False
+        for i, op in enumerate(unit):
+            op, replaced, kept = tracer.step(op)
+            others = trace.matched.get((position, i))
+            if others is not None: # the other history made the same edit
+                tracer.alias(op.index, kept, others)
+                kept = others
+            bases.update(tracer.bases(replaced, kept))
+            mine = [tag for tag in kept if tag >= first_theirs]
+            created.extend(mine)
+            if clash or others is not None:
+                continue # the operation is only followed
+            action = _transform_action(op, replaced, our_changes,
+                                       their_changes, gone, strict)
+            if action == 'apply':
+                index, action = _place(op, replaced, merged, result, length,
+                                       first_theirs, tracer.tags, gone, drift)
+                if replaced:
+                    drift = index - op.index
+            if action == 'apply':
+                op = _retargeted(op, index, result)
+                try:
+                    _apply_copying(op, result, copied)
+                except ValueError: # a split point no longer within its event
+                    action = 'clash'
+            if action == 'clash':
+                clash = True
+            elif action == 'skip':
+                # events the operation would have created are left out too
+                gone.update(mine)
+            else:
+                _splice(merged, index, replaced, kept)
+                done.append((op, index, replaced, kept))
+        if clash:
+            for op, index, replaced, kept in reversed(done):
+                op.inverse().apply(result)
+                _splice(merged, index, kept, replaced)
+            drift = saved_drift
+            gone.update(created)
+            clashes.append((min(bases), max(bases) + 1, position))
+        elif len(unit) == 1 and done:
+            out.append(done[0][0])
+        elif done:
+            out.append(Group([op for op, _, _, _ in done]))
+    return ops, out, clashes
+
+def _place(op, replaced, merged, result, length, first_theirs, tags, gone,
+           drift):
+    """Returns the index in result at which a single-event operation
+       applies, as followed by a _Tracer with the given tags, and 'apply',
+       or 'clash' if the events it replaces are no longer together."""
+    if replaced:
+        index = _find(merged, replaced[0], op.index + drift)
+        if _slice(merged, index, index + len(replaced)) != replaced:
+            return index, 'clash' # other events came between them
+        return index, 'apply'
+    before = op.index - 1
+    while before >= 0 and tags[before] in gone:
+        before -= 1
+    index = (_find(merged, tags[before], before + drift) + 1
+             if before >= 0 else 0)
+    # after events the other history created in the same place, if they
+    # start no later
+    while (index < len(merged) and length <= merged[index] < first_theirs and
+           result[index]['start'] <= op.event['start']):
+        index += 1
+    return index, 'apply'
+
+def _conflicts(clashes, theirs, ours, our_concerns):
+    """Returns the Conflicts for operations left out by _transform,
+       gathering those whose ranges overlap, with the operations of the other
+       history, ours, concerning each range, as found by our_concerns."""
+    ranges = [] # [start, stop, positions of the operations in theirs]
+    for start, stop, position in sorted(clashes):
+        if ranges and start < ranges[-1][1]:
+            ranges[-1][1] = max(stop, ranges[-1][1])
+            ranges[-1][2].append(position)
+        else:
+            ranges.append([start, stop, [position]])
+    conflicts = []
+    for start, stop, positions in ranges:
+        our_positions = set(p for tag in range(start, stop)
+                            for p in our_concerns.get(tag, ()))
+        conflicts.append(Conflict(start, stop,
+                                  [ours[p] for p in sorted(our_positions)],
+                                  [theirs[p] for p in sorted(positions)]))
+    return conflicts
+
+def merge(labels, ops, other_ops):
+    """Merges two histories of operations made against the same labels.
+       
+       labels -- list of event dicts, or table with to_dicts(); not modified
+       ops, other_ops -- iterables of operations, each made against labels
+       
+       Returns a Merge: ops, the first history followed by the second's
+       operations transformed to apply after it; conflicts, a list of
+       Conflicts in order; and labels, the result of applying ops to a copy
+       of labels. Each group or bulk operation of the second history is
+       kept or left out whole, and is kept as a group of operations on one
+       event each.
+       
+       Events are followed through each history, so an operation of the
+       second history is moved to wherever its events are once the first
+       has been applied. The histories conflict over an original event if
+       both change it, unless they only set different columns, or set a
+       column to the same value, or both delete it; an edit made by both is
+       kept once. So is a merge, split or creation both make, with the same
+       values, of the same events (for a creation, after the same event).
+       Operations on an event the first history merged, split or deleted
+       otherwise, or which need neighbours the first history separated, also
+       conflict. The first history's edits are kept in a conflict, and the
+       second's are left out, along with later operations on events they
+       would have created. Other events created by both histories in the
+       same place are ordered by start time."""
+    events = _event_list(labels)
+    length = len(events)
+    ops = [compile_op(op) for op in ops]
+    new_tags = itertools.count(length)
+    ours = _trace(ops, length, new_tags, {})
+    result = _BlockList(events)
+    copied = set()
+    for unit in ours.units:
+        for op in unit:
+            _apply_copying(op, result, copied)
+    theirs, out, clashes = _transform(other_ops, length, ours.tags, result,
+                                      copied, None, ours.removed, new_tags,
+                                      ours=ours)
+    return Merge(ops + out, _conflicts(clashes, theirs, ops, ours.concerns),
+                 list(result))
+
+def _apply_copying(op, labels, copied):
+    """Applies a single-event operation to labels, first copying the event
+       it changes unless its id is in the set copied."""
+    if op.removed and id(labels[op.index]) not in copied:
+        labels[op.index] = _copy_event(labels[op.index])
+        copied.add(id(labels[op.index]))
+    op.apply(labels)
+
+def merge_ops_files(labels, ops_files, ops_file, **kwargs):
+    """Merges operations files made against the same labels into one.
+       
+       labels -- list of event dicts, or table with to_dicts(), which each
+                 file was made against; not modified
+       ops_files -- filenames; each is merged after those before it, as the
+                    second history of merge(), so in a conflict the edits
+                    of the earlier files are kept
+       ops_file -- filename to write the merged operations and metadata to
+       kwargs -- passed to the EditStack writing ops_file
+       
+       Returns a list of the Conflicts found. Raises ValueError if the
+       hash_pre of a file doesn't match labels."""
+    events = _event_list(labels)
+    ops = []
+    conflicts = []
+    for file in ops_files:
+        stack = EditStack([_copy_event(event) for event in events], file,
+                          load=True)
+        result = merge(events, ops, stack.undo_stack)
+        ops = result.ops
+        conflicts.extend(result.conflicts)
+    stack = EditStack([_copy_event(event) for event in events], ops_file,
+                      load=False, **kwargs)
+    for op in ops:
+        stack.push(op)
+    stack.write_to_file()
+    return conflicts
+
+
+# rebasing
+
+def _align(old, new, new_tags):
+    """Matches the events of new to those of old by time.
+       
+       Events shared at the start and end are matched, and the rest are
+       swept through once, matching each pair of overlapping events unless
+       either overlaps its other neighbour more.
+       
+       Returns a tag for each event in new: the index of its match in old,
+       or a number from new_tags; for each event in old, _DELETED if it is
+       unmatched, or else a dict of the values in new of its name, start and
+       stop which differ, if any; and the set of unmatched events in old."""
+    i = 0
+    n = min(len(old), len(new))
+    while i < n and old[i] == new[i]:
+        i += 1
+    end = 0
+    while end < n - i and old[-1 - end] == new[-1 - end]:
+        end += 1
+    old_stop, new_stop = len(old) - end, len(new) - end
+    tags = list(range(i))
+    changes = {}
+    gone = set()
+    j = i
+    while i < old_stop and j < new_stop:
+        event, new_event = old[i], new[j]
+        if event != new_event:
+            if event['stop'] <= new_event['start']:
+                changes[i] = _DELETED
+                gone.add(i)
+                i += 1
+                continue
+            if new_event['stop'] <= event['start']:
+                tags.append(next(new_tags))
+                j += 1
+                continue
+            # neighbours only compete for a match if they overlap too
+            following = old[i + 1] if i + 1 < old_stop else None
+            new_following = new[j + 1] if j + 1 < new_stop else None
+            if following is not None and (following['start'] <
+                                          new_event['stop']):
+                if (_overlap(following, new_event) >
+                        _overlap(event, new_event)):
+                    changes[i] = _DELETED
+                    gone.add(i)
+                    i += 1
+                    continue
+            if new_following is not None and (new_following['start'] <
+                                              event['stop']):
+                if (_overlap(event, new_following) >
+                        _overlap(event, new_event)):
+                    tags.append(next(new_tags))
+                    j += 1
+                    continue
+            values = {}
+            for column in _BOUNDARY_NAME:
+                if event[column] != new_event[column]:
+                    values[column] = new_event[column]
+            if values:
+                changes[i] = values
+        tags.append(i)
+        i += 1
+        j += 1
+    gone.update(range(i, old_stop))
+    changes.update((k, _DELETED) for k in range(i, old_stop))
+    tags.extend(next(new_tags) for _ in range(j, new_stop))
+    tags.extend(range(old_stop, len(old)))
+    return tags, changes, gone
+
+def _overlap(event, other):
+    """Returns the length of time two events share."""
+    return (min(event['stop'], other['stop']) -
+            max(event['start'], other['start']))
+
+def rebase(old_labels, new_labels, ops):
+    """Moves a history of operations made against old_labels onto
+       new_labels, such as a regenerated version of the same labels.
+       
+       old_labels, new_labels -- lists of event dicts, or tables with
+                                 to_dicts(), ordered by start time; not
+                                 modified
+       ops -- iterable of operations made against old_labels
+       
+       Returns a Merge: ops, to apply to new_labels; conflicts, a list of
+       Conflicts (with no ops of their own) for the operations left out;
+       and labels, the result of applying ops to a copy of new_labels.
+       Each group or bulk operation is kept or left out whole, and is kept
+       as a group of operations on one event each.
+       
+       The events of the two label lists are matched by time, and each
+       operation is moved to the new event matching its own, taking that
+       event's values as its target. Setting a name, start or stop which
+       differs between the two lists conflicts, unless the history leaves
+       it as in new_labels, when it is dropped; so does any operation on an
+       event with no match, except deleting it. Merging events no longer
+       neighbours, splitting an event at a point no longer within it, and
+       operations on events created by operations left out also conflict.
+       The cost grows with the length of the lists plus the length of the
+       history."""
+    old = _event_list(old_labels)
+    new = _event_list(new_labels)
+    length = len(old)
+    new_tags = itertools.count(length)
+    merged, changes, gone = _align(old, new, new_tags)
+    result = _BlockList(new)
+    theirs, out, clashes = _transform(ops, length, _BlockList(merged), result,
+                                      set(), changes, gone, new_tags,
+                                      strict=False)
+    return Merge(out, _conflicts(clashes, theirs, [], {}), list(result))
+
+
+# thread safety
+
+Snapshot = collections.namedtuple('Snapshot', ['revision', 'hash_pre',
+                                               'current_hash', 'undo_ops',
+                                               'redo_ops', 'labels'])
+
+class RWLock(object):
+    """Readers-writer lock: held for reading by any number of threads at
+       once, or for writing by one thread alone.
+       
+       Waiting writers are served before new readers, so readers cannot
+       starve a writer. The lock is reentrant: a thread holding it may take
+       it again for reading, and a thread holding it for writing may take it
+       again for writing. A thread holding it only for reading may not take
+       it for writing (RuntimeError), as two threads doing so would wait on
+       each other forever."""
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {} # thread -> depth of its read holds
+        self._writer = None
+        self._depth = 0 # depth of the writer's write holds
+        self._waiting = 0 # number of writers waiting
+    
+    def read(self):
+        """Returns a context manager holding the lock for reading."""
+        return _Held(self.acquire_read, self.release_read)
+    
+    def write(self):
+        """Returns a context manager holding the lock for writing."""
+        return _Held(self.acquire_write, self.release_write)
+    
+    def acquire_read(self):
+        me = threading.current_thread()
+        with self._cond:
+            if not (self._writer is me or me in self._readers):
+                while self._writer is not None or self._waiting:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+    
+    def release_read(self):
+        me = threading.current_thread()
+        with self._cond:
+            depth = self._readers.get(me)
+            if not depth:
+                raise RuntimeError('lock not held for reading')
+            if depth > 1:
+                self._readers[me] = depth - 1
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+    
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is me:
+                self._depth += 1
+                return
+            if me in self._readers:
+                raise RuntimeError('lock held for reading; cannot write')
+            self._waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+                if not self._waiting:
+                    self._cond.notify_all() # let waiting readers check
+            self._writer = me
+            self._depth = 1
+    
+    def release_write(self):
+        with self._cond:
+            if self._writer is not threading.current_thread():
+                raise RuntimeError('lock not held for writing')
+            self._depth -= 1
+            if not self._depth:
+                self._writer = None
+                self._cond.notify_all()
+
+class Autosaver(object):
+    """Calls a save function on a background thread after edits, once they
+       pause or pile up, so a burst of edits is saved by one call.
+       
+       An error raised by an autosave is logged and kept in error, and the
+       save is tried again after delay seconds (or one second)."""
+    def __init__(self, save, delay=None, max_edits=None):
+        """Creates an Autosaver, and starts its thread.
+           
+           save -- callable taking no arguments
+           delay -- number of seconds; if present, save once no edit has
+                    been made for this long
+           max_edits -- int; if present, save once this many edits have
+                        been made since the last save began"""
+        self.save = save
+        self.delay = delay
+        self.max_edits = max_edits
+        self.error = None
+        self._cond = threading.Condition(threading.Lock())
+        self._edits = 0 # edits since the last save began
+        self._last = None # clock time of the last edit
+        self._retry = None # clock time before which not to retry a save
+        self._saving = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='eventedit-autosave')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def changed(self):
+        """Records an edit."""
+        with self._cond:
+            self._edits += 1
+            self._last = _clock()
+            self._cond.notify_all()
+    
+    def flush(self):
+        """Saves any unsaved edits in this thread, after waiting for a save
+           under way to finish. Errors are raised, rather than kept."""
+        with self._cond:
+            edits = self._begin_save()
+        if edits:
+            self._save(edits, raise_errors=True)
+    
+    def close(self, flush=True):
+        """Stops the thread, after flushing if flush is True."""
+        if flush:
+            self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+    
+    def _begin_save(self):
+        """Waits for a save under way, then claims the edits to be saved."""
+        while self._saving:
+            self._cond.wait()
+        edits, self._edits = self._edits, 0
+        self._saving = bool(edits)
+        return edits
+    
+    def _wait(self):
+        """Waits until a save is due, returning the edits to save, or 0 if
+           the Autosaver is closed."""
+        with self._cond:
+            while not self._closed:
+                due = None
+                if self._edits and not self._saving:
+                    if self.max_edits and self._edits >= self.max_edits:
+                        due = self._last
+                    elif self.delay is not None:
+                        due = self._last + self.delay
+                    if due is not None and self._retry is not None:
+                        due = max(due, self._retry)
+                timeout = None if due is None else due - _clock()
+                if timeout is not None and timeout <= 0:
+                    return self._begin_save()
+                self._cond.wait(timeout)
+            return 0
+    
+    def _run(self):
+        while True:
+            edits = self._wait()
+            if not edits:
+                return
+            self._save(edits)
+    
+    def _save(self, edits, raise_errors=False):
+        try:
+            self.save()
+            self.error = self._retry = None
+        except Exception as e:
+            self.error = e
+            with self._cond:
+                self._edits += edits
+                self._retry = _clock() + (self.delay or 1.0)
+            if raise_errors:
+                raise
+            import logging
+            logging.getLogger('eventedit').exception('autosave failed')
+        finally:
+            with self._cond:
+                self._saving = False
+                self._cond.notify_all()
+
+class _Held(object):
+    __slots__ = ('acquire', 'release')
+    
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+    
+    def __enter__(self):
+        self.acquire()
+    
+    def __exit__(self, exc_type, exc_value, exc_trace):
+        self.release()
+
+# instrumentation
+
+try:
+    _clock = time.perf_counter
+except AttributeError: # python 2/3 support
+    _clock = time.time
+
+class Stats(object):
+    """Counts and total times of named events."""
+    def __init__(self, hook=None):
+        """Creates a Stats.
+           
+           hook -- callable; if present, called as hook(name, seconds) after
+                   each event"""
+        self.hook = hook
+        self._counts = collections.Counter()
+        self._seconds = collections.defaultdict(float)
+    
+    def timer(self, name):
+        """Returns a context manager which records its block as name."""
+        return _Timer(self, name)
+    
+    def record(self, name, seconds):
+        self._counts[name] += 1
+        self._seconds[name] += seconds
+        if self.hook is not None:
+            self.hook(name, seconds)
+    
+    def snapshot(self):
+        """Returns a dict mapping each event name to its count and seconds."""
+        return {name: {'count': count, 'seconds': self._seconds[name]}
+                for name, count in self._counts.items()}
+    
+    def reset(self):
+        self._counts.clear()
+        self._seconds.clear()
+
+class _Timer(object):
+    __slots__ = ('stats', 'name', 'start')
+    
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+    
+    def __enter__(self):
+        self.start = _clock()
+    
+    def __exit__(self, exc_type, exc_value, exc_trace):
+        self.stats.record(self.name, _clock() - self.start)
+
+class _NoTimer(object):
+    __slots__ = ()
+    
+    def __enter__(self):
+        pass
+    
+    def __exit__(self, exc_type, exc_value, exc_trace):
+        pass
+
+_NO_TIMER = _NoTimer()
+_NO_LOCK = _NO_TIMER # does nothing, for stacks which aren't thread-safe
+
+def logging_hook(logger=None, level=None):
+    """Returns a stats hook which logs each event.
+       
+       logger -- logging.Logger; if not present, the 'eventedit' logger
+       level -- logging level of the messages; if not present, DEBUG"""
+    import logging
+    if logger is None:
+        logger = logging.getLogger('eventedit')
+    if level is None:
+        level = logging.DEBUG
+    def hook(name, seconds):
+        logger.log(level, '%s %.6fs', name, seconds)
+    return hook
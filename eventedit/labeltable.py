@@ -0,0 +1,360 @@
+import numbers
+try:
+    from collections.abc import Mapping
+except ImportError: # python 2/3 support
+    from collections import Mapping
+
+np = None # numpy is optional, and slow to import, so see _import_numpy
+
+def _import_numpy():
+    """Imports numpy, the first time a LabelTable is made."""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('LabelTable requires numpy')
+        np = numpy
+
+class _Missing(object):
+    """Marks a row which has no value in an extra column."""
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'
+
+MISSING = _Missing()
+
+class LabelTable(object):
+    """Event data stored column-wise.
+
+       start and stop are contiguous float arrays, name is stored as integer
+       codes into a list of categories, and every other column is stored as
+       its own object array. Rows missing an extra column hold MISSING.
+
+       Supports the indexing semantics the raw operations rely on, so it may
+       be used in place of a list of dicts: table[i] returns a mutable view
+       of a row, and insert(), pop() and len() behave as for lists. Start and
+       stop values are stored as floats, but returned as they were given:
+       integers as ints (exactly, up to 2**53) and None as None, so the
+       events hash as the same list of dicts would."""
+
+    def __init__(self, events=()):
+        """Creates a LabelTable.
+
+           events -- iterable of dicts denoting event data"""
+        _import_numpy()
+        self._n = 0
+        self._start = np.empty(0, dtype=np.float64)
+        self._stop = np.empty(0, dtype=np.float64)
+        self._start_kind = np.empty(0, dtype=np.int8)
+        self._stop_kind = np.empty(0, dtype=np.int8)
+        self._codes = np.empty(0, dtype=np.int32)
+        self._categories = []
+        self._category_codes = {}
+        self._extra = {}
+        self._assign(list(events))
+
+    def _assign(self, events):
+        """Replaces the table's contents with a list of event dicts."""
+        n = len(events)
+        self._n = n
+        self._start, self._start_kind = _boundary_arrays(
+            [e['start'] for e in events])
+        self._stop, self._stop_kind = _boundary_arrays(
+            [e['stop'] for e in events])
+        self._codes = np.array([self._code(e['name']) for e in events],
+                               dtype=np.int32)
+        self._extra = {}
+        for i, e in enumerate(events):
+            for k, v in e.items():
+                if k not in self._extra and k not in ('start', 'stop', 'name'):
+                    self._add_column(k)
+                if k in self._extra:
+                    self._extra[k][i] = v
+
+    def _code(self, name):
+        """Returns the category code for a name, adding it if necessary."""
+        try:
+            return self._category_codes[name]
+        except KeyError:
+            self._category_codes[name] = len(self._categories)
+            self._categories.append(name)
+            return self._category_codes[name]
+
+    def _add_column(self, column):
+        """Adds an extra column, missing for every existing row."""
+        values = np.empty(len(self._start), dtype=object)
+        values.fill(MISSING)
+        self._extra[column] = values
+
+    def _reserve(self, size):
+        """Ensures every column has room for size rows."""
+        if size <= len(self._start):
+            return
+        capacity = max(size, 2 * len(self._start), 16)
+        def grow(arr):
+            new = np.empty(capacity, dtype=arr.dtype)
+            new[:self._n] = arr[:self._n]
+            return new
+        self._start = grow(self._start)
+        self._stop = grow(self._stop)
+        self._start_kind = grow(self._start_kind)
+        self._stop_kind = grow(self._stop_kind)
+        self._codes = grow(self._codes)
+        for k in self._extra:
+            self._extra[k] = grow(self._extra[k])
+            self._extra[k][self._n:].fill(MISSING)
+
+    def _columns(self):
+        return ([self._start, self._stop, self._start_kind, self._stop_kind,
+                 self._codes] + list(self._extra.values()))
+
+    def _check(self, index):
+        """Normalizes an index, raising IndexError if it is out of range."""
+        if index < 0:
+            index += self._n
+        if not 0 <= index < self._n:
+            raise IndexError('LabelTable index out of range')
+        return index
+
+    # column access
+
+    @property
+    def start(self):
+        """Array of event start times."""
+        return self._start[:self._n]
+
+    @property
+    def stop(self):
+        """Array of event stop times."""
+        return self._stop[:self._n]
+
+    @property
+    def names(self):
+        """Object array of event names."""
+        categories = np.array(self._categories + [None], dtype=object)
+        return categories[self._codes[:self._n]]
+
+    @property
+    def columns(self):
+        """List of column names."""
+        return ['start', 'stop', 'name'] + list(self._extra.keys())
+
+    def column(self, column):
+        """Returns an array of a column's values, in row order."""
+        if column == 'start':
+            return self.start
+        elif column == 'stop':
+            return self.stop
+        elif column == 'name':
+            return self.names
+        return self._extra[column][:self._n]
+
+    def durations(self):
+        """Returns an array of event durations."""
+        return self.stop - self.start
+
+    # time queries
+
+    def at(self, t):
+        """Returns the indices of the events containing time t."""
+        return np.flatnonzero((self.start <= t) & (t < self.stop))
+
+    def overlapping(self, t0, t1):
+        """Returns the indices of the events overlapping [t0, t1)."""
+        return np.flatnonzero((self.start < t1) & (self.stop > t0))
+
+    # list interface
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield _Row(self, i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._n)
+            table = LabelTable()
+            rows = np.arange(start, stop, step)
+            table._n = len(rows)
+            table._start = self._start[rows]
+            table._stop = self._stop[rows]
+            table._start_kind = self._start_kind[rows]
+            table._stop_kind = self._stop_kind[rows]
+            table._codes = self._codes[rows]
+            table._categories = list(self._categories)
+            table._category_codes = dict(self._category_codes)
+            table._extra = {k: v[rows] for k, v in self._extra.items()}
+            return table
+        return _Row(self, self._check(index))
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            if index != slice(None):
+                raise ValueError('only whole-table slice assignment allowed')
+            self._assign(_event_dicts(value))
+            return
+        index = self._check(index)
+        for k in self._extra:
+            self._extra[k][index] = MISSING
+        self._set_row(index, value)
+
+    def _set_row(self, index, event):
+        self._start[index], self._start_kind[index] = _boundary(event['start'])
+        self._stop[index], self._stop_kind[index] = _boundary(event['stop'])
+        self._codes[index] = self._code(event['name'])
+        for k, v in event.items():
+            if k not in ('start', 'stop', 'name'):
+                if k not in self._extra:
+                    self._add_column(k)
+                self._extra[k][index] = v
+
+    def insert(self, index, event):
+        """Inserts an event (a dict) before index."""
+        if index < 0:
+            index = max(index + self._n, 0)
+        index = min(index, self._n)
+        self._reserve(self._n + 1)
+        for arr in self._columns():
+            arr[(index + 1):(self._n + 1)] = arr[index:self._n]
+        for k in self._extra:
+            self._extra[k][index] = MISSING
+        self._n += 1
+        self._set_row(index, event)
+
+    def append(self, event):
+        self.insert(self._n, event)
+
+    def pop(self, index=-1):
+        """Removes the event at index, and returns it as a dict."""
+        index = self._check(index)
+        event = dict(_Row(self, index))
+        for arr in self._columns():
+            arr[index:(self._n - 1)] = arr[(index + 1):self._n]
+        self._n -= 1
+        for k in self._extra:
+            self._extra[k][self._n] = MISSING
+        return event
+
+    def to_dicts(self):
+        """Returns the events as a list of dicts."""
+        keys = ['start', 'stop', 'name']
+        columns = [_boundary_list(self.start, self._start_kind[:self._n]),
+                   _boundary_list(self.stop, self._stop_kind[:self._n]),
+                   self.names.tolist()]
+        keys.extend(self._extra.keys())
+        columns.extend(v[:self._n].tolist() for v in self._extra.values())
+        events = [dict(zip(keys, row)) for row in zip(*columns)]
+        for k, values in zip(keys[3:], columns[3:]):
+            for event, v in zip(events, values):
+                if v is MISSING:
+                    del event[k]
+        return events
+
+    def __eq__(self, other):
+        return _event_dicts(self) == _event_dicts(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LabelTable(' + repr(self.to_dicts()) + ')'
+
+
+class _Row(Mapping):
+    """Mutable view of one row of a LabelTable.
+
+       Only valid until rows are inserted or removed before it."""
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, column):
+        table = self._table
+        if column == 'start':
+            return _value(table._start[self._index],
+                          table._start_kind[self._index])
+        elif column == 'stop':
+            return _value(table._stop[self._index],
+                          table._stop_kind[self._index])
+        elif column == 'name':
+            return table._categories[table._codes[self._index]]
+        value = table._extra[column][self._index]
+        if value is MISSING:
+            raise KeyError(column)
+        return value
+
+    def __setitem__(self, column, value):
+        table = self._table
+        index = self._index
+        if column == 'start':
+            table._start[index], table._start_kind[index] = _boundary(value)
+        elif column == 'stop':
+            table._stop[index], table._stop_kind[index] = _boundary(value)
+        elif column == 'name':
+            table._codes[self._index] = table._code(value)
+        else:
+            if column not in table._extra:
+                table._add_column(column)
+            table._extra[column][self._index] = value
+
+    def __iter__(self):
+        for k in ('start', 'stop', 'name'):
+            yield k
+        for k, values in self._table._extra.items():
+            if values[self._index] is not MISSING:
+                yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __deepcopy__(self, memo):
+        import copy
+        return copy.deepcopy(dict(self), memo)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+_FLOAT, _INT, _NONE = 0, 1, 2 # the kinds of boundary value
+
+def _boundary(value):
+    """Converts a boundary value for storage, as a float and its kind; None
+       is stored as NaN."""
+    if value is None:
+        return float('nan'), _NONE
+    elif isinstance(value, numbers.Integral) and not isinstance(value, bool):
+        return float(value), _INT
+    return float(value), _FLOAT
+
+def _boundary_arrays(values):
+    """Converts a list of boundary values to arrays of floats and kinds."""
+    converted = [_boundary(v) for v in values]
+    return (np.array([v for v, _ in converted], dtype=np.float64),
+            np.array([k for _, k in converted], dtype=np.int8))
+
+def _value(value, kind):
+    """Returns a stored boundary value as the kind it was given as."""
+    if kind == _FLOAT:
+        return float(value)
+    elif kind == _INT:
+        return int(value)
+    return None
+
+def _boundary_list(values, kinds):
+    """Returns arrays of stored boundary values and kinds as a list."""
+    if not kinds.any(): # all floats
+        return values.tolist()
+    return [_value(v, k) for v, k in zip(values.tolist(), kinds.tolist())]
+
+def _event_dicts(events):
+    """Returns a LabelTable or iterable of event dicts as a list of dicts."""
+    if isinstance(events, LabelTable):
+        return events.to_dicts()
+    return [dict(e) for e in events]
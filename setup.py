@@ -18,4 +18,7 @@ setup(name='eventedit',
       license='GPL',
       packages=['eventedit'],
       install_requires=['pyyaml',],
+      extras_require={'table': ['numpy']},
+      entry_points={'console_scripts':
+                    ['eventedit-batch=eventedit.batch:main']},
       zip_safe=False)
@@ -0,0 +1,63 @@
+import pytest
+import os
+import copy
+import eventedit.eventedit as eved
+from eventedit import batch
+from test_eventedit import TEST_LABELS
+
+def make_label_file(path, labels=TEST_LABELS):
+    batch.write_labels(path, labels, ['start', 'stop', 'name'])
+    labels, _ = batch.read_labels(path)
+    return labels
+
+def make_pair(path, edit):
+    labels = make_label_file(path)
+    cs = eved.EditStack(labels=labels, ops_file=path + '.corr', load=False)
+    edit(cs)
+    cs.write_to_file()
+    return cs.labels
+
+def test_read_and_write_labels(tmpdir):
+    path = tmpdir.join('a.csv').strpath
+    labels = make_label_file(path)
+    assert labels == TEST_LABELS
+    with open(path) as fp:
+        assert fp.readline().strip() == 'start,stop,name,tier'
+    labels, columns = batch.read_labels(path)
+    assert columns == ['start', 'stop', 'name', 'tier']
+
+def test_apply_batch(tmpdir):
+    subdir = tmpdir.mkdir('sub')
+    good = make_pair(tmpdir.join('a.csv').strpath,
+                     lambda cs: (cs.rename(0, 'q'), cs.split(1, 3.0)))
+    good2 = make_pair(subdir.join('b.csv').strpath,
+                      lambda cs: cs.delete(2))
+    # labels relabeled since the corrections were made
+    make_pair(tmpdir.join('c.csv').strpath, lambda cs: cs.rename(0, 'q'))
+    changed = copy.deepcopy(TEST_LABELS)
+    changed[3]['name'] = 'z'
+    make_label_file(tmpdir.join('c.csv').strpath, changed)
+    # ops file without labels is ignored
+    make_pair(tmpdir.join('d.csv').strpath, lambda cs: cs.rename(0, 'q'))
+    os.remove(tmpdir.join('d.csv').strpath)
+    tmpdir.join('a.csv.meta.yaml').write('units: s\n')
+    
+    pairs = batch.find_pairs(tmpdir.strpath)
+    assert [os.path.basename(l) for l, _ in pairs] == ['a.csv', 'c.csv',
+                                                      'b.csv']
+    for workers in (1, 2):
+        results = batch.apply_batch(pairs, workers=workers)
+        assert [r.ok for r in results] == [True, False, True]
+        assert results[0].n_ops == 2
+        assert results[0].output_file == tmpdir.join('a.corrected.csv').strpath
+        assert 'hash' in results[1].error
+        assert results[1].output_file is None
+        assert batch.read_labels(results[0].output_file)[0] == good
+        assert batch.read_labels(results[2].output_file)[0] == good2
+        assert tmpdir.join('a.corrected.csv.meta.yaml').read() == 'units: s\n'
+    
+    assert batch.main([tmpdir.strpath, '--workers', '1']) == 1
+    os.remove(tmpdir.join('c.csv.corr').strpath)
+    assert batch.main([tmpdir.strpath, '-w', '2',
+                       '--output-suffix', '.fixed']) == 0
+    assert os.path.exists(subdir.join('b.fixed.csv').strpath)
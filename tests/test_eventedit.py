@@ -1,8 +1,15 @@
 import pytest
 import copy
+import hashlib
+import io
+import json
 import eventedit.eventedit as eved
 import os
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import yaml
 
 TEST_COMMAND = '(set-name (interval 3 4.7 5.0 "d" "focus_bird") "b")'
@@ -103,6 +110,12 @@ def test_tokenize():
     tkns = eved.tokenize('string "(can) contain parentheses"')
     assert len(tkns) == 2
     assert tkns[1] == '"(can) contain parentheses"'
+    
+    with pytest.raises(ValueError):
+        eved.tokenize('(set-name "a"b)')
+    
+    with pytest.raises(ValueError):
+        eved.tokenize('(set-name a"b")')
 
 def test_atomize():
     assert eved.atomize('1') == 1
@@ -111,6 +124,12 @@ def test_atomize():
     assert eved.atomize('"focus_bird"') == 'focus_bird'
     assert isinstance(eved.atomize('set-name'), eved.Symbol)
     assert eved.atomize('set-name') == 'set_name'
+    # the reader behind parse and iter_parse agrees with atomize
+    for token in ['1', '-1', '+5', '1_000', '1.5', '-2e3', 'inf', u'\u00b2',
+                  'set-name', '#:new-name']:
+        atom = eved.parse(token)
+        assert atom == eved.atomize(token)
+        assert type(atom) is type(eved.atomize(token))
 
 def test_parse_and_read_from_tokens():
     with pytest.raises(SyntaxError):
@@ -119,6 +138,13 @@ def test_parse_and_read_from_tokens():
     with pytest.raises(SyntaxError):
         eved.read_from_tokens([')'])
     
+    with pytest.raises(SyntaxError):
+        eved.read_from_tokens(['(', 'a'])
+    
+    token_list = ['(', 'a', ')', '(', 'b', ')']
+    assert eved.read_from_tokens(token_list) == ['a']
+    assert token_list == ['(', 'b', ')']
+    
     nested_list = eved.parse(TEST_COMMAND)
     assert len(nested_list) == 3
     assert len(nested_list[1]) == 6
@@ -126,6 +152,52 @@ def test_parse_and_read_from_tokens():
     assert nested_list[1][0] == 'interval'
     assert nested_list[1][5] == 'focus_bird'
 
+def test_iter_parse():
+    import io
+    text = '\n'.join(TEST_OPS + ['', TEST_COMMAND, '(a\n  (b "c d)"))', '7'])
+    expected = [eved.parse(op) for op in TEST_OPS]
+    expected += [eved.parse(TEST_COMMAND), eved.parse('(a (b "c d)"))'), 7]
+    for chunk_size in (1, 3, 16, 65536):
+        s_exprs = list(eved.iter_parse(io.StringIO(text), chunk_size))
+        assert s_exprs == expected
+    assert isinstance(s_exprs[0], eved.SExpr)
+    
+    assert list(eved.iter_parse(io.StringIO(''))) == []
+    
+    with pytest.raises(SyntaxError):
+        list(eved.iter_parse(io.StringIO(TEST_OPS[0] + '\n(a (b')))
+    
+    with pytest.raises(SyntaxError):
+        list(eved.iter_parse(io.StringIO('(a))')))
+    
+    with pytest.raises(SyntaxError):
+        list(eved.iter_parse(io.StringIO('(a "b')))
+
+def test_binary_format():
+    ops = [eved.parse(op) for op in TEST_OPS]
+    ops += [eved.parse(TEST_COMMAND), eved.parse('(a (b null -7 1e300) "")'),
+            eved.parse('(#:a ' + str(2 ** 70) + ' -0.0)'), 7]
+    fp = io.BytesIO()
+    eved.write_binary(ops, fp)
+    data = fp.getvalue()
+    assert data.startswith(eved.BINARY_MAGIC)
+    for chunk_size in (1, 3, 65536):
+        read = list(eved.iter_read_binary(io.BytesIO(data), chunk_size))
+        assert read == ops
+        assert [eved.deparse(op) for op in read[:-1]] == \
+               [eved.deparse(op) for op in ops[:-1]]
+    assert isinstance(read[0], eved.SExpr)
+    assert isinstance(read[0][1], eved.KeyArg)
+    assert read[0][1] is read[1][1] # keywords are interned
+    assert type(read[4][1]) is int and type(read[4][2]) is float
+    
+    with pytest.raises(SyntaxError):
+        list(eved.iter_read_binary(io.BytesIO(data[:-1])))
+    with pytest.raises(ValueError):
+        list(eved.iter_read_binary(io.BytesIO(TEST_OPS[0].encode())))
+    with pytest.raises(ValueError):
+        eved.write_binary([[object()]], io.BytesIO())
+
 def test_evaluate():
     def complex_proc(**kwargs):
         for a in kwargs:
@@ -179,8 +251,595 @@ def test_whole_stack():
     assert len(labels) == len(TEST_LABELS)
     assert labels[1]['stop'] == TEST_LABELS[1]['stop']
 
+def test_compile_op():
+    cmds = ["""(set-name #:target (interval #:index 0 #:name "a") #:new-name "b")""",
+            """(set-start #:target (interval #:index 1 #:start 2.1) #:new-start 2.2)""",
+            """(merge-next #:target (interval #:index 1 #:name "b" #:stop 3.5 #:next-start 3.5 #:next-name "c") #:new-stop null #:new-next-start null)""",
+            """(split #:target (interval #:index 1 #:name "b" #:stop null #:next-start null #:next-name "b") #:new-stop 3.5 #:new-next-start 3.5)""",
+            """(delete #:target (interval #:index 3 #:start 4.7 #:stop 5.0 #:name "d" #:tier "tier3"))""",
+            """(create #:target (interval #:index 0 #:start 0.5 #:stop 0.9 #:name "q" #:tier "spam"))"""]
+    interpreted = copy.deepcopy(TEST_LABELS)
+    compiled = copy.deepcopy(TEST_LABELS)
+    test_env = eved.make_env(labels=interpreted)
+    for cmd in cmds:
+        eved.evaluate(eved.parse(cmd), test_env)
+        eved.compile_op(eved.parse(cmd)).apply(compiled)
+        assert compiled == interpreted
+    
+    # compiled form is cached on the s-expression, and can be reapplied
+    s_expr = eved.parse(cmds[-1])
+    code = eved.compile_op(s_expr)
+    assert code.kind == 'create'
+    assert eved.compile_op(s_expr) is code
+    code.apply(compiled)
+    code.apply(compiled)
+    assert compiled[0]['name'] == 'q'
+    assert compiled[1]['name'] == 'q'
+    assert 'index' not in compiled[0]
+    
+    # inversion leaves s_expr, and so the cached form, unchanged
+    eved.invert(s_expr)
+    assert s_expr == eved.parse(cmds[-1])
+    assert eved.compile_op(s_expr) is code
+    
+    with pytest.raises(ValueError):
+        eved.compile_op(eved.parse('(delete #:target spam)'))
+
+def test_Op():
+    labels = copy.deepcopy(TEST_LABELS)
+    cs = eved.EditStack(labels=labels, ops_file='unused', load=False)
+    ops = [cs.codegen_rename(0, 'q'),
+           cs.codegen_set_start(1, 2.0),
+           cs.codegen_set_stop(1, 3.0),
+           cs.codegen_merge_next(1),
+           cs.codegen_split(1, 3.0),
+           cs.codegen_delete(3),
+           cs.codegen_create(4, 5.5, 6.0, 'e', tier='tier4')]
+    kinds = [eved.SetName, eved.SetStart, eved.SetStop, eved.MergeNext,
+             eved.Split, eved.Delete, eved.Create]
+    for op, kind in zip(ops, kinds):
+        assert type(op) is kind
+        assert not hasattr(op, '__dict__')
+        s_expr = eved.parse(eved.deparse(op))
+        assert op == s_expr
+        assert s_expr == op
+        assert eved.compile_op(s_expr) == op
+        assert op.inverse().inverse() == op
+        inv = op.inverse()
+        assert op.inverse() is inv # inverse is cached
+        assert inv.inverse() is op
+        assert op.inverse() == eved.invert(op.to_sexpr())
+    
+    assert ops[0] == eved.parse(TEST_OPS[0])
+    assert ops[0] != eved.parse(TEST_OPS[1])
+    assert ops[0] != ops[1]
+    assert ops[0] != 'spam'
+    assert ops[5].inverse().event == ops[5].event
+    
+    for op in ops:
+        cs.push(op)
+        cs.undo()
+        assert cs.labels == TEST_LABELS
+    cs.push(eved.parse(TEST_OPS[0]))
+    assert isinstance(cs.peek(), eved.SetName)
+    
+    # operations outside the generated layouts can't be converted
+    with pytest.raises(ValueError):
+        eved.compile_op(eved.parse('(set-name #:target (interval #:index 0 #:name "a" #:stop 1.0) #:new-name "b")'))
+    with pytest.raises(ValueError):
+        eved.compile_op(eved.parse('(spam #:target (interval #:index 0))'))
+
+def test_bulk_ops():
+    labels = make_labels(12)
+    labels[4]['stop'] = 4.001
+    cs = eved.EditStack(labels=copy.deepcopy(labels), ops_file='unused',
+                        load=False, checkpoint_interval=2)
+    assert cs.select(name='a') == [0, 2, 4, 6, 8, 10]
+    assert cs.select(name='a', tier='tier0') == [0, 6]
+    assert cs.select(max_duration=0.01) == [4]
+    assert cs.select(min_duration=0.01, t0=2.2, t1=5.0) == [2, 3]
+    assert cs.select(t1=1.0) == [0]
+    assert cs.select(lambda e: e['start'] > 9, name='b') == [11]
+    assert cs.select(spam='eggs') == []
+
+    ops = [cs.codegen_rename_many([6, 0, -2], 'c'),
+           cs.codegen_delete_many([5, 1, 9]),
+           cs.codegen_delete_many([5, 1, 9]).inverse()]
+    kinds = [eved.SetNameMany, eved.DeleteMany, eved.CreateMany]
+    for op, kind in zip(ops, kinds):
+        assert type(op) is kind
+        assert not hasattr(op, '__dict__')
+        assert op.indices == (0, 6, 10) if kind is eved.SetNameMany \
+            else op.indices == (1, 5, 9)
+        s_expr = eved.parse(eved.deparse(op))
+        assert op == s_expr
+        assert eved.compile_op(s_expr) == op
+        assert op.inverse().inverse() is op
+        assert op.inverse() == eved.invert(op.to_sexpr())
+        # the reference evaluator agrees with the compiled operation
+        applied = copy.deepcopy(labels if kind is not eved.CreateMany
+                                else [e for i, e in enumerate(labels)
+                                      if i not in (1, 5, 9)])
+        evaluated = copy.deepcopy(applied)
+        op.apply(applied)
+        eved.evaluate(s_expr, eved.make_env(labels=evaluated))
+        assert applied == evaluated
+
+    assert cs.rename_where('c', name='a', tier='tier0') == 2
+    assert cs.delete_where(max_duration=0.01) == 1
+    assert cs.rename_where('d', name='spam') == 0
+    assert len(cs.undo_stack) == 2
+    assert len(cs.labels) == 11
+    assert [e['name'] for e in cs.labels[:7]] == ['c', 'b', 'a', 'b', 'b',
+                                                  'c', 'b']
+    assert cs.current_hash() == eved.EventDigest(cs.labels).hexdigest()
+    assert cs.events_in(4.0, 4.5) == []
+    cs.undo()
+    cs.undo()
+    assert cs.labels == labels
+    assert cs.current_hash() == eved.EventDigest(labels).hexdigest()
+    cs.goto(2)
+    assert len(cs.labels) == 11
+    cs.delete_many(range(11))
+    assert cs.labels == []
+    eved.replay(cs.labels, [cs.peek().inverse()])
+    assert len(cs.labels) == 11
+
+    with pytest.raises(IndexError):
+        cs.codegen_delete_many([11])
+    with pytest.raises(ValueError):
+        cs.codegen_rename_many([0], 'a"b')
+    with pytest.raises(ValueError):
+        eved.compile_op(eved.parse('(delete-many #:target (interval #:index 0 #:name "a" #:start 0.0 #:stop 0.5))'))
+    with pytest.raises(ValueError):
+        eved.compile_op(eved.parse('(set-name-many #:target (intervals #:0 (interval #:index 0 #:name "a")))'))
+
+def make_labels(n):
+    return [{'start': float(i), 'stop': i + 0.5, 'name': 'ab'[i % 2],
+             'tier': 'tier' + str(i % 3)}
+            for i in range(n)]
+
+def random_ops(labels, n_ops, seed=0):
+    """Returns a list of valid ops generated by random edits to labels."""
+    import random
+    rng = random.Random(seed)
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file='unused',
+                        load=False)
+    for _ in range(n_ops):
+        choice = rng.randrange(7)
+        idx = rng.randrange(len(cs.labels) - 1)
+        event = cs.labels[idx]
+        if choice == 0:
+            cs.rename(idx, rng.choice('abcd'))
+        elif choice == 1:
+            cs.set_start(idx, event['start'] - 0.1)
+        elif choice == 2:
+            cs.set_stop(idx, event['stop'] + 0.1)
+        elif choice == 3:
+            cs.merge_next(idx)
+        elif choice == 4:
+            cs.split(idx, (event['start'] + event['stop']) / 2)
+        elif choice == 5 and len(cs.labels) > 2:
+            cs.delete(idx)
+        else:
+            cs.create(idx, event['start'] - 0.3, event['start'] - 0.2, 'new',
+                      tier='created')
+    return list(cs.undo_stack), cs.labels
+
+def test_replay(monkeypatch):
+    monkeypatch.setattr(eved._BlockList, 'block_size', 4)
+    labels = make_labels(50)
+    ops, final = random_ops(labels, 300)
+    
+    sequential = copy.deepcopy(labels)
+    test_env = eved.make_env(labels=sequential)
+    for op in ops:
+        eved.evaluate(op.to_sexpr(), test_env)
+    assert sequential == final
+    
+    replayed = copy.deepcopy(labels)
+    eved.replay(replayed, ops)
+    assert replayed == final
+    
+    # value-only operations are applied directly
+    replayed = copy.deepcopy(TEST_LABELS)
+    eved.replay(replayed, [eved.parse(op) for op in TEST_OPS])
+    assert replayed[0]['name'] == 'q'
+    assert replayed[2]['stop'] == 4.5
+    
+    # on failure, labels reflect the operations before the failing one
+    bad_op = eved.parse('(delete #:target (interval #:index 99))')
+    replayed = copy.deepcopy(labels)
+    with pytest.raises(IndexError):
+        eved.replay(replayed, ops[:10] + [bad_op] + ops[10:])
+    partial = copy.deepcopy(labels)
+    eved.replay(partial, ops[:10])
+    assert replayed == partial
+
+def test__BlockList(monkeypatch):
+    monkeypatch.setattr(eved._BlockList, 'block_size', 2)
+    seq = eved._BlockList(range(7))
+    ref = list(range(7))
+    for s in (seq, ref):
+        s.insert(3, 'a')
+        s.insert(0, 'b')
+        s.insert(100, 'c')
+        s.insert(-2, 'd')
+        for _ in range(5):
+            s.insert(4, 'e')
+        s[2] = 'f'
+        s.pop(5)
+        s.pop()
+        s.pop(-3)
+    assert list(seq) == ref
+    assert len(seq) == len(ref)
+    assert [seq[i] for i in range(-len(ref), len(ref))] == ref + ref
+    for item in ref:
+        for start in range(len(ref)):
+            for stop in range(len(ref) + 2):
+                try:
+                    expected = ref.index(item, start, stop)
+                except ValueError:
+                    with pytest.raises(ValueError):
+                        seq.index(item, start, stop)
+                else:
+                    assert seq.index(item, start, stop) == expected
+    with pytest.raises(IndexError):
+        seq[len(ref)]
+    while len(ref):
+        assert seq.pop(0) == ref.pop(0)
+    with pytest.raises(IndexError):
+        seq.pop()
+
 # test inverse parser operations and inverse generator
 
+def test_squash_ops():
+    labels = make_labels(10)
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file='unused',
+                        load=False)
+    for i in range(10):
+        cs.set_start(2, 1.5 + i * 0.01) # folded into one
+        cs.rename(4, 'q')
+    cs.rename(4, 'a') # folded into a no-op, and dropped
+    cs.set_stop(3, 3.9)
+    cs.create(5, 4.6, 4.7, 'x', tier='new')
+    cs.delete(5) # cancels create
+    cs.merge_next(6) # barrier
+    cs.set_start(2, 1.7)
+    squashed = eved.squash_ops(cs.undo_stack)
+    assert [op.kind for op in squashed] == ['set_start', 'set_stop',
+                                            'merge_next', 'set_start']
+    assert squashed[0] == eved.SetStart(2, 2.0, 1.59)
+    replayed = copy.deepcopy(labels)
+    eved.replay(replayed, squashed)
+    assert replayed == cs.labels
+    for op in reversed(squashed):
+        op.inverse().apply(replayed)
+    assert replayed == labels
+    
+    labels = make_labels(50)
+    for seed in range(5):
+        ops, final = random_ops(labels, 60, seed)
+        ops += [op.inverse() for op in reversed(ops[-10:])]
+        squashed = eved.squash_ops(ops)
+        assert len(squashed) < len(ops)
+        replayed = copy.deepcopy(labels)
+        eved.replay(replayed, squashed)
+        expected = copy.deepcopy(labels)
+        eved.replay(expected, ops)
+        assert replayed == expected
+    
+    assert eved.squash_ops([]) == []
+    assert eved.squash_ops([eved.parse(TEST_OPS[0])]) == [eved.parse(TEST_OPS[0])]
+
+def test_diff():
+    labels = make_labels(10)
+    assert eved.diff(labels, copy.deepcopy(labels)) == []
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file='unused',
+                        load=False)
+    cs.rename(1, 'q')
+    cs.set_start(2, 1.8)
+    cs.merge_next(4)
+    cs.split(6, 7.2)
+    cs.set_stop(6, 7.1)
+    cs.delete(9)
+    cs.create(0, -1.0, -0.5, 'new', tier='created')
+    ops = eved.diff(labels, cs.labels)
+    assert [op.kind for op in ops] == ['create', 'set_name', 'set_start',
+                                       'merge_next', 'split', 'delete']
+    assert ops[1] == eved.SetName(2, 'b', 'q')
+    assert (ops[4].new_stop, ops[4].new_next_start) == (7.1, 7.2)
+    assert labels == make_labels(10)
+    
+    # a change in a column other than a boundary or name
+    edited = copy.deepcopy(labels)
+    edited[3]['tier'] = 'other'
+    assert ([op.kind for op in eved.diff(labels, edited)] ==
+            ['delete', 'create'])
+    
+    labels = make_labels(100)
+    for seed in range(10):
+        _, final = random_ops(labels, 40, seed)
+        ops = eved.diff(labels, final)
+        assert len(ops) <= 40
+        cs = eved.EditStack(labels=copy.deepcopy(labels),
+                            ops_file='unused',
+                            load=False)
+        for op in ops:
+            cs.push(eved.parse(eved.deparse(op)))
+        assert cs.labels == final
+        for _ in ops:
+            cs.undo()
+        assert cs.labels == labels
+
+def test_merge(monkeypatch):
+    monkeypatch.setattr(eved._BlockList, 'block_size', 4)
+    labels = make_labels(20)
+    ours = eved.EditStack(labels=copy.deepcopy(labels),
+                          ops_file='unused',
+                          load=False)
+    theirs = eved.EditStack(labels=copy.deepcopy(labels),
+                            ops_file='unused',
+                            load=False)
+    ours.create(0, -1.0, -0.5, 'new')
+    ours.rename(3, 'x') # original event 2
+    ours.delete(6) # original event 5
+    ours.split(11, 11.2) # original event 11
+    ours.set_stop(16, 15.6) # original event 15
+    theirs.set_stop(3, 3.7) # no conflict
+    theirs.rename(2, 'x') # the same edit
+    theirs.delete(5) # the same edit
+    theirs.merge_next(7) # original events 8 and 9
+    theirs.create(10, 11.6, 11.7, 'm') # created between 11 and 12
+    theirs.set_stop(14, 15.7) # conflicts with ours
+    theirs.set_start(18, 19.1) # original event 19
+    merged = eved.merge(labels, ours.undo_stack, theirs.undo_stack)
+    assert merged.ops[:5] == list(ours.undo_stack)
+    assert [op.kind for op in merged.ops[5:]] == ['set_stop', 'merge_next',
+                                                  'create', 'set_start']
+    replayed = copy.deepcopy(labels)
+    eved.replay(replayed, merged.ops)
+    assert replayed == merged.labels
+    assert labels == make_labels(20)
+    expected = copy.deepcopy(ours.labels)
+    expected[4]['stop'] = 3.7
+    expected[8]['stop'] = 9.5
+    del expected[9]
+    expected.insert(12, {'start': 11.6, 'stop': 11.7, 'name': 'm'})
+    expected[-1]['start'] = 19.1
+    assert merged.labels == expected
+    assert merged.conflicts == [eved.Conflict(15, 16,
+                                              [eved.SetStop(16, 15.5, 15.6)],
+                                              [eved.SetStop(14, 15.5, 15.7)])]
+    
+    # edits to separate events merge the same way in either order
+    labels = make_labels(200)
+    for seed in range(5):
+        ours_ops, ours_final = random_ops(labels[:100], 30, seed)
+        theirs_ops, theirs_final = random_ops(labels[100:], 30, seed)
+        theirs_ops = [eved._reindexed(op, op.index + 100)
+                      for op in eved._single_ops(theirs_ops)]
+        merged = eved.merge(labels, ours_ops, theirs_ops)
+        assert not merged.conflicts
+        assert merged.labels == ours_final + theirs_final
+        merged = eved.merge(labels, theirs_ops, ours_ops)
+        assert merged.labels == ours_final + theirs_final
+    
+    # overlapping edits give conflicts, and the merge still replays
+    for seed in range(5):
+        ours_ops, _ = random_ops(labels, 40, seed)
+        theirs_ops, _ = random_ops(labels, 40, seed + 10)
+        merged = eved.merge(labels, ours_ops, theirs_ops)
+        assert merged.conflicts
+        replayed = copy.deepcopy(labels)
+        eved.replay(replayed, merged.ops)
+        assert replayed == merged.labels
+    
+    # a group is merged or left out whole
+    labels = make_labels(10)
+    ours = eved.EditStack(labels=copy.deepcopy(labels),
+                          ops_file='unused',
+                          load=False)
+    ours.rename(4, 'x')
+    theirs = eved.EditStack(labels=copy.deepcopy(labels),
+                            ops_file='unused',
+                            load=False)
+    with theirs.transaction():
+        theirs.rename(2, 'p')
+        theirs.rename(4, 'q')
+    theirs.rename(6, 'r')
+    merged = eved.merge(labels, ours.undo_stack, theirs.undo_stack)
+    assert [e['name'] for e in merged.labels[2:7]] == ['a', 'b', 'x', 'b', 'r']
+    assert merged.conflicts == [eved.Conflict(2, 5, [ours.undo_stack[0]],
+                                              [theirs.undo_stack[0]])]
+    merged = eved.merge(labels, [], theirs.undo_stack)
+    assert [type(op) for op in merged.ops] == [eved.Group, eved.SetName]
+    
+    labels = make_labels(60)
+    for seed in range(5):
+        ours_ops, _ = random_ops(labels, 30, seed)
+        theirs_ops, _ = random_ops(labels, 30, seed + 10)
+        groups = [eved.Group(theirs_ops[i:i + 3]) for i in range(0, 30, 3)]
+        merged = eved.merge(labels, ours_ops, groups)
+        assert labels == make_labels(60)
+        replayed = copy.deepcopy(labels)
+        eved.replay(replayed, merged.ops)
+        assert replayed == merged.labels
+        left_out = [op for c in merged.conflicts for op in c.other_ops]
+        assert len(merged.ops) - len(ours_ops) + len(left_out) <= len(groups)
+        assert all(op in groups for op in left_out)
+    
+    # merges, splits and creations made by both are kept once
+    labels = make_labels(10)
+    stacks = []
+    for first in ('x', 'y'):
+        cs = eved.EditStack(labels=copy.deepcopy(labels),
+                            ops_file='unused',
+                            load=False)
+        cs.rename(8, first)
+        cs.split(2, 2.25)
+        cs.create(5, 3.6, 3.8, 'new')
+        cs.merge_next(6)
+        cs.rename(3, 'z') # the second half of the split
+        stacks.append(cs)
+    merged = eved.merge(labels, stacks[0].undo_stack, stacks[1].undo_stack)
+    assert len(merged.ops) == 5
+    assert merged.labels == stacks[0].labels
+    assert merged.conflicts == [eved.Conflict(8, 9,
+                                              [stacks[0].undo_stack[0]],
+                                              [stacks[1].undo_stack[0]])]
+    
+    # so a history merges with itself
+    labels = make_labels(30)
+    for seed in range(100):
+        ops, final = random_ops(labels, 40, seed)
+        merged = eved.merge(labels, ops, ops)
+        assert not merged.conflicts
+        assert merged.ops == ops
+        assert merged.labels == final
+
+def test_merge_ops_files(tmpdir):
+    labels = make_labels(20)
+    files = []
+    for edits in ([('rename', 2, 'x'), ('delete', 5)],
+                  [('set_stop', 3, 3.7), ('rename', 2, 'y')]):
+        files.append(os.path.join(tmpdir.strpath, 'ops%d' % len(files)))
+        cs = eved.EditStack(labels=copy.deepcopy(labels),
+                            ops_file=files[-1],
+                            load=False)
+        for edit in edits:
+            getattr(cs, edit[0])(*edit[1:])
+        cs.write_to_file()
+    out = os.path.join(tmpdir.strpath, 'merged')
+    conflicts = eved.merge_ops_files(labels, files, out)
+    assert [(c.start, c.stop) for c in conflicts] == [(2, 3)]
+    cs = eved.EditStack(labels=copy.deepcopy(labels), ops_file=out, load=True)
+    assert [op.kind for op in cs.undo_stack] == ['set_name', 'delete',
+                                                 'set_stop']
+    assert cs.labels[2]['name'] == 'x'
+    assert cs.labels[3]['stop'] == 3.7
+    
+    with pytest.raises(ValueError):
+        eved.merge_ops_files(labels[1:], files, out)
+
+def rebase_example():
+    """Returns labels, a stack of corrections to them, and regenerated
+       labels."""
+    labels = make_labels(10)
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file='unused',
+                        load=False)
+    cs.rename(1, 'q')
+    cs.set_stop(3, 3.8) # conflicts with the new stop
+    cs.rename(4, 'x') # applies despite the new stop
+    cs.delete(6) # missing from the new labels anyway
+    cs.split(6, 7.2) # original event 7
+    cs.set_start(8, 8.2) # already the new start
+    cs.rename(9, 'z') # missing from the new labels
+    new_labels = copy.deepcopy(labels)
+    new_labels[3]['stop'] = 3.6
+    new_labels[4]['stop'] = 4.4
+    new_labels[7]['tier'] = 'tier9'
+    new_labels[8]['start'] = 8.2
+    del new_labels[9]
+    del new_labels[6]
+    new_labels.insert(2, {'start': 1.6, 'stop': 1.8, 'name': 'c',
+                          'tier': 'tier0'})
+    return labels, cs, new_labels
+
+def test_rebase(monkeypatch):
+    monkeypatch.setattr(eved._BlockList, 'block_size', 4)
+    labels, cs, new_labels = rebase_example()
+    rebased = eved.rebase(labels, new_labels, cs.undo_stack)
+    assert [op.kind for op in rebased.ops] == ['set_name', 'set_name', 'split']
+    assert rebased.ops[1] == eved.SetName(5, 'a', 'x')
+    expected = copy.deepcopy(new_labels)
+    expected[1]['name'] = 'q'
+    expected[5]['name'] = 'x'
+    expected[7:8] = [dict(expected[7], stop=7.2),
+                     dict(expected[7], start=7.2)]
+    assert rebased.labels == expected
+    replayed = copy.deepcopy(new_labels)
+    eved.replay(replayed, rebased.ops)
+    assert replayed == expected
+    assert [(c.start, c.stop, c.ops) for c in rebased.conflicts] == [
+        (3, 4, []), (9, 10, [])]
+    assert rebased.conflicts[1].other_ops == [eved.SetName(9, 'b', 'z')]
+    
+    # unchanged labels
+    ops, final = random_ops(labels, 40)
+    rebased = eved.rebase(labels, copy.deepcopy(labels), ops)
+    assert not rebased.conflicts
+    assert rebased.labels == final
+    
+    # shifted boundaries, and a dropped and an added event
+    labels = make_labels(100)
+    new_labels = [dict(e, start=e['start'] + 0.01) for e in labels]
+    del new_labels[50]
+    new_labels.insert(20, {'start': 19.6, 'stop': 19.8, 'name': 'c'})
+    for seed in range(5):
+        ops, _ = random_ops(labels, 40, seed)
+        rebased = eved.rebase(labels, new_labels, ops)
+        replayed = copy.deepcopy(new_labels)
+        eved.replay(replayed, rebased.ops)
+        assert replayed == rebased.labels
+    
+    # a rename is kept though the history also splits the event
+    labels = make_labels(5)
+    new_labels = [dict(e, start=e['start'] + 0.01, stop=e['stop'] + 0.01)
+                  for e in labels]
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file='unused',
+                        load=False)
+    with cs.transaction():
+        cs.split(2, 2.25)
+        cs.rename(2, 'p')
+        cs.rename(3, 'q')
+    rebased = eved.rebase(labels, new_labels, cs.undo_stack)
+    assert not rebased.conflicts
+    assert [e['name'] for e in rebased.labels[2:4]] == ['p', 'q']
+    
+    # a group with an operation in conflict is left out whole
+    with cs.transaction():
+        cs.rename(0, 'r')
+        cs.set_stop(4, 4.2)
+    new_labels[4]['stop'] = 4.4
+    rebased = eved.rebase(labels, new_labels, cs.undo_stack)
+    assert rebased.labels[0]['name'] == 'a'
+    assert [c.other_ops for c in rebased.conflicts] == [[cs.undo_stack[1]]]
+    assert [type(op) for op in rebased.ops] == [eved.Group]
+
+def test_CS_rebase_from_file(tmpdir):
+    labels, cs, new_labels = rebase_example()
+    ops_file = os.path.join(tmpdir.strpath, 'ops')
+    cs.write_to_file(ops_file)
+    with pytest.raises(ValueError):
+        eved.EditStack(labels=copy.deepcopy(new_labels), ops_file=ops_file,
+                       load=True)
+    
+    cs = eved.EditStack(labels=copy.deepcopy(new_labels), ops_file=ops_file,
+                        load=False)
+    conflicts = cs.rebase_from_file(labels)
+    assert [(c.start, c.stop) for c in conflicts] == [(3, 4), (9, 10)]
+    assert cs.labels == eved.rebase(labels, new_labels,
+                                    eved.read_ops_file(ops_file)[0]).labels
+    assert cs.hash_pre == eved.event_hash(new_labels, cs.hash_algorithm,
+                                          cs.event_encoding)
+    cs.write_to_file()
+    cs_new = eved.EditStack(labels=copy.deepcopy(new_labels),
+                            ops_file=ops_file,
+                            load=True)
+    assert cs_new.labels == cs.labels
+    for _ in range(3):
+        cs_new.undo()
+    assert cs_new.labels == new_labels
+    
+    with pytest.raises(ValueError): # the file is now against new_labels
+        cs.rebase_from_file(labels)
+
 def test_deatomize():
     assert eved.deatomize(None) == 'null'
     
@@ -236,8 +895,10 @@ def test_deparse():
 def test_invert():
     cmd = '(merge-next #:target (interval-pair #:index 0 #:name null #:sep null #:next-name null) #:new-name "b" #:new-sep 1.5 #:new-next-name "c")'
     hand_inv = '(split #:target (interval-pair #:index 0 #:name "b" #:sep 1.5 #:next-name "c") #:new-name null #:new-sep null #:new-next-name null)'
-    inv = eved.invert(eved.parse(cmd))
+    s_expr = eved.parse(cmd)
+    inv = eved.invert(s_expr)
     assert inv == eved.parse(hand_inv)
+    assert s_expr == eved.parse(cmd) # input is unchanged
     
     ident = eved.invert(eved.invert(eved.parse(cmd)))
     assert cmd == eved.deparse(ident)
@@ -372,6 +1033,713 @@ def test_CS_write_to_file(tmpdir):
     assert cs_new.undo_stack == cs.undo_stack
     assert cs_new.undo_stack[-1] == eved.parse(new_cmd)
     assert cs_new.hash_pre == cs.hash_pre
+    assert cs.hash_post == cs.current_hash()
+    assert cs_new.hash_post == cs_new.current_hash() == cs.current_hash()
+    # a legacy file is written back with the legacy hash
+    with open(tf.name + '.yaml') as mdfp:
+        file_data = yaml.safe_load(mdfp)
+    assert 'hash_algorithm' not in file_data
+    assert file_data['hash_post'] == cs.hash_post
+    
+    # the labels after replay are checked against hash_post
+    file_data['hash_post'] = eved.EventDigest(TEST_LABELS).hexdigest()
+    with open(tf.name + '.yaml', 'w') as mdfp:
+        yaml.safe_dump(file_data, mdfp)
+    with pytest.raises(ValueError):
+        eved.EditStack(labels=copy.deepcopy(TEST_LABELS), ops_file=tf.name,
+                       load=True)
+    cs_lazy = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                             ops_file=tf.name, load=True, lazy=True)
+    with pytest.raises(ValueError):
+        cs_lazy.current_hash()
+    cs.write_to_file()
+    
+    # new stacks record the hash algorithm and event encoding
+    for algorithm in [None, 'sha256']:
+        cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                            ops_file=tf.name,
+                            load=False,
+                            hash_algorithm=algorithm)
+        cs.push(eved.parse(new_cmd))
+        cs.write_to_file()
+        with open(tf.name + '.yaml') as mdfp:
+            file_data = yaml.safe_load(mdfp)
+        algorithm = algorithm or eved.DEFAULT_HASH_ALGORITHM
+        assert file_data == {'hash_pre': eved.event_hash(TEST_LABELS,
+                                                         algorithm, 1),
+                             'hash_post': cs.current_hash(),
+                             'hash_algorithm': algorithm,
+                             'event_encoding': 1}
+        cs_new = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                                ops_file=tf.name,
+                                load=True,
+                                journal=True)
+        assert cs_new.labels == cs.labels
+        assert cs_new.hash_algorithm == algorithm
+        cs_new.journal.close()
+        # as does the journal
+        cs_new = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                                ops_file=tf.name,
+                                load=True,
+                                journal=True)
+        assert cs_new.labels == cs.labels
+        assert cs_new.hash_algorithm == algorithm
+        cs_new.close_journal()
+    labels = copy.deepcopy(TEST_LABELS)
+    labels[0]['name'] = 'spam'
+    with pytest.raises(ValueError):
+        eved.EditStack(labels=labels, ops_file=tf.name, load=True)
+    
+    os.remove(tf.name)
+
+def test_CS_json_metadata(tmpdir):
+    tf = make_corr_file(tmpdir)
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                        ops_file=tf.name,
+                        load=True)
+    assert cs.metadata_format == 'yaml'
+    cs.write_to_file(metadata_format='json')
+    # the YAML metadata is removed, so can't be read in place of the JSON
+    assert not os.path.exists(tf.name + '.yaml')
+    with open(tf.name + '.json') as fp:
+        assert json.load(fp) == {'hash_pre': cs.hash_pre,
+                                 'hash_post': cs.hash_post}
+    cs_new = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                            ops_file=tf.name,
+                            load=True)
+    assert cs_new.metadata_format == 'json'
+    assert cs_new.labels == cs.labels
+    cs_new.rename(0, 'spam')
+    cs_new.write_to_file(metadata_format='yaml')
+    assert not os.path.exists(tf.name + '.json')
+    assert eved.read_metadata(tf.name) == ({'hash_pre': cs.hash_pre,
+                                            'hash_post': cs_new.hash_post},
+                                           'yaml')
+    
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                        ops_file=tf.name,
+                        load=False,
+                        metadata_format='json')
+    cs.write_to_file()
+    metadata, metadata_format = eved.read_metadata(tf.name)
+    assert metadata_format == 'json'
+    assert metadata['hash_pre'] == cs.hash_pre
+    with pytest.raises(ValueError):
+        cs.write_to_file(metadata_format='xml')
+
+def test_import_time():
+    # slow imports are put off until they are needed
+    code = ('import sys, eventedit; '
+            'print(" ".join(sorted(set(sys.modules) & set(sys.argv[1:]))))')
+    slow = ['copy', 'json', 'logging', 'numpy', 'tempfile', 'uuid', 'yaml']
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, '-c', code] + slow,
+                                  cwd=root)
+    assert out.decode().split() == []
+
+def test_CS_binary_file(tmpdir):
+    tf = make_corr_file(tmpdir)
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                            ops_file=tf.name,
+                            load=True)
+    assert cs.ops_format == 'text'
+    cs.rename(3, 'eggs')
+    cs.write_to_file(ops_format='binary')
+    with open(tf.name, 'rb') as fp:
+        assert fp.read().startswith(eved.BINARY_MAGIC)
+    
+    cs_new = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                                ops_file=tf.name,
+                                load=True)
+    assert cs_new.ops_format == 'binary'
+    assert cs_new.undo_stack == cs.undo_stack
+    assert cs_new.labels == cs.labels
+    
+    eved.convert_ops_file(tf.name, tf.name + '.txt', 'text')
+    ops, ops_format = eved.read_ops_file(tf.name + '.txt')
+    assert ops_format == 'text'
+    assert ops == list(cs.undo_stack)
+    with open(tf.name + '.txt') as fp:
+        assert fp.read().splitlines() == [eved.deparse(op) for op in ops]
+    
+    with pytest.raises(ValueError):
+        cs.write_to_file(ops_format='xml')
+    
+    os.remove(tf.name)
+
+def test_CS_lazy_load(tmpdir):
+    tf = make_corr_file(tmpdir)
+    eager = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                           ops_file=tf.name,
+                           load=True)
+
+    labels = copy.deepcopy(TEST_LABELS)
+    cs = eved.EditStack(labels=labels,
+                        ops_file=tf.name,
+                        load=True,
+                        lazy=True)
+    assert not cs.loaded
+    assert labels == TEST_LABELS # nothing replayed yet
+    assert len(cs.undo_stack) == len(TEST_OPS)
+    assert cs.peek() == eved.parse(TEST_OPS[-1])
+    assert cs.peek(0) == eved.parse(TEST_OPS[0])
+    with pytest.raises(IndexError):
+        cs.peek(len(TEST_OPS))
+    assert labels == TEST_LABELS
+    assert cs.labels == eager.labels # first access replays
+    assert cs.loaded
+    assert list(cs.undo_stack) == list(eager.undo_stack)
+    assert cs.current_hash() == eager.current_hash()
+
+    # on a thread-safe stack, only what needs the labels replays them
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                        ops_file=tf.name,
+                        load=True,
+                        lazy=True,
+                        thread_safe=True)
+    assert cs.peek() == eved.parse(TEST_OPS[-1])
+    assert len(cs.undo_stack) == len(TEST_OPS)
+    cs.start_journal()
+    cs.close_journal()
+    assert not cs.loaded
+    cs.read_from_file(lazy=True) # the old replay is never needed
+    assert not cs.loaded
+    assert cs.current_hash() == eager.current_hash()
+    assert cs.loaded
+    
+    # an edit triggers the replay before it is applied
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                        ops_file=tf.name,
+                        load=True,
+                        lazy=True)
+    cs.rename(3, 'eggs')
+    eager.rename(3, 'eggs')
+    assert cs.loaded
+    assert cs.labels == eager.labels
+    cs.undo()
+    cs.undo()
+    assert len(cs.undo_stack) == len(TEST_OPS) - 1
+
+    # binary files are read eagerly, but replayed lazily
+    eager.write_to_file(tf.name + '.bin', ops_format='binary')
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                        ops_file=tf.name + '.bin',
+                        load=True,
+                        lazy=True)
+    assert cs.ops_format == 'binary'
+    assert not cs.loaded
+    assert cs.labels == eager.labels
+
+    # a hash mismatch is reported when the labels are needed
+    cs = eved.EditStack(labels=make_labels(5),
+                        ops_file=tf.name,
+                        load=True,
+                        lazy=True)
+    with pytest.raises(ValueError):
+        cs.labels
+    assert not cs.loaded
+
+    assert eved._form_spans(b'(a "(" b)\n  (c (d))') == [(0, 9), (12, 19)]
+    with pytest.raises(SyntaxError):
+        eved._form_spans(b'(a (b)')
+    with pytest.raises(SyntaxError):
+        eved._form_spans(b'(a))')
+
+    os.remove(tf.name)
+
+def test_CS_journal(tmpdir):
+    labels = copy.deepcopy(TEST_LABELS)
+    tf = make_corr_file(tmpdir)
+    
+    cs = eved.EditStack(labels=labels,
+                            ops_file=tf.name,
+                            load=True,
+                            journal=True)
+    assert os.path.exists(tf.name + '.journal')
+    cs.rename(3, 'eggs')
+    cs.split(1, 3.0)
+    cs.undo()
+    cs.set_stop(0, 2.0)
+    cs.undo()
+    expected = copy.deepcopy(cs.labels)
+    # simulate a process killed partway through writing a record
+    with open(tf.name + '.journal', 'a') as fp:
+        fp.write('(push (set-name #:target (interval #:index 0 #:name "q"')
+    
+    labels = copy.deepcopy(TEST_LABELS)
+    cs_new = eved.EditStack(labels=labels,
+                                ops_file=tf.name,
+                                load=True,
+                                journal=True,
+                                fsync_every=0)
+    assert cs_new.labels == expected
+    assert cs_new.undo_stack == cs.undo_stack
+    assert cs_new.redo_stack == cs.redo_stack
+    cs_new.redo()
+    assert cs_new.labels[0]['stop'] == 2.0
+    
+    # the restarted journal reproduces the recovered state
+    with open(tf.name + '.journal') as fp:
+        hash_pre, undo_ops, redo_ops = eved.read_journal(fp)
+    assert hash_pre == cs.hash_pre
+    assert undo_ops == list(cs_new.undo_stack)
+    assert redo_ops == list(cs_new.redo_stack)
+    
+    # journal doesn't match labels
+    with pytest.raises(ValueError):
+        eved.EditStack(labels=copy.deepcopy(expected),
+                       ops_file=tf.name,
+                       load=True,
+                       journal=True)
+    
+    # regular exit saves the operations and removes the journal
+    with cs_new:
+        pass
+    assert not os.path.exists(tf.name + '.journal')
+    labels = copy.deepcopy(TEST_LABELS)
+    cs_new = eved.EditStack(labels=labels, ops_file=tf.name, load=True)
+    assert cs_new.labels[0]['stop'] == 2.0
+    assert cs_new.labels[3]['name'] == 'eggs'
+    
+    with pytest.raises(ValueError):
+        eved.read_journal(io.StringIO(TEST_OPS[0]))
+    
+    # journals from before version 2 use the legacy hash
+    with open(tf.name + '.journal', 'w') as fp:
+        fp.write('(journal #:version 1 #:hash_pre "%s")\n(push %s)\n'
+                 % (eved.event_hash(TEST_LABELS), TEST_OPS[0]))
+    cs_new = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                            ops_file=tf.name,
+                            load=True,
+                            journal=True)
+    assert cs_new.labels[0]['name'] == 'q'
+    assert cs_new.hash_algorithm == 'sha1'
+    cs_new.close_journal()
+    
+    os.remove(tf.name)
+
+def test_CS_squash(tmpdir):
+    tf = make_corr_file(tmpdir)
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                            ops_file=tf.name,
+                            load=True)
+    cs.set_stop(2, 4.4)
+    cs.rename(0, 'a')
+    cs.write_to_file(squash=True)
+    assert len(cs.undo_stack) == 4
+    
+    cs_new = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                                ops_file=tf.name,
+                                load=True)
+    assert list(cs_new.undo_stack) == [eved.parse(TEST_OPS[1][:-4] + '4.4)')]
+    assert cs_new.labels == cs.labels
+    assert cs_new.hash_pre == cs.hash_pre
+    
+    cs.squash()
+    assert cs.undo_stack == cs_new.undo_stack
+    cs.undo()
+    assert cs.labels == TEST_LABELS
+    
+    os.remove(tf.name)
+
+def test_CS_goto(tmpdir, monkeypatch):
+    monkeypatch.setattr(eved._FrozenEvents, 'block_size', 4)
+    labels = make_labels(50)
+    ops, _ = random_ops(labels, 60, seed=3)
+    states = [copy.deepcopy(labels)]
+    plain = eved.EditStack(labels=copy.deepcopy(labels),
+                           ops_file='unused',
+                           load=False)
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file='unused',
+                        load=False,
+                        checkpoint_interval=8)
+    for op in ops:
+        plain.push(op)
+        cs.push(op)
+        states.append(copy.deepcopy(cs.labels))
+    assert sorted(cs._checkpoints) == list(range(0, 61, 8))
+    # checkpoints share the blocks of events unchanged between them
+    blocks = set(id(b) for c in cs._checkpoints.values() for b in c)
+    assert len(blocks) < sum(len(c) for c in cs._checkpoints.values())
+
+    for revision in [3, 60, 0, 59, 17, 45, 44, 60, 1]:
+        plain.goto(revision)
+        cs.goto(revision)
+        assert cs.revision == revision
+        assert cs.labels == states[revision]
+        assert plain.labels == states[revision]
+        assert list(cs.undo_stack) == ops[:revision]
+        assert list(cs.redo_stack) == list(plain.redo_stack)
+        assert cs.current_hash() == eved.EventDigest(cs.labels).hexdigest()
+        assert cs.events_in(-1, 100) == list(range(len(cs.labels)))
+    cs.redo()
+    assert cs.labels == states[2]
+    cs.undo()
+    cs.undo()
+    assert cs.labels == states[0]
+    with pytest.raises(IndexError):
+        cs.goto(61)
+    with pytest.raises(IndexError):
+        cs.goto(-1)
+
+    # a push discards the checkpoints of the abandoned revisions
+    cs.goto(20)
+    cs.rename(0, 'eggs')
+    assert sorted(cs._checkpoints) == [0, 8, 16]
+    cs.goto(0)
+    assert cs.labels == states[0]
+    cs.goto(21)
+    assert cs.labels[0]['name'] == 'eggs'
+
+    # loading checkpoints the replay, and a journal follows goto
+    cs.write_to_file(str(tmpdir.join('ops')))
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file=str(tmpdir.join('ops')),
+                        load=True,
+                        journal=True,
+                        checkpoint_interval=8)
+    assert sorted(cs._checkpoints) == [0, 8, 16]
+    cs.goto(5)
+    assert cs.labels == states[5]
+    recovered = eved.EditStack(labels=copy.deepcopy(labels),
+                               ops_file=str(tmpdir.join('ops')),
+                               load=True,
+                               journal=True)
+    assert recovered.labels == states[5]
+    assert len(recovered.redo_stack) == 16
+    cs.close_journal()
+
+def test_CS_transaction(tmpdir):
+    labels = make_labels(6)
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file=str(tmpdir.join('ops')),
+                        load=False,
+                        journal=True,
+                        checkpoint_interval=1)
+    cs.rename(0, 'eggs')
+    cs.undo()
+    with cs.transaction():
+        cs.split(1, 1.25)
+        with cs.transaction(): # joins the outer transaction
+            cs.rename(2, 'spam')
+        cs.rename(1, 'ham')
+        with pytest.raises(RuntimeError):
+            cs.undo()
+    assert len(cs.undo_stack) == 1
+    assert not cs.redo_stack
+    group = cs.peek()
+    assert type(group) is eved.Group
+    assert not hasattr(group, '__dict__')
+    assert [op.kind for op in group.ops] == ['split', 'set_name', 'set_name']
+    assert [e['name'] for e in cs.labels[:4]] == ['a', 'ham', 'spam', 'a']
+    expected = copy.deepcopy(cs.labels)
+    assert cs.current_hash() == eved.EventDigest(expected).hexdigest()
+
+    # the group is undone and redone as a unit
+    cs.undo()
+    assert cs.labels == labels
+    assert cs.events_in(-1, 100) == list(range(6))
+    cs.redo()
+    assert cs.labels == expected
+
+    # an exception rolls back the operations pushed in the block
+    with pytest.raises(ZeroDivisionError):
+        with cs.transaction():
+            cs.delete(0)
+            cs.rename(0, 'eggs')
+            1 / 0
+    assert cs.labels == expected
+    assert list(cs.undo_stack) == [group]
+    assert cs.current_hash() == eved.EventDigest(expected).hexdigest()
+    assert sorted(cs._checkpoints) == [0, 1]
+    with cs.transaction():
+        pass
+    assert len(cs.undo_stack) == 1
+
+    # the journal only records the group
+    cs.journal.close()
+    recovered = eved.EditStack(labels=copy.deepcopy(labels),
+                               ops_file=str(tmpdir.join('ops')),
+                               load=True,
+                               journal=True)
+    assert recovered.labels == expected
+    assert list(recovered.undo_stack) == [group]
+    recovered.close_journal()
+
+    # a group which fails partway is undone before the exception propagates
+    s_expr = eved.parse(eved.deparse(group))
+    assert group == s_expr
+    assert group.inverse() == eved.invert(s_expr)
+    evaluated = copy.deepcopy(labels)
+    eved.evaluate(s_expr, eved.make_env(labels=evaluated))
+    assert evaluated == expected
+    bad = eved.Group([group.ops[0], eved.SetStop(9, 9.5, 10.0)])
+    before = copy.deepcopy(cs.labels)
+    with pytest.raises(Exception):
+        cs.push(bad)
+    assert cs.labels == before
+    assert list(cs.undo_stack) == [group]
+
+def test_RWLock():
+    lock = eved.RWLock()
+    with lock.write():
+        with lock.write():
+            with lock.read():
+                pass
+    with lock.read():
+        with lock.read():
+            with pytest.raises(RuntimeError):
+                lock.acquire_write()
+    with pytest.raises(RuntimeError):
+        lock.release_read()
+
+    # readers share the lock; a writer waits for them, and new readers wait
+    # for a waiting writer
+    order = []
+    def writer():
+        with lock.write():
+            order.append('write')
+    def reader():
+        with lock.read():
+            order.append('read')
+    with lock.read():
+        threads = [threading.Thread(target=writer)]
+        threads[0].start()
+        while not lock._waiting:
+            time.sleep(0.001)
+        threads.append(threading.Thread(target=reader))
+        threads[1].start()
+        time.sleep(0.01)
+        assert order == []
+    for thread in threads:
+        thread.join()
+    assert order == ['write', 'read']
+
+def test_CS_thread_safe(tmpdir):
+    labels = make_labels(100)
+    ops, _ = random_ops(labels, 150, seed=5)
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file=str(tmpdir.join('ops')),
+                        load=False,
+                        thread_safe=True)
+    snapshots = []
+    done = threading.Event()
+    def edit():
+        try:
+            for i, op in enumerate(ops):
+                if i % 10 == 9:
+                    with cs.transaction():
+                        cs.push(op)
+                        cs.rename(0, 'eggs')
+                        cs.rename(0, labels[0]['name'])
+                else:
+                    cs.push(op)
+        finally:
+            done.set()
+    def read():
+        while True:
+            snapshots.append(cs.snapshot())
+            cs.write_to_file()
+            if done.is_set():
+                break
+    threads = [threading.Thread(target=edit), threading.Thread(target=read),
+               threading.Thread(target=read)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    snapshots.append(cs.snapshot())
+
+    # each snapshot is of the labels as left by its undo stack
+    for snap in snapshots[::max(len(snapshots) // 20, 1)] + snapshots[-1:]:
+        assert snap.revision == len(snap.undo_ops)
+        expected = copy.deepcopy(labels)
+        eved.replay(expected, snap.undo_ops)
+        assert snap.labels == expected
+        assert snap.current_hash == eved.EventDigest(expected).hexdigest()
+    assert snapshots[-1].labels == cs.labels
+    assert cs.snapshot(labels=False).labels is None
+
+    # the file written last holds a consistent history
+    loaded = eved.EditStack(labels=copy.deepcopy(labels),
+                            ops_file=str(tmpdir.join('ops')),
+                            load=True)
+    assert len(loaded.undo_stack) <= len(cs.undo_stack)
+    assert list(loaded.undo_stack) == \
+        list(cs.undo_stack)[:len(loaded.undo_stack)]
+
+    # edits wait for readers to finish
+    with cs.reading():
+        thread = threading.Thread(target=cs.undo)
+        thread.start()
+        time.sleep(0.01)
+        assert cs.revision == len(ops)
+        with pytest.raises(RuntimeError):
+            cs.rename(0, 'spam')
+    thread.join()
+    assert cs.revision == len(ops) - 1
+
+def test_CS_write_unlocked(tmpdir, monkeypatch):
+    labels = make_labels(10)
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file=str(tmpdir.join('ops')),
+                        load=False,
+                        thread_safe=True)
+    cs.rename(0, 'eggs')
+    write_ops_file = eved.write_ops_file
+    def slow_write(*args, **kwargs):
+        # another thread edits while the files are being written
+        thread = threading.Thread(target=cs.rename, args=(1, 'spam'))
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+        write_ops_file(*args, **kwargs)
+    monkeypatch.setattr(eved, 'write_ops_file', slow_write)
+    cs.write_to_file()
+    assert cs.revision == 2
+    # the files hold the stack as it was when the write began
+    monkeypatch.setattr(eved, 'write_ops_file', write_ops_file)
+    loaded = eved.EditStack(labels=copy.deepcopy(labels),
+                            ops_file=str(tmpdir.join('ops')),
+                            load=True)
+    assert list(loaded.undo_stack) == list(cs.undo_stack)[:1]
+    assert loaded.current_hash() == cs.hash_post != cs.current_hash()
+
+def test_Autosaver(caplog):
+    saved = []
+    def save():
+        saved.append(len(saved))
+        if len(saved) == 3:
+            raise IOError('disk full')
+    saver = eved.Autosaver(save, delay=0.1)
+    for _ in range(20): # a burst of edits is saved once
+        saver.changed()
+    time.sleep(0.3)
+    assert saved == [0]
+    saver.changed()
+    saver.flush() # doesn't wait for the pause
+    assert saved == [0, 1]
+    saver.flush() # nothing to save
+    assert saved == [0, 1]
+    saver.changed()
+    time.sleep(0.15)
+    assert saved == [0, 1, 2]
+    assert isinstance(saver.error, IOError)
+    assert 'autosave failed' in caplog.text
+    time.sleep(0.2) # retried
+    assert saved == [0, 1, 2, 3]
+    assert saver.error is None
+    saver.close()
+    assert not saver._thread.is_alive()
+
+    saved = []
+    saver = eved.Autosaver(lambda: saved.append(None), max_edits=3)
+    saver.changed()
+    saver.changed()
+    time.sleep(0.05)
+    assert saved == []
+    saver.changed()
+    time.sleep(0.05)
+    assert saved == [None]
+    saver.changed()
+    saver.close()
+    assert saved == [None, None]
+
+def test_CS_autosave(tmpdir):
+    labels = make_labels(20)
+    ops_file = str(tmpdir.join('ops'))
+    def load():
+        return eved.EditStack(labels=copy.deepcopy(labels), ops_file=ops_file,
+                              load=True)
+    with eved.EditStack(labels=copy.deepcopy(labels), ops_file=ops_file,
+                        load=False, autosave=0.05) as cs:
+        assert cs._lock is not None
+        cs.rename(0, 'eggs')
+        cs.split(3, 3.25)
+        cs.undo()
+        time.sleep(0.2)
+        assert load().labels == cs.labels
+        cs.delete(5)
+        cs.flush()
+        assert load().labels == cs.labels
+        with cs.transaction():
+            with pytest.raises(RuntimeError):
+                cs.flush()
+        cs.close()
+        cs.close()
+        cs.rename(1, 'spam') # saved on leaving the context manager
+    assert load().labels == cs.labels
+    assert not os.path.exists(ops_file + '.tmp')
+
+    # a failed write leaves the last file intact
+    def failing():
+        yield eved.SetName(0, 'eggs', 'spam')
+        raise IOError('disk full')
+    with pytest.raises(IOError):
+        eved.write_ops_file(ops_file, failing())
+    assert load().labels == cs.labels
+    assert not os.path.exists(ops_file + '.tmp')
+
+def test_CS_stats(tmpdir, caplog, monkeypatch):
+    import logging
+    tf = make_corr_file(tmpdir)
+    events = []
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                            ops_file=tf.name,
+                            load=True,
+                            stats_hook=lambda name, t: events.append(name))
+    cs.rename(3, 'eggs')
+    cs.merge_next(0)
+    cs.undo()
+    cs.undo()
+    cs.redo()
+    cs.write_to_file()
+    stats = cs.stats()
+    assert stats['push.set_name']['count'] == 1
+    assert stats['push.merge_next']['count'] == 1
+    assert stats['undo.merge_next']['count'] == 1
+    assert stats['undo.set_name']['count'] == 1
+    assert stats['redo.set_name']['count'] == 1
+    assert stats['apply.set_name']['count'] == 3
+    assert stats['apply.split']['count'] == 1
+    for name in ('read_from_file', 'write_to_file', 'parse', 'replay', 'hash'):
+        assert stats[name]['count'] == 1
+        assert stats[name]['seconds'] >= 0
+    assert events[:4] == ['hash', 'parse', 'replay', 'read_from_file']
+    assert events[4:6] == ['apply.set_name', 'push.set_name']
+    assert len(events) == sum(s['count'] for s in stats.values())
+    
+    assert cs.stats(reset=True) == stats
+    assert cs.stats() == {}
+    
+    # a write doesn't rehash the labels
+    def event_hash(*args, **kwargs):
+        raise AssertionError('labels rehashed')
+    monkeypatch.setattr(eved, 'event_hash', event_hash)
+    cs.rename(0, 'spam')
+    cs.write_to_file()
+    assert 'hash' not in cs.stats()
+    assert cs.stats()['write_to_file']['count'] == 1
+    monkeypatch.undo()
+    cs.stats(reset=True)
+    
+    logger = logging.getLogger('eventedit.test')
+    with caplog.at_level(logging.INFO, logger='eventedit.test'):
+        cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                                ops_file=tf.name,
+                                load=False,
+                                stats_hook=eved.logging_hook(logger,
+                                                             logging.INFO))
+        cs.rename(0, 'q')
+    assert [r.getMessage().split()[0] for r in caplog.records] == \
+           ['hash', 'apply.set_name', 'push.set_name']
+    
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                            ops_file=tf.name,
+                            load=True)
+    cs.rename(0, 'q')
+    assert cs.stats() == {}
     
     os.remove(tf.name)
 
@@ -679,6 +2047,134 @@ def test_CS_create():
     os.remove(tf.name)
 
 
+def test_EventDigest(monkeypatch):
+    monkeypatch.setattr(eved._DigestList, 'block_size', 2)
+    labels = make_labels(30)
+    digest = eved.EventDigest(labels, 'sha1', None)
+    assert digest.flat_hash == eved.event_hash(labels)
+    assert eved.EventDigest(labels, 'blake2b').flat_hash == \
+        eved.event_hash(labels, 'blake2b', 1)
+    assert len(digest) == 30
+    initial = digest.hexdigest()
+    assert initial == eved.EventDigest(copy.deepcopy(labels)).hexdigest()
+    assert initial != eved.EventDigest(labels[1:]).hexdigest()
+    assert initial != eved.EventDigest(labels[::-1]).hexdigest()
+    
+    digest.replace(3, 1, [TEST_LABELS[0]])
+    digest.replace(5, 2, [])
+    digest.replace(0, 0, TEST_LABELS)
+    expected = TEST_LABELS + labels[:3] + [TEST_LABELS[0]] + labels[4:5] + labels[7:]
+    assert digest.hexdigest() == eved.EventDigest(expected).hexdigest()
+    
+    assert eved.EventDigest([]).hexdigest() != eved.EventDigest(labels[:1]).hexdigest()
+
+def test_CS_current_hash():
+    labels = make_labels(40)
+    ops, final = random_ops(labels, 100)
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file='unused',
+                        load=False)
+    assert cs.hash_algorithm == eved.DEFAULT_HASH_ALGORITHM
+    assert cs.hash_pre == eved.event_hash(labels, cs.hash_algorithm,
+                                          cs.event_encoding)
+    initial = cs.current_hash()
+    for op in ops:
+        cs.push(op)
+        assert cs.current_hash() == eved.EventDigest(cs.labels).hexdigest()
+    assert cs.labels == final
+    while cs.undo_stack:
+        cs.undo()
+    assert cs.current_hash() == initial
+    
+    # direct modification of labels needs rehash
+    cs.labels[0]['name'] = 'spam'
+    assert cs.current_hash() == initial
+    cs.rehash()
+    assert cs.current_hash() != initial
+
+def test_TimeIndex(monkeypatch):
+    monkeypatch.setattr(eved._TimeList, 'block_size', 2)
+    labels = make_labels(30)
+    labels[10]['stop'] = 20.0 # overlaps many later events
+    index = eved.TimeIndex(labels)
+    def brute_at(events, t):
+        return [i for i, e in enumerate(events) if e['start'] <= t < e['stop']]
+    def brute_overlapping(events, t0, t1):
+        return [i for i, e in enumerate(events)
+                if e['start'] < t1 and e['stop'] > t0]
+    
+    for t in (-1.0, 0.0, 0.25, 0.5, 12.2, 19.9, 29.4, 40.0):
+        assert index.at(t) == brute_at(labels, t)
+    assert index.overlapping(4.7, 12.1) == brute_overlapping(labels, 4.7, 12.1)
+    assert index.overlapping(30.0, 31.0) == []
+    
+    new_events = [{'start': 12.1, 'stop': 12.3}, {'start': 0.1, 'stop': 0.2}]
+    index.replace(12, 1, new_events)
+    index.replace(3, 2, [])
+    labels[12:13] = new_events
+    labels[3:5] = []
+    assert len(index) == len(labels)
+    for t in (0.15, 10.0, 12.2, 19.9):
+        assert index.at(t) == brute_at(labels, t)
+    assert index.overlapping(0.0, 13.0) == brute_overlapping(labels, 0.0, 13.0)
+
+def test_CS_time_lookup():
+    labels = make_labels(30)
+    ops, final = random_ops(labels, 100, seed=1)
+    cs = eved.EditStack(labels=copy.deepcopy(labels),
+                        ops_file='unused',
+                        load=False)
+    assert cs.event_at(3.2) == 3
+    assert cs.event_at(3.7) is None
+    assert cs.events_in(2.6, 4.2) == [3, 4]
+    for op in ops:
+        cs.push(op)
+    assert cs.events_in(-10.0, 100.0) == list(range(len(cs.labels)))
+    for t in (1.25, 7.1, 15.4):
+        expected = [i for i, e in enumerate(final) if e['start'] <= t < e['stop']]
+        assert cs.event_at(t) == (expected[0] if expected else None)
+    
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                        ops_file='unused',
+                        load=False)
+    cs.rename_at(2.5, 'z')
+    assert cs.labels[1]['name'] == 'z'
+    cs.set_start_at(4.8, 4.6)
+    assert cs.labels[3]['start'] == 4.6
+    cs.set_stop_at(1.5, 2.0)
+    assert cs.labels[0]['stop'] == 2.0
+    cs.split_at(3.0)
+    assert cs.labels[1]['stop'] == 3.0
+    assert cs.labels[2]['start'] == 3.0
+    assert cs.event_at(3.2) == 2
+    cs.delete_at(3.2)
+    assert cs.event_at(3.2) is None
+    with pytest.raises(ValueError):
+        cs.delete_at(2.05)
+    assert len(cs.undo_stack) == 5
+    
+    # labels changed directly need a rehash, which also drops the index
+    cs = eved.EditStack(labels=copy.deepcopy(TEST_LABELS),
+                        ops_file='unused',
+                        load=False,
+                        checkpoint_interval=2)
+    cs.rename(0, 'eggs')
+    assert cs.event_at(2.5) == 1
+    cs.labels.insert(0, {'start': -1.0, 'stop': -0.5, 'name': 'spam'})
+    cs.rehash()
+    assert cs.event_at(2.5) == 2
+    assert sorted(cs._checkpoints) == [1]
+    expected = copy.deepcopy(cs.labels)
+    for i in range(4):
+        cs.rename(i, 'ham')
+    cs.goto(1)
+    assert cs.labels == expected
+    assert cs.events_in(-10.0, 100.0) == list(range(len(expected)))
+    cs.labels = copy.deepcopy(TEST_LABELS)
+    assert cs.event_at(2.5) == 1
+    assert cs.current_hash() == eved.EventDigest(TEST_LABELS).hexdigest()
+    assert sorted(cs._checkpoints) == [1]
+
 def test_event_hash():
     d1 = {'a': 1, 'b': 2, 'c': 3}
     d2 = {'d': 4, 'e': 5, 'f': 6}
@@ -688,4 +2184,38 @@ def test_event_hash():
     dl1 = [d1, d2]
     dl2 = [d3, d4]
     
-    assert eved.event_hash(dl1) == eved.event_hash(dl2)
\ No newline at end of file
+    assert eved.event_hash(dl1) == eved.event_hash(dl2)
+    assert eved.event_hash(dl1, 'blake2b', 1) == \
+        eved.event_hash(dl2, 'blake2b', 1)
+    assert eved.event_hash(dl1, 'blake2b', 1) != eved.event_hash(dl1)
+    assert eved.event_hash(dl1, 'sha256', 1) != \
+        eved.event_hash(dl1, 'blake2b', 1)
+    with pytest.raises(ValueError):
+        eved.event_hash(dl1, 'spam')
+    with pytest.raises(ValueError):
+        eved.event_hash(dl1, 'sha1', 99)
+    eved.register_hash_algorithm('md5', hashlib.md5)
+    assert eved.event_hash(dl1, 'md5', 1) == \
+        hashlib.md5(b''.join(eved.encode_event(e) for e in dl1)).hexdigest()
+    del eved.HASH_ALGORITHMS['md5']
+
+def test_encode_event():
+    event = {'start': 1.5, 'stop': 2.0, 'name': u'\xe9', 'tier': None,
+             'n': 3, 'flag': True, 'data': b'\x00', 'xs': [1, 2]}
+    encoded = eved.encode_event(event)
+    assert encoded == eved.encode_event(dict(reversed(list(event.items()))))
+    # the column count, then the column names, start, stop and name first
+    assert encoded.startswith(b'\x08\x00\x00\x00\x05\x00\x00\x00start'
+                              b'\x04\x00\x00\x00stop\x04\x00\x00\x00name'
+                              b'\x04\x00\x00\x00data')
+    assert encoded.endswith(b'f\x00\x00\x00\x00\x00\x00\xf8?'
+                            b'f\x00\x00\x00\x00\x00\x00\x00@'
+                            b's\x02\x00\x00\x00\xc3\xa9'
+                            b'y\x01\x00\x00\x00\x00'
+                            b'T'
+                            b'i\x01\x00\x00\x003'
+                            b'n'
+                            b'r\x06\x00\x00\x00[1, 2]')
+    # values of different types differ
+    for other in [1, '1.5', None, True]:
+        assert eved.encode_event(dict(event, start=other)) != encoded
\ No newline at end of file
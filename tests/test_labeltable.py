@@ -0,0 +1,177 @@
+import pytest
+import copy
+import eventedit.eventedit as eved
+from eventedit.labeltable import LabelTable, MISSING
+from test_eventedit import TEST_LABELS, TEST_OPS, make_labels, random_ops
+
+np = pytest.importorskip('numpy')
+
+def test_LabelTable_init():
+    table = LabelTable(TEST_LABELS)
+    assert len(table) == 4
+    assert table.to_dicts() == TEST_LABELS
+    assert table == TEST_LABELS
+    assert table.columns == ['start', 'stop', 'name', 'tier']
+    assert table.start.dtype == np.float64
+    assert list(table.names) == ['a', 'b', 'c', 'd']
+    assert list(table.column('tier')) == ['tier0', 'tier1', 'tier2', 'tier3']
+    assert len(LabelTable()) == 0
+    
+    ragged = [{'start': 0.0, 'stop': 1.0, 'name': 'a'},
+              {'start': 1.0, 'stop': 2.0, 'name': 'b', 'spam': 'eggs'}]
+    table = LabelTable(ragged)
+    assert table.to_dicts() == ragged
+    assert table.column('spam')[0] is MISSING
+    assert 'spam' not in table[0]
+
+def test_LabelTable_rows():
+    table = LabelTable(TEST_LABELS)
+    row = table[-1]
+    assert row == TEST_LABELS[3]
+    assert isinstance(row['start'], float)
+    assert set(row.keys()) == set(TEST_LABELS[3].keys())
+    row['name'] = 'z'
+    row['stop'] = 6.0
+    row['new_column'] = 3
+    assert table[3]['name'] == 'z'
+    assert table[3]['stop'] == 6.0
+    assert table[3]['new_column'] == 3
+    with pytest.raises(KeyError):
+        table[0]['new_column']
+    with pytest.raises(KeyError):
+        table[0]['sirnotappearinginthisfilm']
+    with pytest.raises(IndexError):
+        table[4]
+    
+    copied = copy.deepcopy(table[0])
+    assert isinstance(copied, dict)
+    assert copied == TEST_LABELS[0]
+
+def test_LabelTable_insert_and_pop():
+    table = LabelTable(TEST_LABELS)
+    ref = copy.deepcopy(TEST_LABELS)
+    for labels in (table, ref):
+        for i in range(20):
+            labels.insert(i % 3, {'start': float(i), 'stop': i + 1.0,
+                                  'name': 'n' + str(i), 'tier': 'x'})
+        labels.insert(100, {'start': 9.0, 'stop': 9.5, 'name': 'end',
+                            'tier': 'y'})
+        labels.pop(5)
+        labels.pop()
+        labels.pop(-2)
+    assert table == ref
+    assert len(table) == len(ref)
+    with pytest.raises(IndexError):
+        LabelTable().pop()
+
+def test_LabelTable_slicing_and_queries():
+    table = LabelTable(TEST_LABELS)
+    assert table[1:3] == TEST_LABELS[1:3]
+    assert table[::-1] == TEST_LABELS[::-1]
+    assert list(table.at(2.1)) == [1]
+    assert list(table.at(4.5)) == []
+    assert list(table.overlapping(3.0, 4.8)) == [1, 2, 3]
+    assert np.allclose(table.durations(), [1.1, 1.4, 0.7, 0.3])
+
+def test_LabelTable_raw_operations():
+    labels = make_labels(20)
+    ops, final = random_ops(labels, 200)
+    table = LabelTable(labels)
+    for op in ops:
+        op.apply(table)
+    assert table == final
+    
+    table = LabelTable(labels)
+    eved.replay(table, ops)
+    assert table == final
+
+def test_LabelTable_EditStack(tmpdir):
+    from test_eventedit import make_corr_file
+    assert eved.event_hash(LabelTable(TEST_LABELS)) == \
+        eved.event_hash(TEST_LABELS)
+    
+    tf = make_corr_file(tmpdir)
+    cs = eved.EditStack(labels=LabelTable(TEST_LABELS),
+                        ops_file=tf.name,
+                        load=True)
+    assert isinstance(cs.labels, LabelTable)
+    assert cs.labels[0]['name'] == 'q'
+    assert cs.labels[2]['stop'] == 4.5
+    cs.split(0, 1.5)
+    cs.merge_next(2)
+    cs.delete(0)
+    assert len(cs.labels) == 3
+    cs.undo()
+    cs.undo()
+    cs.undo()
+    assert cs.labels[0]['name'] == 'q'
+    cs.undo()
+    cs.undo()
+    assert cs.labels == TEST_LABELS
+
+def test_LabelTable_integer_times(tmpdir):
+    labels = [{'start': i, 'stop': i + 1, 'name': 'n%d' % i}
+              for i in range(10)]
+    labels[3]['stop'] = 3.5
+    labels[5]['start'] = None
+    table = LabelTable(labels)
+    # times are returned as given, so hash as the list does
+    assert table.to_dicts() == labels
+    assert [type(e['start']) for e in table.to_dicts()] == \
+        [type(e['start']) for e in labels]
+    assert type(table[0]['stop']) is int and type(table[3]['stop']) is float
+    assert table[5]['start'] is None
+    assert np.isnan(table.start[5])
+    assert table.start.dtype == np.float64
+    for args in [(), ('sha256', 1)]:
+        assert eved.event_hash(table, *args) == eved.event_hash(labels, *args)
+    assert eved.EventDigest(table).hexdigest() == \
+        eved.EventDigest(labels).hexdigest()
+    table[1]['start'] = 1.25
+    table.insert(0, {'start': -1, 'stop': 0, 'name': 'x'})
+    assert type(table[2]['start']) is float and type(table[0]['start']) is int
+    assert table[1:3].to_dicts() == [dict(labels[0]),
+                                     dict(labels[1], start=1.25)]
+    
+    # an operations file made against the list loads into a table
+    ops_file = str(tmpdir.join('ops'))
+    cs = eved.EditStack(labels=copy.deepcopy(labels), ops_file=ops_file,
+                        load=False)
+    cs.split(0, 0.5)
+    cs.set_stop(4, 7)
+    cs.rename(8, 'z')
+    cs.write_to_file()
+    loaded = eved.EditStack(labels=LabelTable(labels), ops_file=ops_file,
+                            load=True)
+    assert loaded.labels == cs.labels
+    assert loaded.current_hash() == cs.current_hash()
+
+def test_LabelTable_checkpoints():
+    labels = [{'start': float(i), 'stop': i + 0.5, 'name': 'n%d' % i}
+              for i in range(100)]
+    cs = eved.EditStack(labels=LabelTable(labels),
+                        ops_file='unused',
+                        load=False,
+                        checkpoint_interval=2)
+    cs.delete(0)
+    cs.delete(0)
+    cs.rename(50, 'zz')
+    cs.delete(0)
+    cs.rename(60, 'yy')
+    cs.goto(0)
+    assert cs.labels == labels
+    
+    labels = make_labels(40)
+    for seed in range(10):
+        ops, _ = random_ops(labels, 60, seed)
+        cs = eved.EditStack(labels=LabelTable(labels),
+                            ops_file='unused',
+                            load=False,
+                            checkpoint_interval=4)
+        states = [labels]
+        for op in ops:
+            cs.push(op)
+            states.append(cs.labels.to_dicts())
+        for revision in (0, 60, 13, 37, 2, 59, 21):
+            cs.goto(revision)
+            assert cs.labels == states[revision]